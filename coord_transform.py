@@ -0,0 +1,190 @@
+## Vectorized transforms of particle coordinates, e.g. from cryoSPARC to RELION
+import numpy as np
+
+
+def _zero(value):
+    return not isinstance(value, np.ndarray) and value == 0
+
+
+def _times(value, factor):
+    # value * factor, 0 without a multiplication if value is 0
+    return 0.0 if _zero(value) else value * factor
+
+
+def _linear(out, first, second, a, b, c):
+    """
+    out = a * first + b * second + c, skipping the terms that are 0. out may be
+    first, not second.
+    """
+    if _zero(a):
+        out[:] = 0
+    else:
+        np.multiply(first, a, out=out)
+    if not _zero(b):
+        out += second * b
+    if not _zero(c):
+        out += c
+
+
+class CoordTransform:
+    """
+    Transform of particle coordinates, built a step at a time and applied to
+    all particles at once. The steps that move coordinates (swap, flip, scale,
+    to_absolute, to_fractional) are composed into one affine map, applied in a
+    single pass over float64 arrays of x and y; within then keeps only the
+    particles whose box is inside the micrograph, and rounded rounds to whole
+    pixels. Sizes are numbers, arrays with one for each particle, or names of
+    columns of the dataframe (or fields of the array) the coordinates are in.
+    From the fractional coordinates of cryoSPARC, whose micrograph_shape is
+    (height, width), to RELION pixels of a micrograph cropped by 2:
+
+        shape = cs_array["location/micrograph_shape"]
+        transform = (
+            CoordTransform()
+            .flip(y=True)
+            .to_absolute(shape[:, 1], shape[:, 0])
+            .scale(2)
+            .within(624, 11520, 8184)
+        )
+        x, y, keep = transform.apply(
+            cs_array["location/center_x_frac"], cs_array["location/center_y_frac"]
+        )
+    """
+
+    def __init__(self):
+        self._steps = []
+        self._within = None
+        self._rounded = False
+
+    def swap(self):
+        """
+        Exchanges x and y
+        """
+        self._steps.append(("swap", ()))
+        return self
+
+    def flip(self, x=False, y=False, width=1, height=1):
+        """
+        Mirrors x to width - x and/or y to height - y; the default sizes of 1
+        flip fractional coordinates
+        """
+        self._steps.append(("flip", (x, y, width, height)))
+        return self
+
+    def scale(self, x, y=None):
+        """
+        Multiplies x by x and y by y (x if None), e.g. by a crop factor
+        """
+        self._steps.append(("scale", (x, x if y is None else y)))
+        return self
+
+    def to_absolute(self, width, height):
+        """
+        Fractional coordinates to pixels of micrographs of width and height
+        """
+        return self.scale(width, height)
+
+    def to_fractional(self, width, height):
+        """
+        Pixels of micrographs of width and height to fractional coordinates
+        """
+        self._steps.append(("divide", (width, height)))
+        return self
+
+    def within(self, box_size, width, height):
+        """
+        Keeps only the particles whose box of box_size pixels is inside the
+        micrograph of width and height, after all the other steps
+        """
+        self._within = (box_size, width, height)
+        return self
+
+    def rounded(self):
+        """
+        Rounds the coordinates to whole pixels, after all the other steps
+        """
+        self._rounded = True
+        return self
+
+    @property
+    def columns(self):
+        """
+        Names of the columns that sizes are read from
+        """
+        sizes = [size for _, arguments in self._steps for size in arguments]
+        sizes += list(self._within or ())
+        return list(dict.fromkeys(s for s in sizes if isinstance(s, str)))
+
+    def _affine(self, size):
+        """
+        Coefficients of the steps composed: x' = ax[0] x + ax[1] y + ax[2], and
+        y' likewise with ay. size gives the value of a size.
+        """
+        ax, ay = [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]
+        for step, arguments in self._steps:
+            if step == "swap":
+                ax, ay = ay, ax
+            elif step == "flip":
+                x, y, width, height = arguments
+                if x:
+                    ax = [_times(c, -1.0) for c in ax[:2]] + [size(width) - ax[2]]
+                if y:
+                    ay = [_times(c, -1.0) for c in ay[:2]] + [size(height) - ay[2]]
+            else:
+                x, y = (size(a) for a in arguments)
+                if step == "divide":
+                    x, y = 1.0 / x, 1.0 / y
+                ax = [_times(c, x) for c in ax]
+                ay = [_times(c, y) for c in ay]
+        return ax, ay
+
+    def apply(self, x, y, frame=None, inplace=False):
+        """
+        Transforms the coordinates x and y, arrays, and returns them as new
+        float64 arrays with a boolean array of the particles kept (None without
+        within). If inplace, x and y must be writable float64 arrays, which are
+        changed and returned. Sizes given as names are read from frame, a
+        dataframe or cs array.
+        """
+
+        def size(value):
+            if isinstance(value, str):
+                return np.asarray(frame[value], dtype=np.float64)
+            if np.ndim(value):
+                return np.asarray(value, dtype=np.float64)
+            return float(value)
+
+        if not inplace:
+            x, y = (np.array(values, dtype=np.float64) for values in [x, y])
+        elif not all(
+            isinstance(v, np.ndarray) and v.dtype == np.float64 and v.flags.writeable
+            for v in [x, y]
+        ):
+            raise ValueError("inplace needs x and y as writable float64 arrays")
+        ax, ay = self._affine(size)
+        if self._steps:
+            new_x = np.empty_like(x)
+            _linear(new_x, x, y, *ax)
+            _linear(y, y, x, ay[1], ay[0], ay[2])  # with x as it was
+            x[:] = new_x
+        if self._rounded:
+            np.rint(x, out=x)
+            np.rint(y, out=y)
+        keep = None
+        if self._within is not None:
+            box_size, width, height = (size(v) for v in self._within)
+            half = box_size / 2
+            keep = (x >= half) & (x <= width - half)
+            keep &= (y >= half) & (y <= height - half)
+        return x, y, keep
+
+    def apply_df(self, df, x="CoordinateX", y="CoordinateY"):
+        """
+        A new dataframe: df with the coordinates in columns x and y transformed,
+        as float64, and without the rows of the particles within drops
+        """
+        new_x, new_y, keep = self.apply(df[x], df[y], df)
+        df = df.assign(**{x: new_x, y: new_y})
+        if keep is not None and not keep.all():
+            df = df[keep].reset_index(drop=True)
+        return df
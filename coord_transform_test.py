@@ -0,0 +1,91 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from coord_transform import CoordTransform
+
+
+class testCoordTransform(unittest.TestCase):
+    def setUp(self):
+        self.x = np.array([0.1, 0.5, 0.9])
+        self.y = np.array([0.2, 0.4, 0.99])
+
+    def test_steps(self):
+        x, y, keep = CoordTransform().swap().apply(self.x.copy(), self.y.copy())
+        self.assertEqual((x.tolist(), y.tolist()), ([0.2, 0.4, 0.99], [0.1, 0.5, 0.9]))
+        self.assertIsNone(keep)
+        x, y, _ = CoordTransform().flip(x=True).apply([0.25], [0.5])
+        self.assertEqual((x.tolist(), y.tolist()), ([0.75], [0.5]))
+        x, y, _ = (
+            CoordTransform()
+            .swap()
+            .flip(x=True, y=True, width=100, height=50)
+            .apply([1.0, 2.0], [3.0, 4.0])
+        )
+        self.assertEqual((x.tolist(), y.tolist()), ([97.0, 96.0], [49.0, 48.0]))
+        transform = CoordTransform().to_absolute(200, 100).to_fractional(200, 100)
+        x, y, _ = transform.apply(self.x, self.y)
+        np.testing.assert_allclose(x, [0.1, 0.5, 0.9])
+
+    def test_copies(self):
+        x, y = self.x.copy(), self.y.copy()
+        new_x, new_y, _ = CoordTransform().swap().scale(2, 3).apply(x, y)
+        self.assertEqual((x.tolist(), y.tolist()), (self.x.tolist(), self.y.tolist()))
+        np.testing.assert_allclose(new_x, self.y * 2)
+        np.testing.assert_allclose(new_y, self.x * 3)
+        ints = np.array([1, 2])
+        new_x, _, _ = CoordTransform().scale(2).apply(ints, ints)
+        self.assertEqual(ints.tolist(), [1, 2])
+        self.assertEqual(new_x.tolist(), [2.0, 4.0])
+
+    def test_in_place(self):
+        x, y = self.x.copy(), self.y.copy()
+        transform = CoordTransform().swap().scale(2, 3)
+        new_x, new_y, _ = transform.apply(x, y, inplace=True)
+        self.assertIs(new_x, x)
+        self.assertIs(new_y, y)
+        np.testing.assert_allclose(x, self.y * 2)
+        np.testing.assert_allclose(y, self.x * 3)
+        with self.assertRaises(ValueError):
+            transform.apply(np.array([1, 2]), y, inplace=True)
+        x.flags.writeable = False
+        with self.assertRaises(ValueError):
+            transform.apply(x, y, inplace=True)
+
+    def test_cryosparc_to_relion(self):
+        # as the notebooks did it, with micrograph_shape (height, width)
+        shape = np.array([[4000, 6000], [4000, 6000], [2000, 3000]])
+        expected_x = np.rint(self.x * shape[:, 1] * 2)
+        expected_y = np.rint((1 - self.y) * shape[:, 0] * 2)
+        transform = (
+            CoordTransform()
+            .flip(y=True)
+            .to_absolute(shape[:, 1], shape[:, 0])
+            .scale(2)
+            .rounded()
+            .within(200, 12000, 8000)
+        )
+        x, y, keep = transform.apply(self.x.copy(), self.y.copy())
+        self.assertEqual(x.tolist(), expected_x.tolist())
+        self.assertEqual(y.tolist(), expected_y.tolist())
+        self.assertEqual(keep.tolist(), [True, True, False])  # y is 80
+
+    def test_apply_df(self):
+        df = pd.DataFrame(
+            {
+                "CoordinateX": ["10", "20", "30"],
+                "CoordinateY": [5.0, 50.0, 58.0],
+                "Width": [40, 25, 40],
+            }
+        )
+        transform = CoordTransform().flip(x=True, width="Width").within(10, "Width", 60)
+        self.assertEqual(transform.columns, ["Width"])
+        result = transform.apply_df(df)
+        self.assertEqual(result["CoordinateX"].tolist(), [30.0, 5.0])
+        self.assertEqual(result["CoordinateY"].tolist(), [5.0, 50.0])
+        self.assertEqual(df["CoordinateX"].tolist(), ["10", "20", "30"])
+
+
+if __name__ == "__main__":
+    unittest.main()
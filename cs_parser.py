@@ -4,6 +4,8 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
+from coord_transform import CoordTransform
+
 mappings = {
     "uid": "uid",
     "blob/path": "ImageName",
@@ -132,11 +134,23 @@ class CsParser:
         return df
 
     def swap_coords(self, coord_x, coord_y):
-        swapped_x, swapped_y = [], []
+        # arrays of coordinates, as new float arrays
+        swapped_x, swapped_y, _ = CoordTransform().swap().apply(coord_x, coord_y)
         return swapped_x, swapped_y
 
-    def invert_coord(self, old_coord):
-        return 1 - old_coord
+    def invert_coord(self, old_coord, size=1):
+        # a coordinate or array of them, fractional unless size is given
+        return np.subtract(size, old_coord, dtype=np.float64)
+
+    def transform_coords(self, transform, x="location/center_x_frac", y=None):
+        """
+        The coordinates in fields x and y of the array (y: x with _y for _x)
+        changed by transform, a CoordTransform, as new arrays, and a boolean
+        array of the particles it keeps (None if it keeps all). Sizes that
+        transform names are read from the fields of the array.
+        """
+        y = x.replace("_x", "_y") if y is None else y
+        return transform.apply(self.cs_array[x], self.cs_array[y], self.cs_array)
 
     # def to_df(self):
     #     self.df = pd.DataFrame(self.cs_array, columns=self.column_names.keys())
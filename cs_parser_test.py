@@ -3,6 +3,7 @@ import unittest
 
 import numpy as np
 
+from coord_transform import CoordTransform
 from cs_parser import CsParser
 
 
@@ -33,6 +34,52 @@ class test_parser(unittest.TestCase):
             with self.assertRaises(OSError):
                 parser.parse_array()
 
+    def test_transform_coords(self):
+        particles = np.zeros(
+            3,
+            dtype=[
+                ("location/center_x_frac", "<f8"),
+                ("location/center_y_frac", "<f8"),
+                ("location/micrograph_shape", "<u4", (2,)),
+            ],
+        )
+        particles["location/center_x_frac"] = [0.25, 0.5, 0.75]
+        particles["location/center_y_frac"] = [0.5, 0.25, 0.9]
+        particles["location/micrograph_shape"] = [[40, 80], [40, 80], [20, 40]]
+        with tempfile.NamedTemporaryFile(suffix=".cs") as f:
+            np.save(f, particles)
+            f.seek(0)
+            parser = CsParser(f.name).parse_array()
+        shape = parser.cs_array["location/micrograph_shape"]
+        transform = (
+            CoordTransform()
+            .flip(y=True)
+            .to_absolute(shape[:, 1], shape[:, 0])
+            .within(10, 80, 40)
+        )
+        x, y, keep = parser.transform_coords(transform)
+        self.assertEqual(x.tolist(), [20.0, 40.0, 30.0])
+        np.testing.assert_allclose(y, [20.0, 30.0, 2.0])
+        self.assertEqual(keep.tolist(), [True, True, False])  # y is 2
+        # the array is not changed
+        self.assertEqual(
+            parser.cs_array["location/center_y_frac"].tolist(), [0.5, 0.25, 0.9]
+        )
+
+    def test_swap_coords(self):
+        with tempfile.NamedTemporaryFile() as f:
+            parser = CsParser(f.name)
+        x, y = np.array([1.0, 2.0]), np.array([3.0, 4.0])
+        swapped_x, swapped_y = parser.swap_coords(x, y)
+        self.assertEqual((swapped_x.tolist(), swapped_y.tolist()), ([3, 4], [1, 2]))
+        self.assertEqual((x.tolist(), y.tolist()), ([1, 2], [3, 4]))
+
+    def test_invert_coord(self):
+        with tempfile.NamedTemporaryFile() as f:
+            parser = CsParser(f.name)
+        self.assertEqual(parser.invert_coord(np.array([0.25])).tolist(), [0.75])
+        self.assertEqual(parser.invert_coord(10.0, size=40), 30.0)
+
     def test_detect_colum_dimensionality(self):
         parser = CsParser(self.test_file)
         array = parser.parse_array().cs_array
@@ -6,6 +6,8 @@ from pathlib import Path
 
 from gooey import Gooey
 
+from star_parser import KeySet, StarParser, StarWriter, sort_chunks
+
 
 class StarMasher():
 
@@ -17,6 +19,19 @@ class StarMasher():
         parser = argparse.ArgumentParser()
         parser.add_argument('-i', '--input', nargs='+', required=True, help='Input star file')
         parser.add_argument('-o', '--output', required=True, help='Output star file with modifications')
+        parser.add_argument('-j', '--join', help='Join the second star file to the first on this column')
+        parser.add_argument('--how', choices=['inner', 'left', 'anti'], default='inner',
+                            help='inner: rows in both files, left: all rows of the first file, anti: rows only in the first file')
+        parser.add_argument('--conflicts', choices=['left', 'right', 'suffix', 'error'], default='left',
+                            help='Columns in both files: values of the first file, of the second, both or error')
+        parser.add_argument('-d', '--diff', help='Write the rows added, removed and changed in the second star file, paired on this column')
+        parser.add_argument('--tolerance', type=float, default=0, help='Largest difference of numbers that --diff does not report')
+        parser.add_argument('-s', '--select', help='Keep the rows whose --key is in this star, cs or text file (one key per line)')
+        parser.add_argument('--key', default='ImageName', help='Column compared by --select')
+        parser.add_argument('--exclude', action='store_true', help='Drop the rows found by --select instead of keeping them')
+        parser.add_argument('--sort', nargs='+', help='Sort the rows by these columns, the table is never in memory as a whole')
+        parser.add_argument('--descending', action='store_true', help='Sort from the largest values by --sort')
+        parser.add_argument('--tab', default='data_particles', help='Table to join, diff, select from or sort')
         parser.args = parser.parse_args()
         return parser
 
@@ -37,7 +52,7 @@ class StarMasher():
                 except AssertionError:
                     sys.exit(f'The file {f} does not exist')
             try:
-                assert len(self.input_star) == 2
+                assert len(self.input_star) <= 2
             except AssertionError:
                 sys.exit(f'Please give a maximum of two iput star files')
         #required arguments -- output
@@ -48,6 +63,84 @@ class StarMasher():
             sys.exit(f'Cannot create the star file {a.output}. Does the folder exist?')
         except TypeError as e:
             sys.exit(f'{a.output} does not seem to be a valid name for a file')
+        #optional arguments -- join
+        self.join_column = a.join
+        self.how = a.how
+        self.conflicts = a.conflicts
+        self.tab = a.tab
+        #optional arguments -- diff
+        self.diff_column = a.diff
+        self.tolerance = a.tolerance
+        #optional arguments -- select
+        self.selection = a.select
+        self.key = a.key
+        self.exclude = a.exclude
+        #optional arguments -- sort
+        self.sort_columns = a.sort
+        self.ascending = not a.descending
+
+    def join(self):
+        # the table of the second file joined to the first, the other tables of the first are copied
+        try:
+            assert isinstance(self.input_star, list) and len(self.input_star) == 2
+        except AssertionError:
+            sys.exit('Please give two input star files to join: -i first.star second.star')
+        star = StarParser(self.input_star[0], create=False)
+        try:
+            star.join(self.input_star[1], self.tab, self.join_column, self.how, self.conflicts)
+        except (KeyError, ValueError) as e:
+            sys.exit(f'Cannot join {self.input_star[1]} to {self.input_star[0]}: {e}')
+        star.write_out(to_file=True, new_file=self.output_star)
+
+    def select(self):
+        # the rows of the table selected as the first file is read, the other tables are copied
+        selection = Path(self.selection)
+        try:
+            if selection.suffix == '.cs':
+                keys = KeySet.from_cs(selection, self.key)
+            elif '.star' in selection.suffixes:
+                tab = StarParser(selection, create=False).parse(tabs=self.tab, columns=[self.key])
+                keys = KeySet.from_tab(tab[self.tab], self.key)
+            else:
+                keys = KeySet.from_text(selection)
+            star = StarParser(self.input_star[0], create=False)
+            star.parse(where={self.tab: {self.key: ~keys if self.exclude else keys}})
+        except (OSError, KeyError, ValueError) as e:
+            sys.exit(f'Cannot select rows of {self.input_star[0]} from {selection}: {e}')
+        star.write_out(to_file=True, new_file=self.output_star)
+
+    def sort(self):
+        # the table sorted as it streams to the output, the other tables are copied
+        star = StarParser(self.input_star[0], create=False)
+        try:
+            blocks = star.index()
+            if self.tab not in blocks:
+                raise KeyError(f'There is no table {self.tab}')
+            with StarWriter(self.output_star) as writer:
+                for name, block in blocks.items():
+                    if name == self.tab:
+                        chunks = sort_chunks(star.iter_chunks(name), self.sort_columns, self.ascending)
+                        writer.write_chunks(name, chunks, block.version)
+                    else:
+                        writer.write_tab(star.parse(tabs=name)[name])
+        except (KeyError, ValueError) as e:
+            sys.exit(f'Cannot sort {self.input_star[0]}: {e}')
+
+    def diff(self):
+        # the rows added, removed and changed in the second file as tables <tab>_added, <tab>_removed, <tab>_changed
+        try:
+            assert isinstance(self.input_star, list) and len(self.input_star) == 2
+        except AssertionError:
+            sys.exit('Please give two input star files to diff: -i first.star second.star')
+        star = StarParser(self.input_star[0], create=False)
+        try:
+            diff = star.diff(self.input_star[1], self.tab, self.diff_column, tolerance=self.tolerance)
+        except (KeyError, ValueError) as e:
+            sys.exit(f'Cannot diff {self.input_star[1]} against {self.input_star[0]}: {e}')
+        with StarWriter(self.output_star) as writer:
+            for kind, tab in diff.items():
+                tab.name = f'{self.tab}_{kind}'
+                writer.write_tab(tab)
 
 @Gooey
 def main():
@@ -56,6 +149,14 @@ def main():
     work_folder = Path(r'F:\Users\Cthulhu\Documents\workspace\Starfile')
     os.chdir(work_folder)
     masher = StarMasher()
+    if masher.join_column:
+        masher.join()
+    elif masher.diff_column:
+        masher.diff()
+    elif masher.selection:
+        masher.select()
+    elif masher.sort_columns:
+        masher.sort()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
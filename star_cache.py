@@ -0,0 +1,263 @@
+## Binary sidecar cache of parsed star files, one .npy file per column
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from star_parser import _INDEXES, StarGeneralTab, StarTab, _is_categorical
+
+_DIRECTORY = Path(
+    os.environ.get("STAR_CACHE_DIR", Path.home() / ".cache" / "star_parser")
+)
+_MAX_BYTES = 20 << 30
+_SAMPLE = 1 << 20  # bytes hashed at the start, middle and end of a file
+
+
+def fingerprint(star):
+    """
+    Sampled fingerprint of a star file: its size, modification time and a hash
+    of the first, middle and last _SAMPLE bytes, so that multi-GB files are not
+    read in full. It is not a hash of the whole content: an edit outside the
+    samples that keeps the size and modification time is not noticed.
+    """
+    star = Path(star)
+    stat = star.stat()
+    digest = hashlib.blake2b(str(stat.st_size).encode())
+    with open(star, "rb") as f:
+        for offset in [0, (stat.st_size - _SAMPLE) // 2, stat.st_size - _SAMPLE]:
+            f.seek(max(offset, 0))
+            digest.update(f.read(_SAMPLE))
+    return {
+        "path": str(star.resolve()),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "hash": digest.hexdigest(),
+    }
+
+
+def _save_column(entry, index, series):
+    # returns the description of the column for the metadata
+    column = {"name": series.name, "file": f"{index}.npy"}
+    if _is_categorical(series.dtype):
+        column["kind"] = "category"
+        column["categories"] = series.cat.categories.tolist()
+        values = series.cat.codes.to_numpy()
+    elif isinstance(series.dtype, np.dtype) and series.dtype.kind in "biuf":
+        column["kind"] = "array"
+        values = series.to_numpy()
+    else:
+        column["kind"] = "strings"
+        try:
+            values = np.array(series.tolist(), dtype=bytes)
+            column["encoding"] = "ascii"
+        except UnicodeEncodeError:
+            values = np.array([value.encode() for value in series], dtype=bytes)
+            column["encoding"] = "utf-8"
+    np.save(entry / column["file"], values)
+    return column
+
+
+def _save_index(entry, prefix, column, index):
+    # one .npy file per array of the index, described for the metadata
+    files = {}
+    for name, values in index.arrays().items():
+        files[name] = f"{prefix}_{name}.npy"
+        np.save(entry / files[name], values)
+    return {"column": column, "kind": index.kind, "files": files}
+
+
+def _load_column(entry, column):
+    # copy-on-write mapping: the dataframe can be changed, the file is not
+    values = np.load(entry / column["file"], mmap_mode="c")
+    if column["kind"] == "category":
+        return pd.Categorical.from_codes(values, categories=column["categories"])
+    if column["kind"] == "strings":
+        if column["encoding"] == "ascii":
+            values = values.astype(str)
+        else:
+            values = np.char.decode(values, "utf-8")
+        return pd.Series(values.astype(object), dtype=object)
+    return values
+
+
+class StarCache:
+    """
+    Keeps the tables of parsed star files as one .npy file per column in
+    directory, which later opens map into memory instead of parsing the text.
+    An entry is only used while the star file has the fingerprint it was stored
+    with (see fingerprint). The least recently used entries are removed
+    when the cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = Path(directory) if directory else _DIRECTORY
+        self.max_bytes = _MAX_BYTES if max_bytes is None else max_bytes
+
+    def _entry(self, star):
+        path = str(Path(star).resolve()).encode()
+        return self.directory / hashlib.blake2b(path, digest_size=16).hexdigest()
+
+    def load(self, star, tabs=None, columns=None):
+        """
+        Returns the tables of star as StarParser.parse would, or None if the
+        cache has no valid entry for it. tabs and columns select tables and
+        columns as in StarParser.parse, only the columns needed are mapped.
+        """
+        entry = self._entry(star)
+        try:
+            meta = json.loads((entry / "meta.json").read_text())
+        except (OSError, ValueError):
+            return None
+        if meta["source"] != fingerprint(star):
+            self.invalidate(star)
+            return None
+        os.utime(entry / "meta.json")  # most recently used
+        if isinstance(tabs, str):
+            tabs = [tabs]
+        parsed = {}
+        for table in meta["tabs"]:
+            if tabs is None or table["name"] in tabs:
+                parsed[table["name"]] = self._load_tab(entry, table, columns)
+        return parsed
+
+    def _load_tab(self, entry, table, columns):
+        by_table = isinstance(columns, dict)
+        if by_table:
+            columns = columns.get(table["name"])
+        if table["general"]:
+            tab = StarGeneralTab(table["name"])
+            tab.version = table["version"]
+            tab.labels = table["labels"]
+            tab.body = table["body"]
+            return tab
+        tab = StarTab(table["name"])
+        tab.version = table["version"]
+        tab.labels = table["labels"]
+        names = tab.get_columns(update=True)
+        if columns is not None and not by_table and not tab._has_columns(columns):
+            columns = None  # as StarParser.parse, for the tables that have them
+        keep = names if columns is None else tab._resolve_columns(columns)
+        data = {
+            c["name"]: _load_column(entry, c)
+            for c in table["columns"]
+            if c["name"] in keep
+        }
+        # copy=False: the columns stay mapped instead of being read into memory
+        tab.df = pd.DataFrame(
+            data, columns=keep, index=pd.RangeIndex(table["rows"]), copy=False
+        )
+        if columns is not None:
+            tab._update_labels(keep)
+        for index in table.get("indexes", []):
+            if index["column"] in keep:
+                arrays = {
+                    name: np.load(entry / file, mmap_mode="r")
+                    for name, file in index["files"].items()
+                }
+                values = tab.df[index["column"]]
+                tab._add_index(
+                    index["column"],
+                    _INDEXES[index["kind"]].from_arrays(values, arrays),
+                )
+        return tab
+
+    def store(self, star, tabs):
+        """
+        Writes all tables of star, as returned by StarParser.parse, to the
+        cache with the indexes made with persist=True, then removes the least
+        recently used entries above max_bytes.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        meta = {"source": fingerprint(star), "tabs": []}
+        temporary = Path(tempfile.mkdtemp(dir=self.directory, prefix=".tmp"))
+        try:
+            for name, tab in tabs.items():
+                table = {"name": name, "version": tab.version, "labels": tab.labels}
+                table["general"] = isinstance(tab, StarGeneralTab)
+                if table["general"]:
+                    table["body"] = tab.body
+                else:
+                    df = tab.to_df()
+                    table["rows"] = len(df)
+                    table["columns"] = [
+                        _save_column(temporary, f"{len(meta['tabs'])}_{i}", df[c])
+                        for i, c in enumerate(df.columns)
+                    ]
+                    # indexes made with persist=True, see StarTab.create_index
+                    indexes = [
+                        (c, index)
+                        for c, index in tab._check_indexes().items()
+                        if index.persist
+                    ]
+                    table["indexes"] = [
+                        _save_index(temporary, f"{len(meta['tabs'])}_i{i}", c, index)
+                        for i, (c, index) in enumerate(indexes)
+                    ]
+                meta["tabs"].append(table)
+            (temporary / "meta.json").write_text(json.dumps(meta))
+            entry = self._entry(star)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(temporary, entry)
+        finally:
+            shutil.rmtree(temporary, ignore_errors=True)
+        self._evict()
+
+    def invalidate(self, star):
+        shutil.rmtree(self._entry(star), ignore_errors=True)
+
+    def clear(self):
+        for entry in self.entries():
+            shutil.rmtree(entry)
+
+    def entries(self):
+        """
+        Cache entries, least recently used first
+        """
+        if not self.directory.exists():
+            return []
+        entries = [e for e in self.directory.iterdir() if (e / "meta.json").exists()]
+        return sorted(entries, key=lambda e: (e / "meta.json").stat().st_mtime)
+
+    def size(self, entry=None):
+        entries = self.entries() if entry is None else [entry]
+        return sum(f.stat().st_size for e in entries for f in e.iterdir())
+
+    def _evict(self):
+        entries = self.entries()
+        total = self.size()
+        while entries and total > self.max_bytes:
+            entry = entries.pop(0)
+            total -= self.size(entry)
+            shutil.rmtree(entry)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the star file cache")
+    parser.add_argument("-d", "--directory", help=f"default {_DIRECTORY}")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the cached star files")
+    commands.add_parser("clear", help="remove all cached star files")
+    invalidate = commands.add_parser("invalidate", help="remove star files")
+    invalidate.add_argument("stars", nargs="+")
+    args = parser.parse_args()
+    cache = StarCache(args.directory)
+    if args.command == "list":
+        for entry in cache.entries():
+            source = json.loads((entry / "meta.json").read_text())["source"]
+            print(f"{source['path']} ({cache.size(entry)} bytes)")
+    elif args.command == "clear":
+        cache.clear()
+    else:
+        for star in args.stars:
+            cache.invalidate(star)
+
+
+if __name__ == "__main__":
+    main()
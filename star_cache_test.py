@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pathlib import Path
+
+import numpy as np
+
+from star_cache import StarCache
+from star_parser import StarGeneralTab, StarParser
+
+
+class testStarCache(unittest.TestCase):
+    def setUp(self):
+        working_dir = Path(os.path.abspath(__file__)).parent
+        self.tmp = Path(tempfile.mkdtemp())
+        self.starfile = self.tmp / "micrographs_ctf.star"
+        shutil.copy(working_dir / "static/micrographs_ctf.star", self.starfile)
+        self.model = self.tmp / "run_it025_model.star"
+        shutil.copy(working_dir / "static/run_it025_model.star", self.model)
+        self.cache = StarCache(self.tmp / "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_load_matches_parse(self):
+        for star in [self.starfile, self.model]:
+            expected = StarParser(star, create=False).parse()
+            self.assertIsNone(self.cache.load(star))
+            StarParser(star, create=False).parse(cache=self.cache)
+            loaded = StarParser(star, create=False).parse(cache=self.cache)
+            self.assertEqual(list(loaded), list(expected))
+            for name, tab in expected.items():
+                self.assertEqual(loaded[name].labels, tab.labels)
+                self.assertEqual(loaded[name].to_star(), tab.to_star())
+                if not isinstance(tab, StarGeneralTab):
+                    self.assertTrue(loaded[name].to_df().equals(tab.to_df()))
+        self.assertEqual(len(self.cache.entries()), 2)
+
+    def test_load_selection(self):
+        StarParser(self.starfile, create=False).parse(cache=self.cache)
+        parser = StarParser(self.starfile, create=False)
+        tabs = parser.parse(
+            tabs="data_micrographs", columns=["DefocusU"], cache=self.cache
+        )
+        self.assertEqual(list(tabs), ["data_micrographs"])
+        self.assertEqual(list(tabs["data_micrographs"].to_df()), ["DefocusU"])
+        self.assertEqual(tabs["data_micrographs"].labels, ["loop_", "_rlnDefocusU #1"])
+        with self.assertRaises(KeyError):
+            parser.parse(tabs="data_particles", cache=self.cache)
+        # data_optics lacks the columns and is loaded whole
+        tabs = parser.parse(columns=["DefocusU"], cache=self.cache)
+        self.assertEqual(list(tabs["data_micrographs"].to_df()), ["DefocusU"])
+        self.assertEqual(len(tabs["data_optics"].columns()), 8)
+        with self.assertRaises(KeyError):
+            parser.parse(columns=["NotAColumn"], cache=self.cache)
+
+    def test_loaded_tables_can_be_changed(self):
+        StarParser(self.starfile, create=False).parse(cache=self.cache)
+        tab = self.cache.load(self.starfile)["data_micrographs"]
+        tab.df.loc[0, "DefocusU"] = -1
+        tab = self.cache.load(self.starfile)["data_micrographs"]
+        self.assertNotEqual(tab.df.loc[0, "DefocusU"], -1)
+
+    def test_loaded_columns_are_memory_mapped(self):
+        StarParser(self.starfile, create=False).parse(cache=self.cache)
+        parser = StarParser(self.starfile, create=False)
+        df = parser.parse(cache=self.cache)["data_micrographs"].to_df()
+        for values in [df["DefocusU"].to_numpy(), df["CtfImage"].values.codes]:
+            while not isinstance(values, np.memmap):
+                self.assertIsNotNone(values.base)
+                values = values.base
+
+    def test_persisted_indexes(self):
+        tabs = StarParser(self.starfile, create=False).parse()
+        tab = tabs["data_micrographs"]
+        tab.create_index("MicrographName", persist=True)
+        tab.create_index("DefocusU", persist=True)
+        tab.create_index("DefocusV")
+        self.cache.store(self.starfile, tabs)
+        loaded = self.cache.load(self.starfile)["data_micrographs"]
+        self.assertEqual(sorted(loaded._indexes), ["DefocusU", "MicrographName"])
+        name = tab.to_df()["MicrographName"][11]
+        found = loaded.lookup("MicrographName", name)
+        self.assertTrue(found.equals(tab.lookup("MicrographName", name)))
+        found = loaded.lookup_range("DefocusU", 10000, 12000)
+        self.assertTrue(found.equals(tab.lookup_range("DefocusU", 10000, 12000)))
+        columns = {"data_micrographs": ["DefocusU"]}
+        loaded = self.cache.load(self.starfile, columns=columns)["data_micrographs"]
+        self.assertEqual(list(loaded._indexes), ["DefocusU"])
+
+    def test_changed_file_invalidates(self):
+        StarParser(self.starfile, create=False).parse(cache=self.cache)
+        with open(self.starfile, "a") as f:
+            f.write("\n")
+        self.assertIsNone(self.cache.load(self.starfile))
+        self.assertEqual(self.cache.entries(), [])
+
+    def test_evict_least_recently_used(self):
+        StarParser(self.starfile, create=False).parse(cache=self.cache)
+        StarParser(self.model, create=False).parse(cache=self.cache)
+        self.cache.max_bytes = self.cache.size() - 1
+        self.cache.load(self.starfile)  # the model is now least recently used
+        os.utime(self.cache._entry(self.model) / "meta.json", (0, 0))
+        self.cache._evict()
+        self.assertEqual(self.cache.entries(), [self.cache._entry(self.starfile)])
+
+    def test_clear_and_invalidate(self):
+        StarParser(self.starfile, create=False).parse(cache=self.cache)
+        StarParser(self.model, create=False).parse(cache=self.cache)
+        self.cache.invalidate(self.model)
+        self.assertEqual(self.cache.entries(), [self.cache._entry(self.starfile)])
+        self.cache.clear()
+        self.assertEqual(self.cache.entries(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
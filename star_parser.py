@@ -1,15 +1,1132 @@
+import copy
+import csv
+import glob
+import gzip
+import io
+import lzma
+import mmap
+import os
 import re
+import shutil
 import sys
+import tempfile
+import weakref
 
+import cs_parser
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
 import pandas as pd
 
 from pathlib import Path
 
+try:
+    import zstandard
+except ImportError:  # only needed for .zst files
+    zstandard = None
+
+# a loop ends at the first comment, new table, loop or label line; empty lines
+# are left to the C reader, which skips them
+_LOOP_END = re.compile(rb"\n[ \t\r]*(?:#|data_|loop_|_)")
+_CHUNK_SIZE = 1 << 22
+_RANGE_MIN = 1 << 20  # bytes of a loop per worker below which it is read serially
+_RANGE_MAX = 1 << 28  # largest byte range read by one worker at a time
+_WRITE_ROWS = 1 << 16  # rows formatted at a time by StarTab.write
+_DISK_ROWS = 1 << 18  # rows of a StarTabDisk read or changed at a time
+_JOIN_ROWS = 1 << 22  # rows indexed at a time by StarTabDisk.join
+_SORT_ROWS = 1 << 20  # rows sorted in memory at a time by sort_chunks
+_BLOOM_KEYS = 1 << 22  # KeySets larger than this have a Bloom filter by default
+_BLOOM_BITS = 10  # bits of the Bloom filter of a KeySet per key
+_BLOOM_PROBES = 4  # bits tested per value, about 1% false positives
+_FIELD_WIDTH = 12  # RELION right-aligns every value in a field this wide
+_QUADS = np.frombuffer(b"".join(b"%04d" % i for i in range(10000)), dtype=np.uint32)
+_POWERS = 10 ** np.arange(19, dtype=np.int64)
+# compressed star files are recognised by their first bytes, or their suffix
+# when they are written
+_MAGIC = {b"\x1f\x8b": "gzip", b"\xfd7zXZ\x00": "xz", b"(\xb5/\xfd": "zstd"}
+_SUFFIXES = {".gz": "gzip", ".xz": "xz", ".zst": "zstd"}
+
+# value types of the RELION labels (without _rln), so that numbers are stored as
+# numbers. Labels that are not listed are kept as strings, see register_label_type
+_INT_LABELS = [
+    "BeamTiltClass",
+    "ClassNumber",
+    "CtfDataAreCtfPremultiplied",
+    "CtfDataArePhaseFlipped",
+    "CurrentImageSize",
+    "DataDimensionality",
+    "FourierSpaceInterpolator",
+    "GroupNumber",
+    "HelicalTubeID",
+    "ImageDimensionality",
+    "ImageSize",
+    "IsHelix",
+    "MicrographFrameNumber",
+    "MicrographId",
+    "MinRadiusNnInterpolation",
+    "NrBodies",
+    "NrClasses",
+    "NrGroups",
+    "NrOfFrames",
+    "NrOfSignificantSamples",
+    "NrOpticsGroups",
+    "OpticsGroup",
+    "OrientationalPriorMode",
+    "OriginalImageSize",
+    "RandomSubset",
+    "ReferenceDimensionality",
+    "SpectralIndex",
+]
+_FLOAT_LABELS = [
+    "AccuracyRotations",
+    "AccuracyTranslations",
+    "AccuracyTranslationsAngst",
+    "AmplitudeContrast",
+    "AngleDirectionalSampling",
+    "AnglePsi",
+    "AnglePsiFlipRatio",
+    "AnglePsiPrior",
+    "AngleRot",
+    "AngleRotPrior",
+    "AngleTilt",
+    "AngleTiltPrior",
+    "AngstromResolution",
+    "AutopickFigureOfMerit",
+    "AveragePmax",
+    "BeamTiltX",
+    "BeamTiltY",
+    "ClassDistribution",
+    "ClassPriorOffsetX",
+    "ClassPriorOffsetY",
+    "CoordinateX",
+    "CoordinateY",
+    "CoordinateZ",
+    "CtfAstigmatism",
+    "CtfBfactor",
+    "CtfFigureOfMerit",
+    "CtfMaxResolution",
+    "CtfScalefactor",
+    "CtfValue",
+    "CurrentResolution",
+    "DefocusAngle",
+    "DefocusU",
+    "DefocusV",
+    "DetectorPixelSize",
+    "EstimatedResolution",
+    "FourierCompleteness",
+    "GoldStandardFsc",
+    "ImagePixelSize",
+    "LogLikeliContribution",
+    "LogLikelihood",
+    "Magnification",
+    "MaxValueProbDistribution",
+    "MicrographOriginalPixelSize",
+    "MicrographPixelSize",
+    "MicrographPreExposure",
+    "MicrographDoseRate",
+    "NormCorrection",
+    "NormCorrectionAverage",
+    "OriginX",
+    "OriginXAngst",
+    "OriginXPrior",
+    "OriginXPriorAngst",
+    "OriginY",
+    "OriginYAngst",
+    "OriginYPrior",
+    "OriginYPriorAngst",
+    "OriginZ",
+    "OriginZAngst",
+    "OverallFourierCompleteness",
+    "PaddingFactor",
+    "PhaseShift",
+    "PixelSize",
+    "ReferenceSigma2",
+    "ReferenceSpectralPower",
+    "ReferenceTau2",
+    "Resolution",
+    "ResolutionInversePixel",
+    "SigmaOffsets",
+    "SigmaOffsetsAngst",
+    "SigmaPriorPsiAngle",
+    "SigmaPriorRotAngle",
+    "SigmaPriorTiltAngle",
+    "SphericalAberration",
+    "SsnrMap",
+    "Tau2FudgeFactor",
+    "Voltage",
+]
+# paths and names repeated over many rows, stored as codes into their unique values.
+# ImageName is not one of them: the image index makes it unique for each particle
+_CATEGORY_LABELS = [
+    "CtfImage",
+    "CtfPowerSpectrum",
+    "MicrographDefectFile",
+    "MicrographGainName",
+    "MicrographMetadata",
+    "MicrographMovieName",
+    "MicrographName",
+    "MtfFileName",
+    "OpticsGroupName",
+    "ReferenceImage",
+]
+label_types = {
+    **{label: "int32" for label in _INT_LABELS},
+    **{label: "float64" for label in _FLOAT_LABELS},
+    **{label: "category" for label in _CATEGORY_LABELS},
+}
+
+
+def register_label_type(label, dtype):
+    """
+    Sets the type used to store a label, e.g. for labels unknown to this module.
+    dtype can be any numpy type, "category" for strings with few distinct values,
+    or object to keep the values as plain strings.
+    """
+    label_types[label.split()[0].replace("_rln", "", 1)] = dtype
+
+
+def _column_dtypes(columns, dtypes=None):
+    # types from label_types, overridden by dtypes, for the columns of a table
+    types = {**label_types, **(dtypes or {})}
+    return {c: pd.api.types.pandas_dtype(types.get(c, object)) for c in columns}
+
+
+def _is_categorical(dtype):
+    return isinstance(dtype, pd.CategoricalDtype)
+
+
+def _convert_column(series, dtype):
+    # used when the C reader could not read the column as the expected type
+    if dtype == object:
+        return series
+    if _is_categorical(dtype):
+        return series.astype(dtype)
+    try:
+        numbers = pd.to_numeric(series)
+        if dtype.kind in "iu" and not (numbers % 1 == 0).all():
+            return series
+        return numbers.astype(dtype)
+    except (ValueError, TypeError):
+        return series
+
+
+def _filled_column(label, value, length):
+    # a column of length times value, with the type of label when it has one
+    dtype = pd.api.types.pandas_dtype(label_types.get(label, object))
+    if _is_categorical(dtype):
+        codes = np.zeros(length, dtype=np.int8)
+        return pd.Categorical.from_codes(codes, categories=[str(value)])
+    if dtype != object:
+        try:
+            return dtype.type(value)
+        except (TypeError, ValueError):
+            pass
+    return str(value)
+
+
+def _format_column(series):
+    """
+    Text of a column as RELION writes it: doubles with 6 decimals, in
+    scientific notation below 0.001 and above 100000
+    """
+    if _is_categorical(series.dtype):
+        # each distinct value is formatted once, missing values (-1) as nan
+        categories = _format_column(pd.Series(series.cat.categories))
+        categories = np.array(categories + ["nan"], dtype=object)
+        return categories[series.cat.codes.to_numpy()].tolist()
+    values = series.to_numpy()
+    if values.dtype.kind == "f":
+        text = np.char.mod("%.6f", values).astype(object)
+        magnitude = np.abs(values)
+        scientific = ((magnitude > 0) & (magnitude < 0.001)) | (magnitude > 100000)
+        if scientific.any():
+            text[scientific] = np.char.mod("%.6e", values[scientific])
+        return text.tolist()
+    return series.astype(str).tolist()
+
+
+def _text_fields(texts, width=_FIELD_WIDTH):
+    """
+    Byte matrix with one row per text, right-aligned in a field of at least
+    width characters.
+    """
+    try:
+        encoded = np.array(texts, dtype=bytes)
+    except UnicodeEncodeError:  # not ascii
+        encoded = np.array([text.encode() for text in texts], dtype=bytes)
+    width = max(width, encoded.dtype.itemsize)
+    fields = np.char.rjust(encoded, width).astype(f"S{width}")
+    return fields.view(np.uint8).reshape(len(texts), width)
+
+
+def _digits(values, count):
+    """
+    Byte matrix with the last count decimal digits of values (non-negative
+    int64), zero-padded. Digits are looked up four at a time.
+    """
+    groups = -(-count // 4)
+    digits = np.empty((len(values), groups), dtype=np.uint32)
+    for group in range(groups - 1, -1, -1):
+        rest = values // 10000
+        digits[:, group] = _QUADS[values - rest * 10000]
+        values = rest
+    return digits.view(np.uint8)[:, 4 * groups - count :]
+
+
+def _number_fields(values, negative, width, decimals=0):
+    """
+    Byte matrix of right-aligned numbers from their magnitudes, scaled to
+    integers by 10**decimals.
+    """
+    fields = np.full((len(values), width), 32, dtype=np.uint8)
+    lengths = np.searchsorted(_POWERS, values, side="right")
+    lengths = np.maximum(lengths, decimals + 1)  # at least one whole digit
+    count = int(lengths.max()) if len(values) else decimals + 1
+    digits = _digits(values, count)
+    stop = width
+    if decimals:
+        fields[:, width - decimals :] = digits[:, count - decimals :]
+        fields[:, width - decimals - 1] = 46
+        stop = width - decimals - 1
+    # blank the leading zeros and put the sign before the first digit
+    zeros = np.arange(count - decimals) < (count - lengths)[:, None]
+    fields[:, stop - count + decimals : stop] = np.where(
+        zeros, 32, digits[:, : count - decimals]
+    )
+    rows = np.nonzero(negative)[0]
+    fields[rows, stop - lengths[rows] + decimals - 1] = 45
+    return fields
+
+
+def _int_fields(values):
+    values = values.astype(np.int64)
+    negative = values < 0
+    magnitude = np.abs(values)
+    digits = len(str(magnitude.max())) if len(values) else 1
+    width = max(_FIELD_WIDTH, digits + negative.any())
+    return _number_fields(magnitude, negative, width)
+
+
+def _float_fields(values):
+    """
+    Fields of doubles as RELION writes them, %12.6f or %12.6e below 0.001 and
+    above 100000. Fixed point values are made from their digits as integers,
+    the others (and the rare values whose rounding is ambiguous that way) by
+    Python.
+    """
+    values = values.astype(np.float64)
+    magnitude = np.abs(values)
+    with np.errstate(invalid="ignore"):
+        scaled = magnitude * 1e6
+        slow = ~np.isfinite(values)
+        slow |= ((magnitude > 0) & (magnitude < 0.001)) | (magnitude > 100000)
+        slow |= np.abs(scaled - np.floor(scaled) - 0.5) < 1e-4
+    scaled = np.rint(np.where(slow, 0, scaled)).astype(np.int64)
+    negative = np.signbit(values) & ~slow
+    texts = _format_column(pd.Series(values[slow]))
+    digits = len(str(scaled.max())) if len(values) else 1
+    width = max(digits, 7) + 1 + negative.any()  # at least 0.dddddd
+    width = max([_FIELD_WIDTH, width] + [len(text) for text in texts])
+    fields = _number_fields(scaled, negative, width, decimals=6)
+    if texts:
+        fields[slow] = _text_fields(texts, width)
+    return fields
+
+
+def _field_formatter(series):
+    """
+    Returns a function that turns a slice of series into a byte matrix, one
+    right-aligned field per row. Categories are formatted once for all slices.
+    """
+    if _is_categorical(series.dtype):
+        texts = _format_column(pd.Series(series.cat.categories)) + ["nan"]
+        fields = _text_fields(texts)
+        return lambda chunk: fields[chunk.cat.codes.to_numpy()]
+    dtype = series.dtype
+    if dtype.kind == "i" or (dtype.kind == "u" and dtype.itemsize < 8):
+        return lambda chunk: _int_fields(chunk.to_numpy())
+    if dtype.kind == "f":
+        return lambda chunk: _float_fields(chunk.to_numpy())
+    return lambda chunk: _text_fields(_format_column(chunk))
+
+
+def _format_rows(chunk, formatters):
+    """
+    Text of the rows of chunk, as a flat byte array, one line per row with a
+    space after each field like RELION writes them, and the length of each
+    line. Fields are as wide as the widest value of the chunk, then each value
+    keeps only _FIELD_WIDTH or its own length.
+    """
+    fields = [formatter(chunk.iloc[:, i]) for i, formatter in enumerate(formatters)]
+    width = sum(f.shape[1] + 1 for f in fields) + 1
+    rows = np.full((len(chunk), width), 32, dtype=np.uint8)
+    keep = None
+    offset = 0
+    for f in fields:
+        field_width = f.shape[1]
+        rows[:, offset : offset + field_width] = f
+        if field_width > _FIELD_WIDTH:
+            padding = np.argmax(f != 32, axis=1)
+            drop = np.minimum(padding, field_width - _FIELD_WIDTH)
+            if drop.any():
+                if keep is None:
+                    keep = np.ones(rows.shape, dtype=bool)
+                keep[:, offset : offset + field_width] = (
+                    np.arange(field_width) >= drop[:, None]
+                )
+        offset += field_width + 1
+    rows[:, -1] = 10
+    if keep is not None:
+        return rows[keep], keep.sum(axis=1)
+    return rows.reshape(-1), np.full(len(rows), width)
+
+
+def _formatters(df):
+    return [_field_formatter(df.iloc[:, i]) for i in range(df.shape[1])]
+
+
+def _runs(rows):
+    """
+    Splits rows, the row of the file for each row of a table (-1 if changed),
+    into (first, last, row of the file or -1) runs of rows that follow each
+    other in the file or changed. None if no row is copied, or if there are too
+    many runs to be worth it.
+    """
+    copied = rows >= 0
+    if not copied.any():
+        return None
+    breaks = copied[1:] != copied[:-1]
+    breaks |= copied[1:] & (rows[1:] != rows[:-1] + 1)
+    bounds = np.concatenate([[0], np.flatnonzero(breaks) + 1, [len(rows)]])
+    if len(bounds) > len(rows) // 8 + 64:
+        return None
+    return [
+        (first, last, rows[first] if copied[first] else -1)
+        for first, last in zip(bounds[:-1], bounds[1:])
+        if first < last
+    ]
+
+
+def _changed_lines(df, runs):
+    """
+    Yields the text of each run of changed rows (-1) of runs, from _runs. The
+    changed rows of df are formatted together, _WRITE_ROWS at a time.
+    """
+    changed = [(first, last) for first, last, row in runs if row < 0]
+    rows = np.concatenate([np.arange(first, last) for first, last in changed])
+    formatters = _formatters(df)
+    text, bounds, done = None, [0], 0  # lines of the last chunk, and those used
+    for first, last in changed:
+        pieces, count = [], last - first
+        while count:
+            if done == len(bounds) - 1:
+                chunk, rows = rows[:_WRITE_ROWS], rows[_WRITE_ROWS:]
+                text, lengths = _format_rows(df.iloc[chunk], formatters)
+                bounds, done = np.concatenate([[0], np.cumsum(lengths)]), 0
+            taken = min(count, len(bounds) - 1 - done)
+            pieces.append(text[bounds[done] : bounds[done + taken]])
+            done, count = done + taken, count - taken
+        yield b"".join(pieces)
+
+
+def _write_rows(handle, frames, formatters=None, trailer=True):
+    # formatters are made for each frame if not given
+    for df in frames:
+        columns = _formatters(df) if formatters is None else formatters
+        for start in range(0, len(df), _WRITE_ROWS):
+            text, _ = _format_rows(df.iloc[start : start + _WRITE_ROWS], columns)
+            handle.write(text)
+    if trailer:
+        handle.write(b"\n\n\n")
+
+
+def _map_distinct(series, function):
+    """
+    Applies function to the text of each distinct value of series once, and maps
+    the results back to the rows through the codes of the values. Categorical
+    columns stay categorical, other columns become strings.
+    """
+    if _is_categorical(series.dtype):
+        codes = series.cat.codes.to_numpy()
+        distinct = series.cat.categories
+    else:
+        codes, distinct = pd.factorize(series)
+    new_values = [function(value) for value in _format_column(pd.Series(distinct))]
+    remap, new_distinct = pd.factorize(np.array(new_values, dtype=object))
+    new_codes = np.where(codes >= 0, remap[codes], -1)
+    mapped = pd.Categorical.from_codes(new_codes, categories=new_distinct)
+    if _is_categorical(series.dtype):
+        return pd.Series(mapped, index=series.index, name=series.name)
+    return pd.Series(np.asarray(mapped), index=series.index, name=series.name)
+
+
+def _copy_on_write():
+    # always on from pandas 3, opt-in through pd.options.mode in pandas 2
+    if int(pd.__version__.split(".")[0]) >= 3:
+        return True
+    return getattr(pd.options.mode, "copy_on_write", False) is True
+
+
+def _preview(df, replaced=()):
+    """
+    Copy of df for operations that are not stored, one block per column. With
+    copy-on-write (pandas 3) it shares all columns with df. Without it, writes
+    into the preview would reach df, so only the columns in replaced, which the
+    operation replaces with _set_column, are shared and the others are copied.
+    """
+    shared = _copy_on_write()
+    columns = {
+        c: values if shared or c in replaced else values.copy()
+        for c, values in df.items()
+    }
+    return pd.DataFrame(columns, index=df.index, columns=df.columns, copy=False)
+
+
+def _set_column(df, column, values):
+    # column of df replaced by values, without writing into the old values
+    if column in df.columns:
+        position = df.columns.get_loc(column)
+        del df[column]
+        df.insert(position, column, values)
+    else:
+        df[column] = values
+
 
 class Hell(BaseException):
     pass
 
 
+def _compression(star, mode="rb"):
+    if mode.startswith("r"):
+        try:
+            with open(star, "rb") as f:
+                start = f.read(6)
+        except OSError:
+            return None
+        return next((c for m, c in _MAGIC.items() if start.startswith(m)), None)
+    return _SUFFIXES.get(Path(star).suffix)
+
+
+def _open_star(star, mode="rb"):
+    """
+    Opens a star file for binary reading or writing, decompressed or compressed
+    on the fly with gzip, xz or zstd. zstd needs the zstandard package, and
+    compresses on all cores.
+    """
+    compression = _compression(star, mode)
+    if compression == "gzip":
+        return gzip.open(star, mode, compresslevel=6)
+    if compression == "xz":
+        return lzma.open(star, mode)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError(f"The zstandard package is needed for {star}")
+        if mode.startswith("r"):
+            return _ZstdReader(star)
+        compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+        return compressor.stream_writer(open(star, "wb"))
+    return open(star, mode)
+
+
+def _replace_file(destination, write):
+    """
+    Calls write with a handle to a temporary file next to destination, opened
+    with _open_star, which then replaces destination: readers see either the
+    old or the whole new file. A symbolic link is followed, and the file it
+    points to is replaced.
+    """
+    name, destination = destination.name, Path(destination).resolve()
+    handle, temporary = tempfile.mkstemp(
+        dir=destination.parent, prefix=".", suffix=f"-{name}"
+    )
+    os.close(handle)
+    try:
+        if destination.exists():
+            shutil.copymode(destination, temporary)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temporary, 0o666 & ~umask)
+        with _open_star(temporary, "wb") as f:
+            write(f)
+        os.replace(temporary, destination)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def _write_over_end(path, offset, data):
+    """
+    Writes data at offset of path, where only blank lines follow, and the
+    blank lines after it. The bytes before offset are not written to, and if
+    the write fails (e.g. the disk is full), path is cut back to offset.
+    """
+    with open(path, "r+b", buffering=0) as f:  # nothing left to flush later
+        f.seek(offset)
+        data = memoryview(data + f.read())
+        f.seek(offset)
+        try:
+            while data:
+                data = data[f.write(data) :]
+            os.fsync(f.fileno())
+        except BaseException:
+            f.truncate(offset)
+            raise
+
+
+def _data_end(handle, start, end):
+    """
+    Offset after the last line between start and end of handle that is not
+    blank, read backwards from end
+    """
+    position = end
+    while position > start:
+        size = min(1 << 16, position - start)
+        handle.seek(position - size)
+        data = handle.read(size)
+        text = data.rstrip()
+        if text:
+            newline = data.find(b"\n", len(text))
+            return position - size + (len(text) if newline < 0 else newline + 1)
+        position -= size
+    return start
+
+
+def _file_key(star):
+    # changes whenever the file is written or replaced
+    stat = os.stat(star)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _line_offsets(source, start, end):
+    """
+    Offsets of the start and end (after the newline) of each line that is not
+    blank between start and end of source, a buffer. Read _CHUNK_SIZE bytes at
+    a time.
+    """
+    starts, ends = [], []
+    line_start, filled = start, False  # filled: the open line has a value
+    for offset in range(start, end, _CHUNK_SIZE):
+        data = np.frombuffer(source, np.uint8, min(_CHUNK_SIZE, end - offset), offset)
+        newlines = np.flatnonzero(data == 10)
+        if len(newlines):
+            last = newlines[-1] + 1
+            # whether each line up to its newline has a byte that is not white space
+            firsts = np.concatenate([[0], newlines[:-1] + 1])
+            keep = np.logical_or.reduceat(data[:last] > 32, firsts)
+            keep[0] |= filled
+            line_starts = np.concatenate([[line_start], offset + firsts[1:]])
+            starts.append(line_starts[keep])
+            ends.append(offset + newlines[keep] + 1)
+            line_start = offset + last
+            filled = bool((data[last:] > 32).any())
+        else:
+            filled |= bool((data > 32).any())
+    if filled:  # last line without newline
+        starts.append([line_start])
+        ends.append([end])
+    if not starts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(starts).astype(np.int64), np.concatenate(ends).astype(np.int64)
+
+
+class _ZstdReader(io.RawIOBase):
+    """
+    Decompressed view of a zstd file. Seeking back starts decompressing again
+    from the start, as gzip and lzma files do.
+    """
+
+    def __init__(self, star):
+        self.name = str(star)
+        self._start()
+
+    def _start(self):
+        self._file = open(self.name, "rb")
+        decompressor = zstandard.ZstdDecompressor()
+        self._reader = decompressor.stream_reader(self._file, read_across_frames=True)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self._reader.readinto(buffer)
+        self._position += size
+        return size
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("zstd files only seek from the start")
+        if offset < self._position:
+            self._reader.close()
+            self._start()
+        while self._position < offset:
+            if not self.read(min(offset - self._position, _CHUNK_SIZE)):
+                break
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._reader.close()
+            self._file.close()
+        super().close()
+
+
+class _StarStream:
+    """
+    Buffered reader over a binary star file. Header lines are read one at a time,
+    while the data lines of a loop are handed out in large blocks, so that the
+    state machine only ever sees headers and labels.
+    """
+
+    def __init__(self, handle, chunk_size=_CHUNK_SIZE):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.position = 0  # next unread byte in buffer
+        self.offset = 0  # file offset of buffer[0]
+
+    def tell(self):
+        return self.offset + self.position
+
+    def _fill(self):
+        chunk = self.handle.read(self.chunk_size)
+        if not chunk:
+            return False
+        # keep the last newline read, loop ends are matched starting from it
+        keep = max(self.position - 1, 0)
+        self.buffer = self.buffer[keep:] + chunk
+        self.offset += keep
+        self.position -= keep
+        return True
+
+    def readline(self):
+        while True:
+            end = self.buffer.find(b"\n", self.position)
+            if end != -1:
+                line = self.buffer[self.position : end + 1]
+                self.position = end + 1
+                return line
+            if not self._fill():
+                line = self.buffer[self.position :]
+                self.position = len(self.buffer)
+                return line
+
+    def rewind(self, line):
+        # only valid for the line just returned by readline
+        self.position -= len(line)
+
+    def seek(self, offset):
+        if self.offset <= offset <= self.offset + len(self.buffer):
+            # still in the buffer, which spares compressed files a seek back
+            self.position = offset - self.offset
+            return
+        self.handle.seek(offset)
+        self.buffer = b""
+        self.position = 0
+        self.offset = offset
+
+    def iter_loop(self):
+        """
+        Yields the data lines of the loop starting at the current position in
+        blocks of whole lines, and stops at the first line that is not data.
+        The stream is left at the start of that line.
+        """
+        while True:
+            limit = self.buffer.rfind(b"\n", self.position)
+            if limit != -1:
+                start = max(self.position - 1, 0)
+                match = _LOOP_END.search(self.buffer, start, limit + 1)
+                end = match.start() + 1 if match else limit + 1
+                block = self.buffer[self.position : end]
+                self.position = end
+                if block:
+                    yield block
+                if match:
+                    return
+            if not self._fill():
+                break
+        # last line of the file, without newline
+        tail = self.buffer[self.position :]
+        if tail.strip() and not _LOOP_END.match(b"\n" + tail + b"\n"):
+            self.position = len(self.buffer)
+            yield tail + b"\n"
+
+
+class StarBlock:
+    """
+    Position of one table in a star file: name, version and header lines, plus
+    the byte offsets of the table start (including its version line), of the first
+    data line (None for tables without data) and of the end of the table.
+    """
+
+    def __init__(self, name, version, start):
+        self.name = name
+        self.version = version
+        self.header = []
+        self.start = start
+        self.data_start = None
+        self.end = None
+
+    def __repr__(self):
+        return (
+            f"StarBlock {self.name} with {len(self.header)} header line(s) "
+            f"at bytes {self.start}-{self.end}"
+        )
+
+    def label_tab(self):
+        # a loop table with only the labels of the header, to resolve columns
+        tab = StarTab(self.name)
+        for line in self.header:
+            tab.read_label_line(line)
+        return tab
+
+
+class _LoopReader(io.RawIOBase):
+    """
+    File-like view of the blocks yielded by _StarStream.iter_loop, to be handed
+    to the pandas C reader.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.pending):
+            block = next(self.blocks, None)
+            if block is None:
+                return 0
+            self.pending = memoryview(block)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def _read_csv(handle, names, usecols, types, chunksize=None):
+    return pd.read_csv(
+        handle,
+        sep=r"\s+",
+        header=None,
+        names=names,
+        usecols=usecols,
+        index_col=False,
+        dtype=types,
+        na_filter=False,
+        quoting=csv.QUOTE_NONE,
+        engine="c",
+        chunksize=chunksize,
+    )
+
+
+def _where_by_table(where):
+    # where of StarParser.parse as dictionaries of predicates by table name
+    return bool(where) and all(isinstance(p, dict) for p in where.values())
+
+
+def _predicate(accepted):
+    # function of a column that is True for the rows to keep
+    if callable(accepted):
+        return accepted
+    if isinstance(accepted, (set, frozenset, list, tuple)):
+        accepted = pd.Index(list(accepted))
+        return lambda values: values.isin(accepted)
+    return lambda values: values == accepted
+
+
+def _loop_chunks(lines, names, usecols, types, chunksize, where=None, convert=None):
+    """
+    Reads a loop chunksize rows at a time and yields each chunk with the columns
+    of usecols, and only the rows that match all predicates of where (column:
+    function). If values are read as strings, convert has the types that the
+    predicates see them as. Categories of rejected rows are dropped with them.
+    """
+    read = usecols
+    if where and usecols is not None:
+        read = [c for c in names if c in usecols or c in where]
+    for chunk in _read_csv(lines, names, read, types, chunksize):
+        if where:
+            typed = chunk
+            if convert is not None:
+                typed = {c: _convert_column(chunk[c], convert[c]) for c in where}
+            mask = np.ones(len(chunk), dtype=bool)
+            for column, predicate in where.items():
+                mask &= np.asarray(predicate(typed[column]), dtype=bool)
+            if not mask.all():
+                chunk = chunk[mask]
+                chunk = chunk.assign(
+                    **{
+                        c: chunk[c].cat.remove_unused_categories()
+                        for c in chunk.columns
+                        if _is_categorical(chunk[c].dtype)
+                    }
+                )
+            if read is not usecols:
+                chunk = chunk[[c for c in chunk.columns if c in usecols]]
+        yield chunk
+
+
+def _split_range(star, start, end, workers):
+    """
+    Splits the bytes from start to end of star into about equal ranges that
+    begin and end at line boundaries, at least workers of them if the data
+    are large enough.
+    """
+    size = end - start
+    count = max(min(workers, size // _RANGE_MIN), -(-size // _RANGE_MAX))
+    bounds = [start]
+    with open(star, "rb") as f:
+        for index in range(1, count):
+            f.seek(start + (end - start) * index // count)
+            f.readline()
+            if bounds[-1] < f.tell() < end:
+                bounds.append(f.tell())
+    bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _share_frame(df):
+    """
+    Moves the columns of df to shared memory, for _shared_frame in another
+    process. Strings are sent as their distinct values and codes.
+    """
+    columns = []
+    for name in df.columns:
+        column = df[name]
+        distinct = None
+        if _is_categorical(column.dtype):
+            values = column.cat.codes.to_numpy()
+            distinct = column.cat.categories
+        elif isinstance(column.dtype, np.dtype) and column.dtype.kind in "biuf":
+            values = column.to_numpy()
+        else:
+            values, distinct = pd.factorize(column)
+            distinct = distinct.to_numpy(dtype=object)
+        memory = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, values.dtype, memory.buf)[:] = values
+        # the parent process unlinks the memory once it has copied it
+        resource_tracker.unregister(memory._name, "shared_memory")
+        memory.close()
+        kind = "category" if _is_categorical(column.dtype) else None
+        columns.append((name, memory.name, values.dtype.str, len(values), distinct, kind))
+    return columns
+
+
+def _shared_frame(columns, blocks):
+    # dataframe of _share_frame, its shared memory blocks are added to blocks
+    data = {}
+    for name, memory_name, dtype, length, distinct, kind in columns:
+        memory = shared_memory.SharedMemory(name=memory_name)
+        blocks.append(memory)
+        values = np.ndarray(length, np.dtype(dtype), memory.buf)
+        if kind == "category":
+            data[name] = pd.Categorical.from_codes(values, categories=distinct)
+        elif distinct is not None:
+            data[name] = pd.Series(np.append(distinct, None)[values], dtype=object)
+        else:
+            data[name] = values
+    return pd.DataFrame(data, columns=[c[0] for c in columns], copy=False)
+
+
+def _read_range(star, start, stop, names, usecols, types):
+    # runs in the worker processes of _read_ranges
+    with open(star, "rb") as f:
+        f.seek(start)
+        lines = io.BytesIO(f.read(stop - start))
+    try:
+        df = _read_csv(lines, names, usecols, types)
+    except ValueError:  # the serial reader deals with values of the wrong type
+        return None
+    return _share_frame(df)
+
+
+def _read_ranges(star, ranges, names, usecols, types, workers):
+    """
+    Reads the data lines in the byte ranges of star in a pool of workers
+    processes and stitches them into one dataframe. Returns None if some values
+    do not match their label type.
+    """
+    jobs = [(star, start, stop, names, usecols, types) for start, stop in ranges]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        shared = list(pool.map(_read_range, *zip(*jobs)))
+    frames, blocks = [], []
+    try:
+        for columns in shared:
+            if columns is not None:
+                frames.append(_shared_frame(columns, blocks))
+        if len(frames) < len(shared):
+            return None
+        return _concat_frames(frames)
+    finally:
+        frames.clear()  # no views on the memory may be left when it is closed
+        for memory in blocks:
+            memory.close()
+            memory.unlink()
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _disk_dtype(dtype):
+    # how a column is kept on disk: numbers as they are, categories as codes,
+    # everything else as text
+    if _is_categorical(dtype):
+        return pd.CategoricalDtype()
+    if isinstance(dtype, np.dtype) and dtype.kind in "biuf":
+        return dtype
+    return np.dtype(object)
+
+
+class _DiskColumn:
+    """
+    Values of one column of a StarTabDisk in files mapped into memory: numbers
+    as an array, categories as int32 codes, and text as newline separated values
+    with the offset of each row and a byte that marks missing rows. A column is
+    filled with append, then finish maps it; it never changes after that, so
+    tables can share it. The files are removed when the column is no longer used.
+    """
+
+    def __init__(self, directory, dtype):
+        self.dtype = _disk_dtype(dtype)
+        self.length = 0
+        self._files = []
+        self._handles = [self._new_file(directory)]
+        if _is_categorical(self.dtype):
+            self._categories = {}
+        elif self.dtype == object:
+            self._handles.append(self._new_file(directory))
+            self._handles[1].write(np.zeros(1, dtype=np.int64).tobytes())
+            self._handles.append(self._new_file(directory))  # missing rows
+            self._end = 0
+        weakref.finalize(self, _remove_files, self._files)
+
+    @classmethod
+    def from_chunks(cls, directory, chunks):
+        # a finished column from an iterable of series, typed as the first one
+        column = None
+        for chunk in chunks:
+            if column is None:
+                column = cls(directory, chunk.dtype)
+            column.append(chunk)
+        return column.finish()
+
+    def _new_file(self, directory):
+        handle = tempfile.NamedTemporaryFile(
+            dir=directory, prefix="star_", suffix=".col", delete=False
+        )
+        self._files.append(handle.name)
+        return handle
+
+    def append(self, series):
+        if _is_categorical(self.dtype):
+            if not _is_categorical(series.dtype):
+                series = series.astype(str).astype("category")
+            # codes of the chunk to codes of the categories of the whole column
+            categories = series.cat.categories.tolist()
+            known = self._categories
+            lookup = [known.setdefault(c, len(known)) for c in categories] + [-1]
+            lookup = np.array(lookup, dtype=np.int32)
+            values = lookup[series.cat.codes.to_numpy()].tobytes()
+        elif self.dtype == object:
+            missing = series.isna().to_numpy()
+            texts = _format_column(series)
+            if missing.any():
+                texts = ["" if m else text for text, m in zip(texts, missing)]
+            values = "".join(text + "\n" for text in texts).encode()
+            lengths = np.fromiter(map(len, texts), np.int64, len(texts)) + 1
+            if lengths.sum() != len(values):  # not ascii
+                lengths = [len(text.encode()) + 1 for text in texts]
+            offsets = self._end + np.cumsum(lengths, dtype=np.int64)
+            self._end += len(values)
+            self._handles[1].write(offsets.tobytes())
+            self._handles[2].write(missing.astype(np.uint8).tobytes())
+        else:
+            values = series.to_numpy(self.dtype).tobytes()
+        self._handles[0].write(values)
+        self.length += len(series)
+
+    def finish(self):
+        for handle in self._handles:
+            handle.close()
+        if _is_categorical(self.dtype):
+            self.dtype = pd.CategoricalDtype(list(self._categories))
+            self._values = self._map(self._files[0], np.int32, self.length)
+        elif self.dtype == object:
+            self._values = self._map(self._files[0], np.uint8, self._end)
+            self._offsets = self._map(self._files[1], np.int64, self.length + 1)
+            self._missing = self._map(self._files[2], np.bool_, self.length)
+        else:
+            self._values = self._map(self._files[0], self.dtype, self.length)
+        del self._handles
+        return self
+
+    def _map(self, path, dtype, length):
+        if not length:  # empty files can not be mapped
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(length,))
+
+    def slice(self, start, stop):
+        """
+        Values of rows start to stop, in memory
+        """
+        if _is_categorical(self.dtype):
+            return pd.Categorical.from_codes(self._values[start:stop], dtype=self.dtype)
+        if self.dtype == object:
+            offsets = self._offsets[start : stop + 1]
+            text = self._values[offsets[0] : offsets[-1]].tobytes().decode()
+            values = np.array(text.split("\n")[:-1], dtype=object)
+            values[self._missing[start:stop]] = np.nan
+            return values
+        return np.array(self._values[start:stop])
+
+    def take(self, rows):
+        """
+        Values of rows, an array of row numbers, in memory
+        """
+        if _is_categorical(self.dtype):
+            return pd.Categorical.from_codes(self._values[rows], dtype=self.dtype)
+        if self.dtype == object:
+            starts, ends = self._offsets[rows], self._offsets[rows + 1] - 1
+            values = [
+                self._values[a:b].tobytes().decode() for a, b in zip(starts, ends)
+            ]
+            values = np.array(values, dtype=object)
+            values[self._missing[rows]] = np.nan
+            return values
+        return np.array(self._values[rows])
+
+    def converted(self, dtype, directory):
+        # the column of strings as dtype, itself if some values do not convert
+        dtype = _disk_dtype(dtype)
+        if dtype == object:
+            return self
+        column = _DiskColumn(directory, dtype)
+        for start in range(0, max(self.length, 1), _DISK_ROWS):
+            chunk = pd.Series(self.slice(start, start + _DISK_ROWS), dtype=object)
+            chunk = _convert_column(chunk, dtype)
+            if chunk.dtype == object:
+                return self
+            column.append(chunk)
+        return column.finish()
+
+
 class StarParser:
     def __init__(self, starfile, create=True):
         self.file_name = Path(starfile)
@@ -36,12 +1153,23 @@ class StarParser:
             "newtab": re.compile("^data_"),
             "version": re.compile("#\sversion\s"),
         }
-        self.blob = self.read_file(self.file_name)
+        self.blocks = {}  # StarBlock for each table, filled while scanning
+        self._scanned_to = 0  # offset up to which blocks are known
+        self._partial = False  # only some tables were parsed
+        self._source = None  # _file_key of the file when it was scanned
 
     def read_file(self, filename):
-        with open(filename, "r") as f:
+        with io.TextIOWrapper(_open_star(filename)) as f:
             return f.readlines()
 
+    def iter_file(self, filename):
+        """
+        Yields the lines of the file one at a time, so that parsing never needs
+        the whole text in memory
+        """
+        with io.TextIOWrapper(_open_star(filename)) as f:
+            yield from f
+
     def check_state(self, line, current_state):
         for possible_state in self.state_order[current_state]:
             if self.state_token[possible_state].match(line):
@@ -50,9 +1178,320 @@ class StarParser:
             f"Current state {self.state} expects to be followed by {self.state_order[current_state]}"
         )
 
-    def parse(self, file_blob=None):
-        if file_blob is None:
-            file_blob = self.blob
+    def parse(
+        self,
+        file_blob=None,
+        tabs=None,
+        columns=None,
+        typed=True,
+        dtypes=None,
+        workers=None,
+        cache=None,
+        memmap=None,
+        where=None,
+    ):
+        """
+        Parses the star file into a dictionary of tables. Data lines are read
+        a whole loop at a time; if file_blob (an iterable of lines) is given, it is
+        parsed line by line instead.
+        tabs: name or list of names of the tables to read. The others are only
+        indexed, and the scan stops as soon as all requested tables are found.
+        columns: list of the columns to keep in the loop tables read that have all
+        these columns (KeyError if none of them has), or a dictionary of such lists
+        by table name (KeyError if the table lacks a column). Other columns are
+        skipped by the reader and never stored.
+        typed: store the columns of known labels as numbers (see label_types), or
+        everything as strings if False. dtypes overrides label_types for this call.
+        workers: number of processes that read large loops in parallel, each a
+        range of lines. The file is indexed first to find where the loops end.
+        Compressed files (gzip, xz or zstd, see _open_star) are read serially.
+        cache: True or a star_cache.StarCache to load the tables from a binary
+        copy made by an earlier parse, or to make one. Only used with the label
+        types of label_types.
+        memmap: True or a directory to keep loop tables as StarTabDisk, with their
+        columns in memory-mapped files in that directory (the temporary directory
+        if True), for tables larger than memory. They are read serially.
+        where: dictionary of column: predicate to keep only matching rows of the
+        loop tables that have all these columns (KeyError if none of the tables
+        read has them), or a dictionary of such dictionaries by table name
+        (KeyError if the table lacks a column). A predicate is a function of a
+        column that returns True for the rows to keep (e.g. lambda values: values
+        < 4), a set, list or tuple of accepted values, or one accepted value. Loops
+        are read in chunks that are filtered as they are read, serially.
+        """
+        if file_blob is not None:
+            return self.parse_lines(file_blob)
+        if cache and typed and dtypes is None and not memmap and not where:
+            return self._parse_cached(cache, tabs, columns, workers)
+        if isinstance(tabs, str):
+            tabs = [tabs]
+        self._check_source()
+        parsed = {}
+        options = {"columns": columns, "dtypes": dtypes if typed else False}
+        if memmap:
+            options["memmap"] = memmap
+        if where:
+            options["where"] = where
+        with _open_star(self.file_name) as handle:
+            stream = _StarStream(handle)
+            if workers is not None and workers > 1 and not _compression(self.file_name):
+                self.index()
+                options["workers"] = workers
+            elif tabs is None:  # fresh scan of the whole file
+                self.blocks = {}
+                self._scanned_to = 0
+            # tables that are already indexed are read directly
+            if tabs is not None or self._scanned_to is None:
+                for name in self.blocks if tabs is None else tabs:
+                    if name in self.blocks:
+                        block = self.blocks[name]
+                        parsed[name] = self._read_tab(stream, block, True, **options)
+            unread = tabs is None or len(parsed) < len(tabs)
+            if unread and self._scanned_to is not None:
+                stream.seek(self._scanned_to)
+                for block in self._iter_blocks(stream):
+                    if tabs is None or block.name in tabs:
+                        parsed[block.name] = self._read_tab(stream, block, **options)
+                        if tabs is not None and len(parsed) == len(tabs):
+                            break
+        loops = [self.blocks[n] for n in parsed if "_general" not in n]
+        if where and not _where_by_table(where):
+            # for all tables, but meant for at least one of them
+            if not any(b.label_tab()._has_columns(where) for b in loops):
+                raise KeyError(
+                    f"Columns {list(where)} of where are missing from all tables of {self.file_name}"
+                )
+        if columns is not None and not isinstance(columns, dict):
+            if not any(b.label_tab()._has_columns(columns) for b in loops):
+                raise KeyError(
+                    f"Columns {columns} are missing from all tables of {self.file_name}"
+                )
+        if tabs is None:
+            self.tabs = parsed
+            self._partial = False
+            return parsed
+        missing = [t for t in tabs if t not in parsed]
+        if missing:
+            raise KeyError(f"Tables {missing} are not in {self.file_name}")
+        known = {**getattr(self, "tabs", {}), **parsed}
+        self.tabs = {n: known[n] for n in self.blocks if n in known}
+        self._partial = (
+            len(self.tabs) < len(self.blocks) or self._scanned_to is not None
+        )
+        return {name: parsed[name] for name in tabs}
+
+    def _parse_cached(self, cache, tabs, columns, workers):
+        from star_cache import StarCache  # star_cache imports this module
+
+        if not isinstance(cache, StarCache):
+            cache = StarCache()
+        parsed = cache.load(self.file_name, tabs, columns)
+        if parsed is None:
+            cache.store(self.file_name, self.parse(workers=workers))
+            parsed = cache.load(self.file_name, tabs, columns)
+        if parsed is None:  # too large for the cache
+            return self.parse(tabs=tabs, columns=columns, workers=workers)
+        loops = [t for n, t in parsed.items() if "_general" not in n]
+        if columns is not None and not isinstance(columns, dict):
+            if not any(t._has_columns(columns) for t in loops):
+                raise KeyError(
+                    f"Columns {columns} are missing from all tables of {self.file_name}"
+                )
+        if tabs is None:
+            self.tabs = parsed
+            self._partial = False
+            return parsed
+        if isinstance(tabs, str):
+            tabs = [tabs]
+        missing = [t for t in tabs if t not in parsed]
+        if missing:
+            raise KeyError(f"Tables {missing} are not in {self.file_name}")
+        self.tabs = {**getattr(self, "tabs", {}), **parsed}
+        self._partial = True  # write_out indexes the file for the other tables
+        return {name: parsed[name] for name in tabs}
+
+    def iter_chunks(
+        self, tab, chunksize=None, columns=None, typed=True, dtypes=None, where=None
+    ):
+        """
+        Yields the rows of the loop table tab in file order, as dataframes of
+        chunksize rows (default _DISK_ROWS) indexed by row number, so that the
+        table is never in memory as a whole. columns, typed, dtypes and where as
+        for parse, each chunk keeps only the rows that match where; categories
+        are those of each chunk. StarWriter.write_chunks writes them back.
+        """
+        self._check_source()
+        with _open_star(self.file_name) as handle:
+            stream = _StarStream(handle)
+            block = self.blocks.get(tab)
+            if block is None and self._scanned_to is not None:
+                stream.seek(self._scanned_to)
+                blocks = self._iter_blocks(stream)
+                block = next((b for b in blocks if b.name == tab), None)
+            if block is None:
+                raise KeyError(f"Tables {[tab]} are not in {self.file_name}")
+            if "_general" in tab:
+                raise ValueError("General tabs contain no data - formatting error")
+            labels = block.label_tab()
+            names, usecols, types = labels._read_types(
+                columns, dtypes if typed else False
+            )
+            where = labels._resolve_where(where)  # raises for missing columns
+            if block.data_start is None:
+                return
+            chunksize = chunksize or _DISK_ROWS
+            lines = labels._lines(stream, block.data_start)
+            done = 0
+            try:
+                for chunk in _loop_chunks(
+                    lines, names, usecols, types, chunksize, where
+                ):
+                    yield chunk
+                    done += 1
+            except ValueError:
+                # as parse, strings for the columns that can not be converted,
+                # from the first chunk not yielded yet
+                lines = labels._lines(stream, block.data_start)
+                strings = {c: np.dtype(object) for c in names}
+                chunks = _loop_chunks(
+                    lines, names, usecols, strings, chunksize, where, types
+                )
+                for index, chunk in enumerate(chunks):
+                    if index < done:
+                        continue
+                    for c in chunk.columns:
+                        chunk[c] = _convert_column(chunk[c], types[c])
+                    yield chunk
+
+    def index(self):
+        """
+        Scans the whole file without parsing any data, and returns the StarBlock
+        of every table
+        """
+        self._check_source()
+        if self._scanned_to is not None:
+            with _open_star(self.file_name) as handle:
+                stream = _StarStream(handle)
+                stream.seek(self._scanned_to)
+                for block in self._iter_blocks(stream):
+                    pass
+        return self.blocks
+
+    def _check_source(self):
+        # offsets in blocks are only valid for the file they were scanned from
+        if self._scanned_to != 0 and self._source != _file_key(self.file_name):
+            self.blocks = {}
+            self._scanned_to = 0
+
+    def _iter_blocks(self, stream):
+        """
+        Reads table headers from the current position of stream and yields a
+        StarBlock for each table. For tables with data the stream is left at the
+        first data line; data that the caller does not read are skipped.
+        """
+        version, version_start = "", None
+        block = None
+        if stream.tell() == 0:
+            self._source = _file_key(self.file_name)
+        while True:
+            start = stream.tell()
+            raw = stream.readline()
+            line = raw.decode().strip()
+            state = self.check_state(line, "start") if line else None
+            if block is not None and (not raw or state in ["newtab", "version"]):
+                # header only tables end with the next table or the file
+                self._add_block(block, header_end)
+                yield block
+                block = None
+            if not raw:
+                self._scanned_to = None  # whole file indexed
+                return
+            if not line:
+                continue
+            if state == "version":
+                version, version_start = line, start
+            elif state == "newtab":
+                if version_start is None:
+                    version_start = start
+                block = StarBlock(line, version, version_start)
+                version_start = None
+                header_end = stream.tell()
+            elif line.startswith("#"):  # other comments are ignored
+                continue
+            elif block is None or block.data_start is not None:
+                raise ValueError(
+                    f"Line '{line}' at byte {start} of {self.file_name} is not in a table"
+                )
+            elif state == "labels":
+                block.header.append(line)
+                header_end = stream.tell()
+            else:  # first data line of a loop
+                stream.rewind(raw)
+                block.data_start = start
+                self.blocks[block.name] = block
+                yield block
+                if stream.tell() == start:  # not read by the caller
+                    for _ in stream.iter_loop():
+                        pass
+                self._add_block(block, stream.tell())
+                block = None
+
+    def _add_block(self, block, end):
+        block.end = end
+        self.blocks[block.name] = block
+        self._scanned_to = end
+
+    def _read_tab(
+        self,
+        stream,
+        block,
+        seek=False,
+        columns=None,
+        dtypes=None,
+        workers=None,
+        memmap=None,
+        where=None,
+    ):
+        by_table = _where_by_table(where)
+        if by_table:
+            where = where.get(block.name)
+        if "_general" in block.name:
+            tab = StarGeneralTab(block.name)
+        elif memmap:
+            tab = StarTabDisk(block.name, None if memmap is True else memmap)
+        else:
+            tab = StarTab(block.name)
+        tab.read_line(block.version, state="version")
+        for line in block.header:
+            tab.read_line(line, state="labels")
+        general = isinstance(tab, StarGeneralTab)
+        if isinstance(columns, dict):
+            columns = columns.get(block.name)
+        elif columns is not None and not general and not tab._has_columns(columns):
+            columns = None  # columns are for all tables, not for this one
+        if where and not by_table and (general or not tab._has_columns(where)):
+            where = None  # where is for all tables, not for this one
+        elif where:
+            tab._resolve_columns(list(where))  # raises for missing columns
+        if block.data_start is not None:
+            if seek:
+                stream.seek(block.data_start)
+            tab.read_block(stream, columns, dtypes, block.end, workers, where)
+            tab.close()
+        else:
+            tab.close()
+            if columns is not None and not general:
+                tab.keep_only_columns(tab._resolve_columns(columns), store=True)
+        if columns is None and not where:
+            # what the table was in the file, see _write_tabs
+            tab._origin = (self._source, block.start, tab._snapshot())
+        return tab
+
+    def parse_lines(self, file_blob):
+        """
+        Line by line parser, kept for blobs of text and as a reference for the
+        block parser in parse()
+        """
         current_state = "start"
         version = ""
         tabs = {}
@@ -65,6 +1504,8 @@ class StarParser:
             except Hell as e:
                 raise NotImplemented("Format checking is not implemented yet") from e
             if new_state == "newtab":
+                if tabs:  # the previous table is complete
+                    tabs[current_table].close()
                 current_table = line
                 if "_general" in current_table:  # define tab beyond first
                     tabs[current_table] = StarGeneralTab(current_table)
@@ -76,14 +1517,33 @@ class StarParser:
                 version = line
             elif new_state in ["data", "labels"]:
                 tabs[current_table].read_line(line, state=new_state)
+        if tabs:
+            tabs[current_table].close()
         self.tabs = tabs
         return tabs
 
     def write_out(self, tabs="all", to_file=False, new_file=""):
+        """
+        Writes the tables to the star file, new_file or a string. Tables that
+        are unchanged since they were parsed, and those that parse skipped, are
+        copied from the star file byte for byte, as are the unchanged rows of
+        tables whose columns are unchanged (see _write_tabs). Files are written
+        to a temporary file that then replaces the destination.
+        """
         if new_file: #seems logical
             to_file=True
         if tabs == "all":
-            requested = self.tabs
+            if self._partial:
+                skipped = [n for n in self.index() if n not in self.tabs]
+                if self._source == _file_key(self.file_name):
+                    # None: copied from the file without parsing
+                    requested = {n: self.tabs.get(n) for n in self.blocks}
+                    requested.update(self.tabs)
+                else:  # read the tables that were skipped by parse
+                    self.parse(tabs=skipped)
+                    requested = self.tabs
+            else:
+                requested = self.tabs
         else:
             if not isinstance(tabs, list):  # single tab requested
                 tabs = [tabs]
@@ -94,49 +1554,362 @@ class StarParser:
                 }
             except AssertionError:
                 sys.exit(f"Not all tabs in {tabs} exist in this data frame{self.tabs}")
-        star = []
-        for tab_name, tab_object in requested.items():
-            star.append(tab_object.to_star())
         if not to_file:
-            return "\n".join(star)
+            buffer = io.BytesIO()
+            self._write_tabs(buffer, requested)
+            return buffer.getvalue().decode()
         else:
             if new_file:
                 destination = Path(new_file)
             else:
                 destination = self.file_name
-            destination.write_text("\n".join(star))
+            # the star file may be the destination and the source of the copies
+            _replace_file(destination, lambda f: self._write_tabs(f, requested))
+            if destination.resolve() == self.file_name.resolve():
+                # the tables are elsewhere in the new file
+                self.blocks = {}
+                self._scanned_to = 0
+                self._source = None
             print(f"Data written to {destination}")
 
-    def read_df(self, df):
-        self.tabs = {}
-        try:
-            assert isinstance(df, pd.DataFrame)
-            self.tabs["data_"] = StarTabDf(df)
-        except AssertionError:
-            raise TypeError(
-                f"The object {df} does not appear to be a compatible pandas DataFrame"
-            )
-        return self.tabs
+    def _write_tabs(self, handle, tabs):
+        """
+        Writes tabs, by name, to handle. While the star file is as it was parsed,
+        tables that did not change since (or None for tables that were not
+        parsed) are copied from it with the lines up to the next table, and the
+        unchanged rows of tables with unchanged columns are copied line by line.
+        """
+        unchanged = self._source is not None
+        unchanged = unchanged and self._source == _file_key(self.file_name)
+        copied_to = None  # where the last table copied ends in the file
+        for index, (name, tab) in enumerate(tabs.items()):
+            block = self.blocks.get(name) if unchanged else None
+            rows = None
+            if block is not None and block.end is not None:
+                origin = None if tab is None else tab._origin
+                if tab is None:
+                    rows = True
+                elif origin is not None and origin[:2] == (self._source, block.start):
+                    rows = tab._verbatim(origin[2])
+            if rows is not None and rows is not True:
+                # row by row from the file, a mapped plain file only
+                runs = None if _compression(self.file_name) else _runs(rows)
+                rows = None if runs is None else rows
+            if rows is None:
+                if index:
+                    handle.write(b"\n")
+                tab.write(handle)
+                copied_to = None
+                continue
+            start, end = block.start, self._span_end(block)
+            if not index and all(b.start >= start for b in self.blocks.values()):
+                start = 0  # with the lines before the first table
+            if index and copied_to != start:
+                handle.write(b"\n")
+            if rows is True:
+                self._copy(handle, start, end)
+            else:
+                self._write_changed_rows(handle, tab, block, runs, start, end)
+            copied_to = end
 
+    def _span_end(self, block):
+        # a table is copied up to the next table, or to the end of the file
+        starts = [b.start for b in self.blocks.values() if b.start > block.start]
+        if starts:
+            return min(starts)
+        return None if self._scanned_to is None else block.end
 
-class StarTab:
-    def __init__(self, name):
+    def _copy(self, handle, start, end=None):
+        """
+        Copies bytes start to end of the star file to handle, within the kernel
+        if both are plain files
+        """
+        if not _compression(self.file_name) and isinstance(handle, io.BufferedWriter):
+            handle.flush()
+            with open(self.file_name, "rb") as source:
+                if end is None:
+                    end = os.fstat(source.fileno()).st_size
+                try:
+                    while start < end:
+                        size = os.copy_file_range(
+                            source.fileno(), handle.fileno(), end - start, start
+                        )
+                        if not size:
+                            break
+                        start += size
+                except (AttributeError, OSError):  # not Linux, or not supported
+                    pass
+            handle.seek(0, io.SEEK_END)  # the file grew behind the buffer
+        with _open_star(self.file_name) as source:
+            source.seek(start)
+            while end is None or start < end:
+                size = _CHUNK_SIZE if end is None else min(_CHUNK_SIZE, end - start)
+                data = source.read(size)
+                if not data:
+                    break
+                handle.write(data)
+                start += len(data)
+
+    def _write_changed_rows(self, handle, tab, block, runs, start, end):
+        """
+        Writes tab with bytes start to end of the star file, but for the rows of
+        the block: runs, from _runs, are copied from the block or formatted.
+        """
+        changed = _changed_lines(tab.to_df(), runs)
+        with open(self.file_name, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+                data_start = block.end if block.data_start is None else block.data_start
+                starts, ends = _line_offsets(source, data_start, block.end)
+                handle.write(source[start:data_start])
+                for first, last, row in runs:
+                    if row < 0:
+                        handle.write(next(changed))
+                        continue
+                    stop = ends[row + last - first - 1]
+                    handle.write(source[starts[row] : stop])
+                    if source[stop - 1] != 10:  # last line of the file
+                        handle.write(b"\n")
+                tail = ends[-1] if len(ends) else data_start
+                handle.write(source[tail:end])
+
+    def append_rows(self, tab, rows):
+        """
+        Adds rows, a dataframe or loop table, at the end of the loop table tab of
+        the star file, without rewriting the file if it is not compressed and tab
+        is its last table: only the rows are written, after its last line, and
+        the file is cut back to that line if the write fails. Else the file is
+        copied with the rows to a file that replaces it (see _replace_file).
+        The columns of rows must be those of the labels of tab, in any order. If
+        tab was parsed it is dropped, and read again by write_out.
+        """
+        blocks = self.index()
+        if tab not in blocks:
+            raise KeyError(f"Tables {[tab]} are not in {self.file_name}")
+        if "_general" in tab:
+            raise ValueError("General tabs contain no data - formatting error")
+        block = blocks[tab]
+        labels = StarTab(tab)
+        for line in block.header:
+            labels.read_label_line(line)
+        columns = labels.get_columns(update=True)
+        df = rows if isinstance(rows, pd.DataFrame) else rows.to_df()
+        names = [c.split()[0].replace("_rln", "", 1) for c in df.columns]
+        if sorted(names) != sorted(columns):
+            raise ValueError(f"Columns {names} do not match the labels of {tab}: {columns}")
+        if not len(df):
+            return
+        text = io.BytesIO()
+        _write_rows(text, [df.set_axis(names, axis=1)[columns]], trailer=False)
+        text = text.getvalue()
+        with _open_star(self.file_name) as f:
+            offset = _data_end(f, block.start, block.end)
+            f.seek(offset - 1)
+            if f.read(1) != b"\n":  # last line of the file
+                text = b"\n" + text
+        if _compression(self.file_name) or any(
+            b.start > block.start for b in blocks.values()
+        ):
+
+            def write(handle):
+                self._copy(handle, 0, offset)
+                handle.write(text)
+                self._copy(handle, offset)
+
+            _replace_file(self.file_name, write)
+        else:
+            _write_over_end(self.file_name, offset, text)
+        # where the tables are now
+        for other in blocks.values():
+            if other.start > block.start:
+                other.start += len(text)
+                other.data_start = other.data_start and other.data_start + len(text)
+                other.end += len(text)
+        if block.data_start is None:
+            block.data_start = offset + len(text) - len(text.lstrip(b"\n"))
+        block.end += len(text)
+        source, self._source = self._source, _file_key(self.file_name)
+        parsed = getattr(self, "tabs", {})
+        for name, other in parsed.items():
+            origin = other._origin
+            if origin is not None and origin[0] == source and name != tab:
+                start = origin[1] + len(text) * (origin[1] > block.start)
+                other._origin = (self._source, start, origin[2])
+        if tab in parsed:
+            del parsed[tab]
+            self._partial = True
+
+    def join(self, other, tab, on, how="inner", conflicts="left", suffix="_2"):
+        """
+        Joins the loop table tab of other, a StarParser or star file, to table tab
+        of this file as StarTab.join, and keeps the result as tab, which is
+        returned. Tables that were not parsed stream from their file (see
+        iter_chunks); the smaller of those, in bytes, is read whole to be indexed.
+        Tables that were parsed are indexed first.
+        """
+        if not isinstance(other, StarParser):
+            other = StarParser(other, create=False)
+        left, left_tab = self._join_input(tab)
+        right, right_tab = other._join_input(tab)
+        on = left_tab._resolve_columns(on)
+        right_tab._resolve_columns(on)
+        renames = _join_renames(
+            left_tab.get_columns(), right_tab.get_columns(), on, how, conflicts, suffix
+        )
+        frames = list(_join(left, right, on, how, renames))
+        joined = StarTab(tab)
+        joined.version = left_tab.version
+        joined.df = frames[0] if len(frames) == 1 else _concat_frames(frames)
+        joined._update_labels(list(joined.df.columns))
+        known = {**getattr(self, "tabs", {}), tab: joined}
+        self.tabs = {n: known[n] for n in self.blocks if n in known}
+        self._partial = len(self.tabs) < len(self.blocks)
+        return joined
+
+    def diff(self, other, tab, on=None, columns=None, tolerance=0, suffix="_old"):
+        """
+        The rows of the loop table tab that differ between this file and other, a
+        StarParser or star file, as StarTab.diff. Tables that were not parsed are
+        parsed first; parse them with memmap beforehand for tables larger than
+        memory.
+        """
+        if not isinstance(other, StarParser):
+            other = StarParser(other, create=False)
+        if "_general" in tab:
+            raise ValueError("General tabs contain no data - formatting error")
+        tabs = []
+        for star in [self, other]:
+            parsed = getattr(star, "tabs", {}).get(tab)
+            tabs.append(star.parse(tabs=tab)[tab] if parsed is None else parsed)
+        return tabs[0].diff(tabs[1], on, columns, tolerance, suffix)
+
+    def _join_input(self, tab):
+        # (size, chunks, df) of the table as from _join_side, with size (0, rows)
+        # if parsed and (1, bytes) if not, and a table with its labels
+        parsed = getattr(self, "tabs", {}).get(tab)
+        if parsed is not None:
+            size, chunks, df = _join_side(parsed)
+            return ((0, size), chunks, df), parsed
+        block = self.index().get(tab)
+        if block is None:
+            raise KeyError(f"Tables {[tab]} are not in {self.file_name}")
+        if "_general" in tab:
+            raise ValueError("General tabs contain no data - formatting error")
+        labels = StarTab(tab)
+        labels.read_line(block.version, state="version")
+        for line in block.header:
+            labels.read_line(line, state="labels")
+        labels.close()  # no rows, the columns typed as they are read
+
+        def chunks():
+            empty = True
+            for chunk in self.iter_chunks(tab):
+                empty = False
+                yield chunk
+            if empty:
+                yield labels.to_df()
+
+        data_start = block.end if block.data_start is None else block.data_start
+        size = (1, block.end - data_start)
+        return (size, chunks, lambda: _concat_frames(list(chunks()))), labels
+
+    def read_df(self, df):
+        self.tabs = {}
+        try:
+            assert isinstance(df, pd.DataFrame)
+            self.tabs["data_"] = StarTabDf(df)
+        except AssertionError:
+            raise TypeError(
+                f"The object {df} does not appear to be a compatible pandas DataFrame"
+            )
+        return self.tabs
+
+
+class StarTab:
+    _columns = None  # per-column values while the parser is filling the table
+    _df = None
+    _body = None
+    _dirty = False  # df changed since the rows in _body were made
+    _origin = None  # (_file_key, start of the block, _snapshot) when parsed
+    _indexes = None  # column name -> HashIndex or SortedIndex, see create_index
+
+    def __init__(self, name):
         self.body = []
         self.labels = []
         self.version = None
         self.name = name
+        self._columns = None
 
     def __repr__(self):
-        return f"StarTable {self.name} with {len(self.get_columns())} columns and {len(self.body)} record(s)"
+        return f"StarTable {self.name} with {len(self.get_columns())} columns and {len(self.to_df())} record(s)"
+
+    @property
+    def df(self):
+        if self._df is None:
+            raise AttributeError(f"{self.name} has no dataframe")
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        if df is not self._df:
+            self._df = df
+            self._body = None  # stale, remade on demand
+            self._dirty = True
+
+    @property
+    def body(self):
+        # the dataframe is the only copy of the table, rows are remade from it
+        # when they are needed and something changed since the last time
+        if self._df is None and self._columns is not None:
+            self.close()
+        if self._dirty:
+            self._body = self._update_body(self._df)
+            self._dirty = False
+        return self._body
+
+    @body.setter
+    def body(self, rows):
+        self._body = rows
+        self._dirty = False
 
     def _update_from_df(self, df):
         self.labels = self._update_labels(list(df.columns))
         self.version = ""
         self.name = "data_"
-        self.body = self._update_body(df)
+        self.df = df.copy(deep=not _copy_on_write())  # df may still be changed
 
     def _update_body(self, df):
-        return [list(r)[1:] for r in df.to_records()]
+        columns = [_format_column(df[c]) for c in df.columns]
+        return [list(row) for row in zip(*columns)]
+
+    def _snapshot(self):
+        # hashes of the rows, to find the rows that changed since
+        df = self.to_df()
+        hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        return self.name, self.version, list(self.labels), hashes
+
+    def _verbatim(self, snapshot):
+        """
+        Compares the table with a _snapshot. Returns True if nothing changed,
+        None if the header changed, and otherwise the row of the snapshot that
+        each row is, -1 for rows that changed.
+        """
+        name, version, labels, hashes = snapshot
+        if (name, version, labels) != (self.name, self.version, self.labels):
+            return None
+        df = self.to_df()
+        if list(df.columns) != self.get_columns():
+            return None
+        rows = self._snapshot()[3]
+        try:
+            index = df.index.to_numpy().astype(np.int64, casting="safe")
+        except TypeError:  # not the rows of the file
+            return None
+        valid = (index >= 0) & (index < len(hashes))
+        unchanged = valid & (hashes[np.where(valid, index, 0)] == rows)
+        source = np.where(unchanged, index, -1)
+        if len(source) == len(hashes) and (source == np.arange(len(hashes))).all():
+            return True
+        return source
 
     def read_line(self, line, state):
         if state == "data":
@@ -150,11 +1923,111 @@ class StarTab:
         self.version = line
 
     def read_data_line(self, line: str):
-        self.body.append(line.strip().split())
+        if self._columns is None:
+            self._columns = [[] for _ in self.get_columns(update=True)]
+        values = line.split()
+        if len(values) != len(self._columns):
+            # as the C reader of read_block does
+            raise ValueError(
+                f"Expected {len(self._columns)} fields in {self.name}, saw {len(values)}: {line.strip()}"
+            )
+        for column, value in zip(self._columns, values):
+            column.append(value)
 
     def read_label_line(self, line: str):
         self.labels.append(line)
 
+    def read_block(
+        self, stream, columns=None, dtypes=None, end=None, workers=None, where=None
+    ):
+        """
+        Reads all data lines of a loop at once with the pandas C reader, from the
+        current position of stream (a _StarStream). If columns is given, only
+        those columns are converted and kept. Known labels are stored as numbers,
+        dtypes overrides their types, or dtypes=False keeps all values as strings.
+        If the end of the loop is known, large loops are split in byte ranges that
+        are read by a pool of workers processes. Otherwise, with where (see
+        StarParser.parse), the loop is read in chunks that keep only the rows
+        that match.
+        """
+        names, usecols, types = self._read_types(columns, dtypes)
+        where = self._resolve_where(where)
+        start = stream.tell()
+        df = None
+        if where:
+            df = self._read_where(stream, start, names, usecols, types, where)
+        elif workers is not None and workers > 1 and end is not None:
+            star = stream.handle.name
+            ranges = _split_range(star, start, end, workers)
+            if len(ranges) > 1:
+                df = _read_ranges(star, ranges, names, usecols, types, workers)
+        if df is None:
+            try:
+                df = _read_csv(self._lines(stream, start), names, usecols, types)
+            except ValueError:
+                # some values do not match their label type, read strings and
+                # convert the columns that can be converted
+                lines = self._lines(stream, start)
+                df = _read_csv(lines, names, usecols, {c: object for c in names})
+                for c in df.columns:
+                    df[c] = _convert_column(df[c], types[c])
+        if usecols is not None:
+            self._update_labels(list(df.columns))
+        self.df = df
+
+    def _read_where(self, stream, start, names, usecols, types, where):
+        try:
+            lines = self._lines(stream, start)
+            chunks = _loop_chunks(lines, names, usecols, types, _DISK_ROWS, where)
+            return _concat_frames(list(chunks))
+        except ValueError:
+            # as without where, strings for the columns that can not be converted
+            lines = self._lines(stream, start)
+            strings = {c: np.dtype(object) for c in names}
+            chunks = _loop_chunks(
+                lines, names, usecols, strings, _DISK_ROWS, where, types
+            )
+            df = _concat_frames(list(chunks))
+            for c in df.columns:
+                df[c] = _convert_column(df[c], types[c])
+            return df
+
+    def _resolve_where(self, where):
+        # predicates by column, KeyError if the table lacks one of the columns
+        if not where:
+            return None
+        columns = self._resolve_columns(list(where))
+        return {c: _predicate(p) for c, p in zip(columns, where.values())}
+
+    def _has_columns(self, where):
+        # whether the table has all columns of where, as labels or names
+        columns = self.get_columns(update=True)
+        return all(c.split()[0].replace("_rln", "", 1) in columns for c in where)
+
+    def _read_types(self, columns, dtypes):
+        # columns in the loop, columns to read and their types for the C reader
+        names = self.get_columns(update=True)
+        usecols = None if columns is None else self._resolve_columns(columns)
+        if dtypes is False:
+            types = {c: np.dtype(object) for c in names}
+        else:
+            types = _column_dtypes(names, dtypes)
+        return names, usecols, types
+
+    def _lines(self, stream, start):
+        stream.seek(start)
+        return io.BufferedReader(_LoopReader(stream.iter_loop()), _CHUNK_SIZE)
+
+    def _resolve_columns(self, columns):
+        # accepts both column names and _rln labels
+        if not isinstance(columns, list):
+            columns = [columns]
+        columns = [c.split()[0].replace("_rln", "", 1) for c in columns]
+        missing = [c for c in columns if c not in self.get_columns()]
+        if missing:
+            raise KeyError(f"Columns {missing} are missing from {self.name}")
+        return columns
+
     def get_labels(self):
         return self.labels
 
@@ -184,12 +2057,32 @@ class StarTab:
         self.clean_labels = self.get_columns(update=True)
         return labels
 
+    def close(self):
+        """
+        Turns the values read line by line into the dataframe, which then becomes
+        the only copy of the table. Called by the parser at the end of each table.
+        """
+        columns = self.get_columns(update=True)
+        if self._columns is None:
+            if self._df is not None:  # already read by read_block
+                return
+            self._columns = [[] for _ in columns]  # loop_ without data lines
+        self.df = pd.DataFrame(
+            dict(zip(columns, self._columns)), columns=columns, dtype=object
+        )
+        for c, dtype in _column_dtypes(columns).items():
+            self.df[c] = _convert_column(self.df[c], dtype)
+        self._columns = None
+
     def to_df(self):
         try:
             return self.df
         except AttributeError:
+            if self._columns is not None:
+                self.close()
+                return self.df
             columns = self.get_columns()
-            self.df = pd.DataFrame(self.body, columns=columns)
+            self._df = pd.DataFrame(self.body, columns=columns)  # rows are current
             return self.df
 
     def to_dataframe(self):  # easier to remember?
@@ -198,11 +2091,11 @@ class StarTab:
     def remove_columns(self, columns, store=False):
         try:
             if not store:
-                return self.to_df().copy().drop(columns=columns)
+                return self.to_df().drop(columns=columns)
             else:
                 self.to_df().drop(columns=columns, inplace=True)
                 self.labels = self._update_labels(self.df.columns)
-                self.body = self._update_body(self.df)
+                self._dirty = True
                 return self.df
         except KeyError as e:
             raise KeyError(
@@ -227,7 +2120,7 @@ class StarTab:
         else:
             self.df = pd.concat([target, dataframe], axis=1, join="inner")
             self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
+            self._dirty = True
             return self.df
 
     def keep_only_columns(self, keep, store=False):
@@ -235,21 +2128,393 @@ class StarTab:
             keep = [keep]
         discard = [c for c in self.to_df().columns if c not in keep]
         if not store:
-            return self.to_df().copy().drop(columns=discard)
+            return self.to_df().drop(columns=discard)
         else:
             self.to_df().drop(columns=discard, inplace=True)
             self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
+            self._dirty = True
             return self.df
 
+    def join(self, other, on, how="inner", conflicts="left", suffix="_2", store=False):
+        """
+        Joins the rows of other, a loop table, to the rows of this table that
+        have the same values in the column(s) on. how is "inner" for the rows
+        with a match, "left" for all rows, with missing values where there is no
+        match, or "anti" for the rows without a match, with only the columns of
+        this table. Columns in both tables are kept as conflicts says: "left"
+        (the values of this table), "right" (those of other), "suffix" (both,
+        suffix added to the names of other) or "error" (ValueError).
+        The smaller table is indexed by a hash table of its keys and the other
+        streams through it, see _join.
+        """
+        on = self._resolve_columns(on)
+        other._resolve_columns(on)
+        renames = _join_renames(
+            self.get_columns(), other.get_columns(), on, how, conflicts, suffix
+        )
+        frames = list(_join(_join_side(self), _join_side(other), on, how, renames))
+        df = frames[0] if len(frames) == 1 else _concat_frames(frames)
+        if not store:
+            return df
+        self._set_rows(df)
+        return self.df
+
+    def _set_rows(self, df):
+        # df as the table, the indexes are made again for its rows when used
+        self.df = df
+        self._update_labels(self.df.columns)
+
+    def select(self, column, keys, exclude=False, store=False):
+        """
+        The rows whose column has one of keys, or those that do not if exclude.
+        keys is a KeySet, a loop table or CsParser with the keys in column (see
+        KeySet.from_tab and from_cs), or the keys. Only the selected rows are
+        copied. To select the rows as a file is read, give a KeySet as a where
+        predicate to StarParser.parse or iter_chunks.
+        """
+        column = self._resolve_columns(column)[0]
+        keys = _key_set(keys, column)
+        accepted = keys(self._column_values(column)).to_numpy() != exclude
+        df = self.to_df()[accepted].reset_index(drop=True)
+        if not store:
+            return df
+        self._set_rows(df)
+        return self.df
+
+    def transform_coords(
+        self, transform, x="CoordinateX", y="CoordinateY", store=False
+    ):
+        """
+        The table with the coordinates in columns x and y changed by transform,
+        a CoordTransform, in one pass over all rows, and without the rows of the
+        particles that it drops. Sizes that transform names are read from the
+        columns of the table.
+        """
+        x, y = self._resolve_columns([x, y])
+        self._resolve_columns(transform.columns)
+        df = _preview(self.to_df(), [x, y])
+        new_x, new_y, keep = transform.apply(df[x], df[y], df)
+        _set_column(df, x, new_x)
+        _set_column(df, y, new_y)
+        if keep is not None and not keep.all():
+            df = df[keep].reset_index(drop=True)
+        if not store:
+            return df
+        self._set_rows(df)
+        return self.df
+
+    def sort_by(self, columns, ascending=True, store=False):
+        """
+        The rows sorted by columns, a name or list of names, in a stable order:
+        numbers by value, text and categories by their characters, missing
+        values last. ascending is True, False, or a list with one for each
+        column. Each row is encoded as one byte string (see _sort_keys), and
+        only those are sorted. StarTabDisk.sort_by and sort_chunks sort tables
+        larger than memory.
+        """
+        columns, ascending = _sort_order(self._resolve_columns(columns), ascending)
+        df, _ = _sorted_frame(self.to_df(), columns, ascending)
+        if not store:
+            return df
+        self._set_rows(df)
+        return self.df
+
+    def diff(self, other, on=None, columns=None, tolerance=0, suffix="_old"):
+        """
+        The rows that differ between this table and other, e.g. a later version
+        of it, as a dictionary of StarTabs: "added" has the rows only in other,
+        "removed" those only in this table, and "changed" the rows of other whose
+        values in columns differ from those of their row in this table, followed
+        by the old values of the columns that changed, suffix added to their names.
+        on: column(s) with the key of each row; rows with the same key are paired
+        in order. Without on, rows are paired by their values in columns and none
+        are changed.
+        columns: the columns compared, by default those in both tables.
+        tolerance: the largest difference of numbers that is not a change, or a
+        dictionary of them by column.
+        Rows are paired by the hashes of their keys (see _diff_pairs), then the
+        columns are compared one at a time: only the keys and one column of each
+        table are in memory at once, besides the rows that differ.
+        """
+        if on is not None:
+            on = self._resolve_columns(on)
+            other._resolve_columns(on)
+        if columns is None:
+            columns = [c for c in self.get_columns() if c in other.get_columns()]
+        else:
+            columns = self._resolve_columns(columns)
+            other._resolve_columns(columns)
+        keys = columns if on is None else on
+        compared = [] if on is None else [c for c in columns if c not in on]
+        if not isinstance(tolerance, dict):
+            tolerance = {c: tolerance for c in compared}
+        old, new = [
+            pd.DataFrame(
+                {c: tab._column_values(c).reset_index(drop=True) for c in keys}
+            )
+            for tab in [self, other]
+        ]
+        new_rows, old_rows = _diff_pairs(old, new, keys)
+        added = np.ones(len(new), dtype=bool)
+        added[new_rows] = False
+        removed = np.ones(len(old), dtype=bool)
+        removed[old_rows] = False
+        del old, new
+        changed = np.zeros(len(new_rows), dtype=bool)
+        changes = []
+        for c in compared:
+            differ = _differ(
+                self._column_values(c).to_numpy()[old_rows],
+                other._column_values(c).to_numpy()[new_rows],
+                tolerance.get(c, 0),
+            )
+            if differ.any():
+                changed |= differ
+                changes.append(c)
+        previous = {
+            f"{c}{suffix}": self._column_values(c).to_numpy()[old_rows[changed]]
+            for c in changes
+        }
+        clashes = [c for c in previous if c in other.get_columns()]
+        if clashes:
+            raise ValueError(f"Columns {clashes} are in the tables already")
+        return {
+            "added": _diff_tab(other, np.flatnonzero(added)),
+            "removed": _diff_tab(self, np.flatnonzero(removed)),
+            "changed": _diff_tab(other, new_rows[changed], previous),
+        }
+
+    def create_index(self, column, kind=None, persist=False):
+        """
+        Indexes column for lookup and lookup_range, and returns the index: kind
+        "hash" (HashIndex) finds the rows with given values in O(1), "sorted"
+        (SortedIndex) in O(log n) and also finds ranges of values. By default
+        numbers are sorted and other columns hashed. The index follows its
+        column when the column is renamed or replaced, also in df directly (see
+        _check_indexes), but not values written into the column in place, such
+        as df.loc[row, column] = value. persist: StarCache.store keeps the index
+        with the table, and StarCache.load restores it.
+        """
+        column = self._resolve_columns(column)[0]
+        values = self._column_values(column)
+        if kind is None:
+            kind = "sorted" if values.dtype.kind in "iuf" else "hash"
+        if kind not in _INDEXES:
+            raise ValueError(f"kind must be hash or sorted, not {kind}")
+        return self._add_index(column, _INDEXES[kind](values, persist))
+
+    def _add_index(self, column, index):
+        # index of the values column has now
+        index.source = self._column_source(column)
+        self._indexes = {**(self._indexes or {}), column: index}
+        return index
+
+    def drop_index(self, column):
+        column = self._resolve_columns(column)[0]
+        self._indexes = {c: i for c, i in self._check_indexes().items() if c != column}
+
+    def lookup(self, column, values):
+        """
+        Rows whose column has any of values (or value) as a dataframe, found
+        through the index of column, or by a scan of the column if it has none
+        """
+        column = self._resolve_columns(column)[0]
+        index = self._check_indexes().get(column)
+        if index is None or callable(values):
+            accepted = _predicate(values)(self._column_values(column))
+            return self._take(np.flatnonzero(accepted.to_numpy()))
+        return self._take(index.rows(values))
+
+    def lookup_range(self, column, low=None, high=None):
+        """
+        Rows with low <= column <= high as a dataframe, found through the
+        sorted index of column, or by a scan of the column if it has none
+        """
+        column = self._resolve_columns(column)[0]
+        index = self._check_indexes().get(column)
+        if isinstance(index, SortedIndex):
+            return self._take(index.range(low, high))
+        values = self._column_values(column)
+        accepted = np.ones(len(values), dtype=bool)
+        if low is not None:
+            accepted &= (values >= low).to_numpy()
+        if high is not None:
+            accepted &= (values <= high).to_numpy()
+        return self._take(np.flatnonzero(accepted))
+
+    def _column_values(self, column):
+        return self.to_df()[column]
+
+    def _take(self, rows):
+        return self.to_df().iloc[rows]
+
+    def _column_names(self):
+        return list(self.to_df().columns)
+
+    def _column_source(self, column):
+        # what holds the values of column, see _same_values
+        values = self.to_df()[column]
+        return values.to_numpy() if isinstance(values.dtype, np.dtype) else values.array
+
+    def _check_indexes(self, mapped=()):
+        """
+        Brings the indexes in step with the table and returns them, the one
+        place that does. Each index keeps what held the values of its column
+        (_column_source): it follows them to the column they were renamed to,
+        goes when they were removed, and is made again when its column has
+        other values, or updated for columns in mapped, whose values were each
+        changed by a function of the old one (see HashIndex.updated).
+        """
+        if not self._indexes:
+            return {}
+        columns = self._column_names()
+        sources = {}
+
+        def source(column):
+            if column not in sources:
+                sources[column] = self._column_source(column)
+            return sources[column]
+
+        indexes = {}
+        for column, index in self._indexes.items():
+            if column in columns and _same_values(index.source, source(column)):
+                if index.source is not source(column):
+                    index = copy.copy(index)  # not to compare the values again
+                    index.source = source(column)
+                indexes[column] = index
+                continue
+            renamed = [
+                c
+                for c in columns
+                if c not in self._indexes and _same_memory(index.source, source(c))
+            ]
+            if renamed:
+                indexes[renamed[0]] = index
+            elif column in columns:
+                values = self._column_values(column)
+                indexes[column] = index.updated(values, mapped=column in mapped)
+                indexes[column].source = source(column)
+        self._indexes = indexes
+        return indexes
+
     def to_star(self):
+        buffer = io.BytesIO()
+        self.write(buffer)
+        return buffer.getvalue().decode()
+
+    def write(self, handle):
+        """
+        Writes the table to handle, a binary file object. The rows are formatted
+        _WRITE_ROWS at a time, column by column straight into bytes, so only one
+        chunk of text is ever in memory.
+        """
+        df = self.to_df()
+        if list(df.columns) != self.get_columns():
+            # columns were changed on the dataframe itself
+            self._update_labels(df.columns)
+            self._dirty = True
+        handle.write(self._header(self.labels).encode())
+        _write_rows(handle, [df], _formatters(df))
+
+    def _header(self, labels):
         star = []
         if self.version:
             star.append("\n" + self.version + "\n")
         star.append(self.name + "\n")
-        star = star + self.labels
-        star = star + [" ".join(i) for i in (self.body + ["\n"])]
-        return "\n".join(star) + "\n\n"
+        star = star + labels
+        return "\n".join(star) + "\n"
+
+    def split_by(
+        self,
+        column,
+        out_dir,
+        name_map=None,
+        drop_column=False,
+        strip_header=False,
+        workers=8,
+    ):
+        """
+        Writes one star file per value of column into out_dir, e.g. the particles
+        of each micrograph. name_map (a function or a dict) turns a value into a
+        file name, by default its file name with a .star extension. drop_column
+        leaves column out of the files, strip_header leaves out everything before
+        the labels, as crYOLO wants for training. The table is sorted by column
+        once and the files are written by a pool of workers threads.
+        Returns the paths of the files written.
+        """
+        df = self.to_df()
+        try:
+            assert column in list(df.columns)
+        except AssertionError:
+            raise AttributeError(f"There is no column named {column} in the dataframe")
+        if name_map is None:
+            name_map = lambda value: Path(value).stem + ".star"
+        elif isinstance(name_map, dict):
+            name_map = name_map.__getitem__
+        if _is_categorical(df[column].dtype):
+            codes = df[column].cat.codes.to_numpy()
+            values = df[column].cat.categories
+        else:
+            codes, values = pd.factorize(df[column])
+        out_dir = Path(out_dir)
+        paths = [out_dir / name_map(v) for v in _format_column(pd.Series(values))]
+        if len(set(paths)) < len(paths):
+            raise ValueError(f"Different values of {column} map to the same file")
+        # rows without a value (-1) are left out, like groupby does
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(-1, len(values) + 1))
+        if drop_column:
+            df = df.drop(columns=column)
+        df = df.take(order[bounds[1] :])
+        bounds = bounds[1:] - bounds[1]
+        labels = ["loop_"] + [f"_rln{c} #{i + 1}" for i, c in enumerate(df.columns)]
+        if strip_header:
+            header = "\n".join(labels[1:]) + "\n"
+        else:
+            header = self._header(labels)
+        header = header.encode()
+        formatters = _formatters(df)
+
+        def write_file(index, text=None):
+            with _open_star(paths[index], "wb") as f:
+                f.write(header)
+                if text is None:  # a large group, formatted as it is written
+                    rows = df.iloc[bounds[index] : bounds[index + 1]]
+                    _write_rows(f, [rows], formatters)
+                else:
+                    f.write(text)
+                    f.write(b"\n\n\n")
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        written = [i for i in range(len(values)) if bounds[i + 1] > bounds[i]]
+        # small groups are formatted together, about _WRITE_ROWS rows at a time,
+        # and each file gets its slice of the text
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            first = 0
+            while first < len(values):
+                last = np.searchsorted(bounds, bounds[first] + _WRITE_ROWS, "right") - 1
+                if last <= first:
+                    jobs = [pool.submit(write_file, first)]
+                    last = first + 1
+                else:
+                    rows = df.iloc[bounds[first] : bounds[last]]
+                    text, lengths = _format_rows(rows, formatters)
+                    ends = np.concatenate([[0], np.cumsum(lengths)])
+                    starts = ends[bounds[first : last + 1] - bounds[first]]
+                    jobs = [
+                        pool.submit(write_file, i, text[starts[k] : starts[k + 1]])
+                        for k, i in enumerate(range(first, last))
+                        if bounds[i + 1] > bounds[i]
+                    ]
+                # keep at most two batches of text in memory
+                for job in pending:
+                    job.result()
+                pending = jobs
+                first = last
+            for job in pending:
+                job.result()
+        return [paths[i] for i in written]
 
     def substitute_columns(self, dataframe, store=False):
         target = self.to_df()
@@ -273,14 +2538,14 @@ class StarTab:
                 f"Columns {missing} are missing from the destination dataframe"
             )
         if not store:
-            x = target.copy()
+            x = _preview(target, dataframe.columns)
         else:
             x = self.df
         for c in dataframe.columns:
-            x[c] = dataframe[c]
+            _set_column(x, c, dataframe[c])
         if store:
             self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
+            self._dirty = True
         return x
 
     def fill_column(self, columns, values, overwrite=False, store=False, create=False):
@@ -288,25 +2553,37 @@ class StarTab:
         Fills the specified column(s) with the specified value(s)
         overwrite = True overwrites existing valuse in a column if set
         """
-        # string to list if necessary
-        if not isinstance(columns, list):
-            columns = [columns]
+        columns, values = self._fill_arguments(
+            columns, values, overwrite, create, list(self.df.columns)
+        )
         # check for inplace change
         if not store:
-            df = self.to_df().copy()
+            df = _preview(self.to_df(), columns)
         else:
             df = self.to_df()
+        for index, c in enumerate(columns):
+            _set_column(df, c, _filled_column(c, values[index], len(df)))
+        if store:
+            self._update_labels(self.df.columns)
+            self._dirty = True
+        return df
+
+    def _fill_arguments(self, columns, values, overwrite, create, existing):
+        # lists of columns and a value for each, checked against the existing columns
+        # string to list if necessary
+        if not isinstance(columns, list):
+            columns = [columns]
         # check for possible overwrite
-        overlap = [i for i in columns if i in self.df.columns]
+        overlap = [i for i in columns if i in existing]
         if len(overlap) and not overwrite:
             raise ValueError(
                 f"Column(s) {overlap} already exist(s) in the star file. Please set overwrite=True to overwrite"
             )
         # check if new columns would be created
-        new_columns = [i for i in columns if i not in list(self.df.columns)]
+        new_columns = [i for i in columns if i not in existing]
         if len(new_columns) and not create:
             raise ValueError(
-                f"Column(s) {overlap} do not exist(s) in the star file. Please set create=True to create them"
+                f"Column(s) {new_columns} do not exist(s) in the star file. Please set create=True to create them"
             )
         # we can either do all columns with same value or each column with a value
         if not isinstance(values, list):
@@ -320,19 +2597,10 @@ class StarTab:
                 raise ValueError(
                     "Mismatch between the number of values and columns. Please give either a single value or a value for each column"
                 )
-        for index, c in enumerate(columns):
-            df[c] = str(values[index])
-        if store:
-            self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
-        return df
+        return columns, values
 
     def reorder_columns(self, new_order, store=False):
-        # check for inplace change
-        if not store:
-            df = self.to_df().copy()
-        else:
-            df = self.to_df()
+        df = self.to_df()  # df[new_order] below is a new dataframe
         try:
             assert len(new_order) == len(df.columns)
             assert list(sorted(new_order)) == list(sorted(df.columns))
@@ -344,7 +2612,7 @@ class StarTab:
         if store:
             self.df = df
             self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
+            self._dirty = True
         return df
 
     def add_prefix_to_column(self, prefix, column, store=False):
@@ -352,16 +2620,13 @@ class StarTab:
         if store:
             target = self.df
         else:
-            target = self.to_df().copy()
+            target = _preview(self.to_df(), [column])
         try:
             assert column in list(target.columns)
         except AssertionError:
             raise AttributeError(f"There is no column named {column} in the dataframe")
-        target[column] = prefix + target[column].astype(str)
-        if store:
-            self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
-        return target
+        values = _map_distinct(target[column], lambda value: prefix + value)
+        return self._map_column(target, column, values, store)
 
     def substitute_string_in_column_name(
         self, pattern, new_pattern, column, store=False
@@ -370,16 +2635,16 @@ class StarTab:
         if store:
             target = self.df
         else:
-            target = self.to_df().copy()
+            target = _preview(self.to_df(), [column])
         try:
             assert column in list(target.columns)
         except AssertionError:
             raise AttributeError(f"There is no column named {column} in the dataframe")
-        target[column] = target[column].replace(pattern, new_pattern).astype(str)
-        if store:
-            self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
-        return target
+        pattern, new_pattern = str(pattern), str(new_pattern)
+        values = _map_distinct(
+            target[column], lambda value: new_pattern if value == pattern else value
+        )
+        return self._map_column(target, column, values, store)
 
     def apply_regex_to_column(self, pattern, new_pattern, column, store=False):
         assert isinstance(pattern, type(re.compile("")))
@@ -388,37 +2653,30 @@ class StarTab:
         if store:
             target = self.df
         else:
-            target = self.to_df().copy()
+            target = _preview(self.to_df(), [column])
         try:
             assert column in list(target.columns)
         except AssertionError:
             raise AttributeError(f"There is no column named {column} in the dataframe")
-        target[column] = target.copy()[column].str.replace(
-            pattern, new_pattern, regex=True
+        values = _map_distinct(
+            target[column], lambda value: pattern.sub(new_pattern, value)
         )
-        if store:
-            self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
-        return target
+        return self._map_column(target, column, values, store)
 
     def remove_string_from_column_name(self, prefix, column, store=False):
         self.df = self.to_df()
         if store:
             target = self.df
         else:
-            target = self.to_df().copy()
+            target = _preview(self.to_df(), [column])
         try:
             assert column in list(target.columns)
         except AssertionError:
             raise AttributeError(f"There is no column named {column} in the dataframe")
-        new_series = []
-        for value in target[column]:
-            new_series.append(str(value).replace(prefix, ""))
-        target[column] = new_series
-        if store:
-            self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
-        return target
+        values = _map_distinct(
+            target[column], lambda value: value.replace(prefix, "")
+        )
+        return self._map_column(target, column, values, store)
 
     def trim_column_values(self, column, start=None, stop=None, store=False):
         _strt = start
@@ -428,7 +2686,7 @@ class StarTab:
         if store:
             target = self.df
         else:
-            target = self.to_df().copy()
+            target = _preview(self.to_df(), [column])
         try:
             assert column in list(target.columns)
         except AssertionError:
@@ -446,7 +2704,7 @@ class StarTab:
         except ValueError:
             raise ValueError("Invalid values for start: {_strt}, stop: {_stp}")
         try:
-            value = target[column][0]
+            value = _format_column(target[column].iloc[:1])[0]
             assert abs(start) < len(value)
             assert abs(stop) <= len(value)
         except AssertionError:
@@ -454,17 +2712,20 @@ class StarTab:
                 f"Invalid slice start: {start}, stop: {stop} for row value of length {len(value)}"
             )
         # actually do stuff
-        new_series = []
         if stop != -1:
-            for value in target[column]:
-                new_series.append(str(value[start : stop + 1]))
+            trim = lambda value: value[start : stop + 1]
         else:
-            for value in target[column]:
-                new_series.append(str(value[start:]))
-        target[column] = new_series
+            trim = lambda value: value[start:]
+        values = _map_distinct(target[column], trim)
+        return self._map_column(target, column, values, store)
+
+    def _map_column(self, target, column, values, store):
+        # values, each a function of the old value of its row, in column of target
+        _set_column(target, column, values)
         if store:
             self._update_labels(self.df.columns)
-            self.body = self._update_body(self.df)
+            self._dirty = True
+            self._check_indexes(mapped=[column])
         return target
 
     def rename_columns(self, old_names, new_names, store=False):
@@ -472,7 +2733,7 @@ class StarTab:
         if store:
             target = self.df
         else:
-            target = self.to_df().copy()
+            target = _preview(self.to_df())
         try:
             assert isinstance(old_names, list)
             assert isinstance(new_names, list)
@@ -499,6 +2760,410 @@ class StarTabDf(StarTab):
         self._update_from_df(from_df)
 
 
+class StarTabDisk(StarTab):
+    """
+    Loop table for tables larger than memory. The columns are kept in memory-
+    mapped files in directory (the temporary directory if None), and the table
+    is read, changed and written _DISK_ROWS rows at a time. Where StarTab
+    methods return a dataframe these return a StarTabDisk, which shares the
+    unchanged columns with this table. iter_chunks and to_df give the rows as
+    dataframes.
+    """
+
+    def __init__(self, name, directory=None):
+        super().__init__(name)
+        self.directory = directory
+        self.rows = 0
+        self._disk = None  # column name -> _DiskColumn, once read
+
+    def __repr__(self):
+        return f"StarTable {self.name} with {len(self.get_columns())} columns and {self.rows} record(s) on disk"
+
+    @property
+    def body(self):
+        # rows as text would hold the whole table in memory
+        raise ValueError(
+            f"{self.name} is kept on disk and has no body, use iter_chunks, to_df or write"
+        )
+
+    @body.setter
+    def body(self, rows):
+        if rows:
+            raise ValueError(f"{self.name} is kept on disk, rows can not be set")
+
+    def _snapshot(self):
+        # columns are not changed once read, only replaced
+        disk = self._disk or {}
+        columns = [(c, weakref.ref(column)) for c, column in disk.items()]
+        return self.name, self.version, list(self.labels), columns
+
+    def _verbatim(self, snapshot):
+        name, version, labels, columns = snapshot
+        if (name, version, labels) != (self.name, self.version, self.labels):
+            return None
+        disk = self._disk or {}
+        current = [(c, column) for c, column in disk.items()]
+        if current == [(c, column()) for c, column in columns]:
+            return True
+        return None
+
+    def read_block(
+        self, stream, columns=None, dtypes=None, end=None, workers=None, where=None
+    ):
+        """
+        Reads the loop _DISK_ROWS rows at a time with the pandas C reader, and
+        appends them to the files of the columns. Arguments as for StarTab,
+        except that workers is not used.
+        """
+        names, usecols, types = self._read_types(columns, dtypes)
+        where = self._resolve_where(where)
+        start = stream.tell()
+        try:
+            lines = self._lines(stream, start)
+            self._read_chunks(lines, names, usecols, types, where)
+        except ValueError:
+            # as StarTab, strings for the columns that can not be converted
+            lines = self._lines(stream, start)
+            strings = {c: np.dtype(object) for c in names}
+            self._read_chunks(lines, names, usecols, strings, where, types)
+            for c, column in self._disk.items():
+                self._disk[c] = column.converted(types[c], self.directory)
+        if usecols is not None:
+            self._update_labels(list(self._disk))
+
+    def _read_chunks(self, lines, names, usecols, types, where, convert=None):
+        keep = [c for c in names if usecols is None or c in usecols]
+        disk = {c: _DiskColumn(self.directory, types[c]) for c in keep}
+        chunks = _loop_chunks(
+            lines, names, usecols, types, _DISK_ROWS, where, convert
+        )
+        for chunk in chunks:
+            for c, column in disk.items():
+                column.append(chunk[c])
+        self._disk = {c: column.finish() for c, column in disk.items()}
+        self.rows = disk[keep[0]].length if keep else 0
+
+    def close(self):
+        # a loop without data lines has empty columns of the types of its labels
+        if self._disk is None:
+            types = _column_dtypes(self.get_columns(update=True))
+            self._disk = {
+                c: _DiskColumn(self.directory, dtype).finish()
+                for c, dtype in types.items()
+            }
+
+    def _ranges(self, rows=None):
+        # at least one, so that the columns of empty tables keep their types
+        rows = rows or _DISK_ROWS
+        starts = range(0, max(self.rows, 1), rows)
+        return [(start, min(start + rows, self.rows)) for start in starts]
+
+    def _frame(self, start, stop, columns=None):
+        index = pd.RangeIndex(start, stop)
+        columns = list(self._disk) if columns is None else columns
+        data = {
+            c: pd.Series(
+                self._disk[c].slice(start, stop),
+                index=index,
+                dtype=self._disk[c].dtype,
+                copy=False,
+            )
+            for c in columns
+        }
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def iter_chunks(self, rows=None, columns=None):
+        """
+        Yields the table, or only columns, as dataframes of rows (default
+        _DISK_ROWS) rows indexed by row number, and one empty dataframe for an
+        empty table.
+        """
+        if columns is not None:
+            columns = self._resolve_columns(columns)
+        for start, stop in self._ranges(rows):
+            yield self._frame(start, stop, columns)
+
+    def to_df(self):
+        """
+        The whole table as one dataframe in memory
+        """
+        return self._frame(0, self.rows)
+
+    def _column(self, chunks):
+        return _DiskColumn.from_chunks(self.directory, chunks)
+
+    def _column_values(self, column):
+        return self._frame(0, self.rows, [column])[column]
+
+    def _column_names(self):
+        return list(self._disk)
+
+    def _column_source(self, column):
+        return self._disk[column]
+
+    def _take(self, rows):
+        index = pd.Index(rows)
+        data = {
+            c: pd.Series(column.take(rows), index=index, dtype=column.dtype)
+            for c, column in self._disk.items()
+        }
+        return pd.DataFrame(data, index=index, columns=list(self._disk))
+
+    def _changed(self, disk, store, rows=None):
+        # this table with the columns of disk if store, otherwise a new table;
+        # rows is their length if the rows changed
+        tab = self
+        if not store:
+            tab = StarTabDisk(self.name, self.directory)
+            tab.version = self.version
+            tab.rows = self.rows
+        if rows is not None:
+            tab.rows = rows
+        tab._indexes = dict(self._indexes or {})
+        tab._disk = disk
+        tab._update_labels(list(disk))
+        if store:
+            tab._check_indexes()  # not to keep the files of replaced columns
+        return tab
+
+    def remove_columns(self, columns, store=False):
+        if not isinstance(columns, list):
+            columns = [columns]
+        if any(c not in self._disk for c in columns):
+            raise KeyError(f"Some columns in {columns} are missing from the dataframe")
+        disk = {c: v for c, v in self._disk.items() if c not in columns}
+        return self._changed(disk, store)
+
+    def add_columns(self, dataframe, store=False):
+        try:
+            # we only work with the same number of records in both tables
+            assert dataframe.shape[0] == self.rows
+        except AttributeError as e:
+            raise TypeError(
+                "A pandas DataFrame or Series are required for this operation"
+            ) from e
+        except AssertionError:
+            raise ValueError(
+                f"Cannot add a dataframe of shape {dataframe.shape} to a table of {self.rows} records"
+            )
+        if isinstance(dataframe, pd.Series):
+            dataframe = dataframe.to_frame()
+        disk = dict(self._disk)
+        for c in dataframe.columns:
+            series = dataframe[c]
+            disk[c] = self._column(series.iloc[a:b] for a, b in self._ranges())
+        return self._changed(disk, store)
+
+    def keep_only_columns(self, keep, store=False):
+        if not isinstance(keep, list):
+            keep = [keep]
+        disk = {c: v for c, v in self._disk.items() if c in keep}
+        return self._changed(disk, store)
+
+    def substitute_columns(self, dataframe, store=False):
+        try:
+            missing = [c for c in dataframe.columns if c not in self._disk]
+        except AttributeError:
+            raise TypeError(
+                "A pandas Dataframe or Series is required for this operation"
+            )
+        if missing:
+            raise AttributeError(
+                f"Columns {missing} are missing from the destination dataframe"
+            )
+        return self.add_columns(dataframe, store)
+
+    def fill_column(self, columns, values, overwrite=False, store=False, create=False):
+        columns, values = self._fill_arguments(
+            columns, values, overwrite, create, list(self._disk)
+        )
+        disk = dict(self._disk)
+        for c, value in zip(columns, values):
+            disk[c] = self._column(
+                pd.Series(_filled_column(c, value, b - a), index=pd.RangeIndex(a, b))
+                for a, b in self._ranges()
+            )
+        return self._changed(disk, store)
+
+    def reorder_columns(self, new_order, store=False):
+        try:
+            assert len(new_order) == len(self._disk)
+            assert list(sorted(new_order)) == list(sorted(self._disk))
+        except AssertionError:
+            raise ValueError(
+                f"\nThe reordered list of columns:\n {new_order} of length {len(new_order)}\n does not match the existing columns:\n {list(self._disk)} of length {len(self._disk)}"
+            )
+        return self._changed({c: self._disk[c] for c in new_order}, store)
+
+    def join(self, other, on, how="inner", conflicts="left", suffix="_2", store=False):
+        """
+        As StarTab.join. If both tables have more than _JOIN_ROWS rows, they are
+        first split by the hash of their keys into partitions on disk, which are
+        joined in pairs; the rows then come one partition at a time.
+        """
+        on = self._resolve_columns(on)
+        other._resolve_columns(on)
+        renames = _join_renames(
+            self.get_columns(), other.get_columns(), on, how, conflicts, suffix
+        )
+        pairs = [(self, other)]
+        size = min(_join_side(self)[0], _join_side(other)[0])
+        if size > _JOIN_ROWS:
+            count = -(-size // _JOIN_ROWS)
+            pairs = zip(
+                _partitions(self, on, count, self.directory),
+                _partitions(other, on, count, self.directory),
+            )
+        # missing values in any chunk of a left join make numbers float
+        floats = [c for c in renames.values() if c not in self._disk and how == "left"]
+        disk = None
+        for left, right in pairs:
+            for chunk in _join(_join_side(left), _join_side(right), on, how, renames):
+                numbers = [c for c in floats if chunk[c].dtype.kind in "iu"]
+                chunk = chunk.astype({c: np.float64 for c in numbers})
+                if disk is None:
+                    disk = {
+                        c: _DiskColumn(self.directory, chunk[c].dtype)
+                        for c in chunk.columns
+                    }
+                for c, column in disk.items():
+                    column.append(chunk[c])
+        disk = {c: column.finish() for c, column in disk.items()}
+        return self._changed(disk, store, disk[on[0]].length)
+
+    def select(self, column, keys, exclude=False, store=False):
+        """
+        As StarTab.select, into new columns on disk, a chunk at a time
+        """
+        column = self._resolve_columns(column)[0]
+        keys = _key_set(keys, column)
+        rows = [
+            chunk.index[keys(chunk[column]).to_numpy() != exclude].to_numpy()
+            for chunk in self.iter_chunks(columns=[column])
+        ]
+        disk = {
+            c: self._column(
+                pd.Series(values.take(selected), dtype=values.dtype)
+                for selected in rows
+            )
+            for c, values in self._disk.items()
+        }
+        return self._changed(disk, store, sum(len(selected) for selected in rows))
+
+    def transform_coords(
+        self, transform, x="CoordinateX", y="CoordinateY", store=False
+    ):
+        """
+        As StarTab.transform_coords, a chunk at a time. Only the columns x and y
+        are written again, unless transform drops particles.
+        """
+        x, y = self._resolve_columns([x, y])
+        read = list(dict.fromkeys([x, y] + self._resolve_columns(transform.columns)))
+        new = {c: _DiskColumn(self.directory, np.dtype(np.float64)) for c in [x, y]}
+        kept = []
+        for chunk in self.iter_chunks(columns=read):
+            new_x, new_y, keep = transform.apply(chunk[x], chunk[y], chunk)
+            rows = chunk.index.to_numpy()
+            if keep is not None:
+                new_x, new_y, rows = new_x[keep], new_y[keep], rows[keep]
+            new[x].append(pd.Series(new_x))
+            new[y].append(pd.Series(new_y))
+            kept.append(rows)
+        disk = dict(self._disk)
+        rows = sum(len(r) for r in kept)
+        if rows < self.rows:  # the other columns lose the rows too
+            disk = {
+                c: self._column(
+                    pd.Series(values.take(r), dtype=values.dtype) for r in kept
+                )
+                for c, values in disk.items()
+            }
+        disk.update({c: column.finish() for c, column in new.items()})
+        return self._changed(disk, store, rows)
+
+    def sort_by(self, columns, ascending=True, store=False):
+        """
+        As StarTab.sort_by, by an external merge sort (see sort_chunks) into
+        new columns on disk
+        """
+        columns = self._resolve_columns(columns)
+        chunks = sort_chunks(self.iter_chunks(), columns, ascending, self.directory)
+        disk = None
+        for chunk in chunks:
+            if disk is None:
+                disk = {
+                    c: _DiskColumn(self.directory, chunk[c].dtype)
+                    for c in chunk.columns
+                }
+            for c, column in disk.items():
+                column.append(chunk[c])
+        disk = {c: column.finish() for c, column in disk.items()}
+        return self._changed(disk, store, self.rows)
+
+    def _transform(self, method, column, store, **arguments):
+        # applies the StarTab method to the column, one chunk at a time
+        if column not in self._disk:
+            raise AttributeError(f"There is no column named {column} in the dataframe")
+        chunks = (
+            method(StarTabDf(frame), column=column, **arguments)[column]
+            for frame in self.iter_chunks(columns=[column])
+        )
+        return self._changed({**self._disk, column: self._column(chunks)}, store)
+
+    def add_prefix_to_column(self, prefix, column, store=False):
+        method = StarTab.add_prefix_to_column
+        return self._transform(method, column, store, prefix=prefix)
+
+    def substitute_string_in_column_name(
+        self, pattern, new_pattern, column, store=False
+    ):
+        method = StarTab.substitute_string_in_column_name
+        return self._transform(
+            method, column, store, pattern=pattern, new_pattern=new_pattern
+        )
+
+    def apply_regex_to_column(self, pattern, new_pattern, column, store=False):
+        assert isinstance(pattern, type(re.compile("")))
+        assert isinstance(new_pattern, str)
+        method = StarTab.apply_regex_to_column
+        return self._transform(
+            method, column, store, pattern=pattern, new_pattern=new_pattern
+        )
+
+    def remove_string_from_column_name(self, prefix, column, store=False):
+        method = StarTab.remove_string_from_column_name
+        return self._transform(method, column, store, prefix=prefix)
+
+    def trim_column_values(self, column, start=None, stop=None, store=False):
+        method = StarTab.trim_column_values
+        return self._transform(method, column, store, start=start, stop=stop)
+
+    def rename_columns(self, old_names, new_names, store=False):
+        try:
+            assert isinstance(old_names, list)
+            assert isinstance(new_names, list)
+            assert len(old_names) == len(new_names)
+        except AssertionError:
+            raise TypeError(
+                f"Please ensure that old_names and new_names are lists of the same length"
+            )
+        if any(c not in self._disk for c in old_names):
+            raise ValueError(
+                f"Not all columns in {old_names} are currently present in the dataframe columns ({self.columns()})"
+            )
+        mapper = dict(zip(old_names, new_names))
+        disk = {mapper.get(c, c): v for c, v in self._disk.items()}
+        return self._changed(disk, store)
+
+    def write(self, handle):
+        """
+        Writes the table to handle, a binary file object, one chunk at a time
+        """
+        handle.write(self._header(self.labels).encode())
+        formatters = _formatters(self._frame(0, 0))
+        _write_rows(handle, self.iter_chunks(), formatters)
+
+
 class StarGeneralTab(StarTab):
     """
     Deals with _general tabs, which have a different format compared to normal
@@ -512,6 +3177,15 @@ class StarGeneralTab(StarTab):
     def read_data_line(self, line: str):
         raise ValueError("General tabs contain no data - formatting error")
 
+    def read_block(
+        self, stream, columns=None, dtypes=None, end=None, workers=None, where=None
+    ):
+        raise ValueError("General tabs contain no data - formatting error")
+
+    def close(self):
+        # values are kept in body, there is no dataframe to build
+        pass
+
     def read_label_line(self, line: str):
         label, value = line.split()
         self.labels.append(f"{label}")
@@ -520,7 +3194,14 @@ class StarGeneralTab(StarTab):
     def _update_labels(self, new_columns):
         return new_columns
 
-    def to_star(self):
+    def _snapshot(self):
+        return self.name, self.version, list(self.labels), list(self.body)
+
+    def _verbatim(self, snapshot):
+        current = (self.name, self.version, self.labels, self.body)
+        return True if current == snapshot else None
+
+    def write(self, handle):
         star = []
         if self.version:
             star.append("\n" + self.version + "\n")
@@ -530,7 +3211,921 @@ class StarGeneralTab(StarTab):
             value = self.body[index]
             spaces = 52 - (len(label) + len(value))
             star.append(f"{label}{' '*spaces}{value}")
-        return "\n".join(star) + "\n\n"
+        handle.write(("\n".join(star) + "\n\n").encode())
+
+
+class StarWriter:
+    """
+    Writes a star file one table at a time, and the rows of loop tables one
+    chunk at a time, e.g. as they come from StarParser.iter_chunks:
+
+        with StarWriter("particles.star") as writer:
+            writer.write_tab(optics)
+            writer.write_chunks("data_particles", chunks, "# version 30001")
+    """
+
+    def __init__(self, destination):
+        self.destination = Path(destination)
+        self._handle = _open_star(self.destination, "wb")
+        self._tabs = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def close(self):
+        self._handle.close()
+
+    def _start_tab(self):
+        if self._tabs:
+            self._handle.write(b"\n")
+        self._tabs += 1
+
+    def write_tab(self, tab):
+        """
+        Writes a whole table, a StarTab or StarGeneralTab
+        """
+        self._start_tab()
+        tab.write(self._handle)
+
+    def write_chunks(self, name, chunks, version=""):
+        """
+        Writes the loop table name with the rows of chunks, dataframes or StarTabs
+        with the same columns. The labels are those of the first chunk.
+        """
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        tab = StarTab(name)
+        tab.version = version
+        columns = [] if first is None else self._frame(first).columns.tolist()
+        tab._update_labels(columns)
+        self._start_tab()
+        self._handle.write(tab._header(tab.labels).encode())
+
+        def frames():
+            if first is None:
+                return
+            yield self._frame(first)
+            for chunk in chunks:
+                df = self._frame(chunk)
+                if df.columns.tolist() != columns:
+                    raise ValueError(
+                        f"Columns {df.columns.tolist()} of a chunk do not match the columns {columns} of {name}"
+                    )
+                yield df
+
+        _write_rows(self._handle, frames())
+
+    def _frame(self, chunk):
+        return chunk.to_df() if isinstance(chunk, StarTab) else chunk
+
+
+def _read_loop(star, tab, columns, typed):
+    # runs in the worker processes of collate
+    parser = StarParser(star, create=False)
+    blocks = parser.index()
+    if tab is None:
+        tab = list(blocks)[-1]
+    if columns is not None:
+        # columns that some files lack are filled by collate
+        labels = [l.split()[0] for l in blocks[tab].header if l.startswith("_")]
+        present = [c.replace("_rln", "", 1) for c in labels]
+        columns = [c for c in columns if c in present]
+    return parser.parse(tabs=tab, columns=columns, typed=typed)[tab].to_df()
+
+
+def _common_dtype(dtypes):
+    if all(isinstance(d, np.dtype) for d in dtypes):
+        try:
+            return np.result_type(*dtypes)
+        except TypeError:
+            pass
+    return np.dtype(object)
+
+
+def _concat_frames(frames):
+    """
+    Concatenates frames into one preallocated table. Columns are the union of
+    the columns of all frames, rows of frames that lack a column get missing
+    values, and categorical columns share one set of categories.
+    """
+    lengths = [len(df) for df in frames]
+    bounds = np.cumsum([0] + lengths)
+    names = list(dict.fromkeys(c for df in frames for c in df.columns))
+    columns = {}
+    for name in names:
+        # frames without rows have no say in the type of a column
+        parts = [(i, df[name]) for i, df in enumerate(frames) if name in df.columns]
+        parts = [(i, part) for i, part in parts if len(part)] or parts
+        missing = sum(len(part) for _, part in parts) < bounds[-1]
+        if all(_is_categorical(part.dtype) for _, part in parts):
+            categories = [part.cat.categories.to_numpy() for _, part in parts]
+            categories = pd.Index(pd.unique(np.concatenate(categories)))
+            codes = np.full(bounds[-1], -1, dtype=np.int32)
+            for i, part in parts:
+                remap = np.append(categories.get_indexer(part.cat.categories), -1)
+                codes[bounds[i] : bounds[i + 1]] = remap[part.cat.codes.to_numpy()]
+            columns[name] = pd.Categorical.from_codes(codes, categories=categories)
+            continue
+        dtypes = [
+            p.cat.categories.dtype if _is_categorical(p.dtype) else p.dtype
+            for _, p in parts
+        ]
+        if missing:  # missing values are NaN
+            dtypes.append(np.dtype(np.float64))
+        dtype = _common_dtype(dtypes)
+        values = np.empty(bounds[-1], dtype=dtype)
+        if missing:
+            values[:] = np.nan
+        for i, part in parts:
+            values[bounds[i] : bounds[i + 1]] = part.to_numpy(dtype=dtype)
+        # pandas 3 would infer str for object arrays, the parser keeps object
+        columns[name] = pd.Series(values, dtype=dtype, copy=False)
+    return pd.DataFrame(columns, columns=names, copy=False)
+
+
+def _key_hashes(df, on):
+    """
+    A 64-bit hash of the keys, the columns on, of each row of df, the same for
+    equal values of any dtype (1 and 1.0 too), and where any key is missing
+    (NaN, None or a missing category).
+    """
+    keys = df[on]
+    numbers = {c: keys[c].astype(np.float64) for c in on if keys[c].dtype.kind in "iuf"}
+    keys = keys.assign(**numbers)
+    hashes = pd.util.hash_pandas_object(keys, index=False, categorize=False)
+    missing = np.zeros(len(keys), dtype=bool)
+    for c in on:
+        if c in numbers:
+            missing |= np.isnan(numbers[c].to_numpy())
+        elif _is_categorical(keys[c].dtype):
+            missing |= keys[c].cat.codes.to_numpy() < 0
+        else:  # None would match None in the comparison of the keys
+            missing |= keys[c].isna().to_numpy()
+    return hashes.to_numpy(), missing
+
+
+class _HashIndex:
+    """
+    Rows of df by key, the columns on: the distinct hashes of the keys in a hash
+    table, and the rows of each hash grouped together, so that looking up a
+    chunk of rows is one get_indexer call. Matches are checked against the
+    keys themselves, in case of collisions. Missing keys match nothing.
+    """
+
+    def __init__(self, df, on):
+        hashes, missing = _key_hashes(df, on)
+        codes, uniques = pd.factorize(hashes)
+        codes[missing] = -1
+        order = np.argsort(codes, kind="stable")
+        rows = order[np.count_nonzero(codes < 0) :]
+        counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        self._set(df, on, uniques, rows, counts)
+
+    @classmethod
+    def from_groups(cls, df, on, keys, rows, counts):
+        # the index of df with the hashes, rows and counts of another index
+        index = cls.__new__(cls)
+        index._set(df, on, keys, rows, counts)
+        return index
+
+    def _set(self, df, on, keys, rows, counts):
+        self.on = on
+        self.values = [df[c].to_numpy() for c in on]
+        self.keys = pd.Index(keys)
+        self.rows = rows
+        self.counts = counts
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+
+    def lookup(self, df):
+        """
+        (row of df, row of the index) of every match of the rows of df, in the
+        order of df
+        """
+        hashes, missing = _key_hashes(df, self.on)
+        codes = self.keys.get_indexer(hashes)
+        codes[missing] = -1
+        found = codes >= 0
+        counts = np.zeros(len(codes), dtype=np.int64)
+        counts[found] = self.counts[codes[found]]
+        positions = np.repeat(np.arange(len(codes)), counts)
+        ends = np.cumsum(counts)
+        within = np.arange(len(positions)) - np.repeat(ends - counts, counts)
+        rows = self.rows[np.repeat(self.starts[np.maximum(codes, 0)], counts) + within]
+        same = np.ones(len(rows), dtype=bool)
+        for c, values in zip(self.on, self.values):
+            same &= values[rows] == df[c].to_numpy()[positions]
+        return positions[same], rows[same]
+
+
+def _index_values(values):
+    # values looked up in an index, typed so that they hash as the column would
+    if not isinstance(values, (list, tuple, set, frozenset, np.ndarray, pd.Series)):
+        values = [values]
+    values = pd.Series(list(values))
+    return values if values.dtype.kind in "iufb" else values.astype(object)
+
+
+class HashIndex:
+    """
+    Index of a column for StarTab.lookup: the rows of each value, found through
+    a hash table of the distinct values in O(1) per value. Made by
+    StarTab.create_index.
+    """
+
+    kind = "hash"
+
+    def __init__(self, values, persist=False, _index=None):
+        frame = values.rename("value").reset_index(drop=True).to_frame()
+        self._index = _HashIndex(frame, ["value"]) if _index is None else _index
+        self.persist = persist
+
+    def rows(self, values):
+        """
+        Rows, in table order, whose value is any of values (or value)
+        """
+        _, rows = self._index.lookup(_index_values(values).to_frame("value"))
+        return np.sort(rows)
+
+    def updated(self, values, mapped=False):
+        """
+        The index of values, the new values of the column. If mapped, each row
+        was changed by a function of its old value, so the rows of each old
+        value still have the same value: only one row of each is hashed again,
+        and the rows of old values that now have the same value are merged.
+        """
+        index = self._index
+        firsts = index.rows[index.starts[:-1]]
+        old = index.values[0]
+        # different values with the same hash would not follow their rows
+        collisions = old[index.rows] != old[np.repeat(firsts, index.counts)]
+        if not mapped or collisions.any():
+            return HashIndex(values, self.persist)
+        values = values.reset_index(drop=True)
+        distinct = _HashIndex(values.iloc[firsts].rename("value").to_frame(), ["value"])
+        group = np.full(len(firsts), -1, dtype=np.int64)
+        group[distinct.rows] = np.repeat(np.arange(len(distinct.keys)), distinct.counts)
+        group = np.repeat(group, index.counts)  # of each of index.rows
+        found = group >= 0  # values that are now missing match nothing
+        order = np.argsort(group[found], kind="stable")
+        rows = index.rows[found][order]
+        counts = np.bincount(group[found], minlength=len(distinct.keys))
+        frame = values.rename("value").to_frame()
+        merged = _HashIndex.from_groups(frame, ["value"], distinct.keys, rows, counts)
+        return HashIndex(values, self.persist, merged)
+
+    def arrays(self):
+        # what StarCache keeps of the index
+        index = self._index
+        keys = index.keys.to_numpy()
+        return {"keys": keys, "rows": index.rows, "counts": index.counts}
+
+    @classmethod
+    def from_arrays(cls, values, arrays, persist=True):
+        frame = values.rename("value").reset_index(drop=True).to_frame()
+        index = _HashIndex.from_groups(
+            frame, ["value"], arrays["keys"], arrays["rows"], arrays["counts"]
+        )
+        return cls(values, persist, index)
+
+
+class SortedIndex:
+    """
+    Index of a column for StarTab.lookup and lookup_range: the rows in the order
+    of their values, searched in O(log n). Made by StarTab.create_index.
+    """
+
+    kind = "sorted"
+
+    def __init__(self, values, persist=False, order=None):
+        values = values.to_numpy()
+        self.order = np.argsort(values, kind="stable") if order is None else order
+        self.values = values[self.order]
+        self.persist = persist
+
+    def rows(self, values):
+        """
+        Rows, in table order, whose value is any of values (or value)
+        """
+        values = _index_values(values).to_numpy()
+        starts = np.searchsorted(self.values, values, "left")
+        counts = np.searchsorted(self.values, values, "right") - starts
+        ends = np.cumsum(counts)
+        total = ends[-1] if len(ends) else 0
+        within = np.arange(total) - np.repeat(ends - counts, counts)
+        return np.sort(self.order[np.repeat(starts, counts) + within])
+
+    def range(self, low=None, high=None):
+        """
+        Rows, in table order, with low <= value <= high, either bound optional
+        """
+        start = 0 if low is None else np.searchsorted(self.values, low, "left")
+        stop = len(self.values)
+        if high is not None:
+            stop = np.searchsorted(self.values, high, "right")
+        return np.sort(self.order[start:stop])
+
+    def updated(self, values, mapped=False):
+        return SortedIndex(values, self.persist)
+
+    def arrays(self):
+        return {"order": self.order}
+
+    @classmethod
+    def from_arrays(cls, values, arrays, persist=True):
+        return cls(values, persist, arrays["order"])
+
+
+_INDEXES = {"hash": HashIndex, "sorted": SortedIndex}
+
+
+def _same_memory(old, new):
+    # whether new, what holds the values of a column (StarTab._column_source),
+    # is old or an array on the same memory; old is kept, so its memory is not
+    # reused
+    if old is new:
+        return True
+    if not isinstance(old, np.ndarray) or not isinstance(new, np.ndarray):
+        return False
+    old, new = [
+        (a.__array_interface__["data"][0], a.shape, a.strides, a.dtype)
+        for a in [old, new]
+    ]
+    return old == new
+
+
+def _same_values(old, new):
+    # as _same_memory, or the same values elsewhere, as after pandas moved them
+    if _same_memory(old, new):
+        return True
+    if isinstance(old, _DiskColumn) or isinstance(new, _DiskColumn):
+        return False
+    old, new = pd.Series(old, copy=False), pd.Series(new, copy=False)
+    return len(old) == len(new) and old.equals(new)
+
+
+def _set_hashes(values):
+    # 64-bit hashes of values, the same for numbers of any dtype and for text
+    values = values if isinstance(values, pd.Series) else pd.Series(values)
+    if values.dtype.kind in "iufb":
+        values = values.astype(np.float64)
+    else:
+        values = values.astype(object)
+    return pd.util.hash_pandas_object(values, index=False, categorize=False).to_numpy()
+
+
+def _bloom_bits(hashes, bits, probe):
+    # the bit of each hash for probe in a Bloom filter of bits, by double hashing
+    low = hashes & np.uint64(0xFFFFFFFF)
+    step = (hashes >> np.uint64(32)) | np.uint64(1)
+    return (low + np.uint64(probe) * step) % np.uint64(bits)
+
+
+class KeySet:
+    """
+    Set of keys that selects rows, e.g. the ImageName of the particles in a
+    cryoSPARC selection: the sorted 64-bit hashes of the distinct keys, 8 bytes
+    a key whatever its length. Called with a column, it returns True for the
+    rows whose value is in the set (~keys for those that are not), so it is a
+    where predicate for StarParser.parse and iter_chunks, which select the rows
+    as the file is read; StarTab.select selects those of a table. Categorical
+    columns are looked up once per category. A value whose hash equals that of
+    a key is taken as the key, about once per 2**64 / len(keys) values.
+    bloom: test values against a Bloom filter of the keys first, so that most
+    of those not in the set are rejected without a search of the hashes; by
+    default for sets of more than _BLOOM_KEYS keys.
+    """
+
+    def __init__(self, keys, bloom=None):
+        if not isinstance(keys, (pd.Series, pd.Index, np.ndarray)):
+            keys = list(keys)
+        keys = pd.Series(keys)
+        if _is_categorical(keys.dtype):  # the categories that are used
+            codes = np.unique(keys.cat.codes.to_numpy())
+            keys = pd.Series(keys.cat.categories[codes[codes >= 0]])
+        self.hashes = np.unique(_set_hashes(keys))
+        self.exclude = False
+        self.bloom = None
+        if bloom or (bloom is None and len(self.hashes) > _BLOOM_KEYS):
+            bits = -(-len(self.hashes) * _BLOOM_BITS // 64) * 64 or 64
+            flags = np.zeros(bits, dtype=bool)
+            for probe in range(_BLOOM_PROBES):
+                flags[_bloom_bits(self.hashes, bits, probe)] = True
+            self.bloom = np.packbits(flags, bitorder="little")
+
+    @classmethod
+    def from_tab(cls, tab, column, bloom=None):
+        """
+        The keys in column of a loop table
+        """
+        column = tab._resolve_columns(column)[0]
+        return cls(tab._column_values(column), bloom)
+
+    @classmethod
+    def from_cs(cls, cs, column, bloom=None):
+        """
+        The keys in column of a cryoSPARC .cs file or CsParser: a field of the
+        array, or the star column of a field (see cs_parser.mappings). ImageName
+        is made as RELION names particles, their index + 1 @ their stack.
+        """
+        if not isinstance(cs, cs_parser.CsParser):
+            cs = cs_parser.CsParser(cs)
+        if not hasattr(cs, "cs_array"):
+            cs.parse_array()
+        array = cs.cs_array
+        fields = {star: field for field, star in cs_parser.mappings.items()}
+        fields.update({field: field for field in array.dtype.names})
+        if column not in fields or fields[column] not in array.dtype.names:
+            raise KeyError(f"There is no column named {column} in {cs.cs_filename}")
+        keys = array[fields[column]]
+        if keys.dtype.kind == "S":
+            keys = np.char.decode(keys, "utf-8")
+        if column == "ImageName":
+            indices = (array["blob/idx"] + 1).astype(str)
+            keys = np.char.add(np.char.add(np.char.zfill(indices, 6), "@"), keys)
+        return cls(keys, bloom)
+
+    @classmethod
+    def from_text(cls, text, bloom=None):
+        """
+        The keys in the lines of the text file text, one a line; numbers if
+        all of them are numbers
+        """
+        with open(text) as f:
+            keys = pd.Series([line.strip() for line in f if line.strip()])
+        numbers = pd.to_numeric(keys, errors="coerce")
+        return cls(keys if numbers.isna().any() else numbers, bloom)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __invert__(self):
+        keys = KeySet.__new__(KeySet)
+        keys.__dict__.update(self.__dict__, exclude=not self.exclude)
+        return keys
+
+    def __call__(self, values):
+        values = values if isinstance(values, pd.Series) else pd.Series(values)
+        if _is_categorical(values.dtype):
+            found = self._found(values.cat.categories)
+            codes = values.cat.codes.to_numpy()
+            found = np.append(found, False)[codes]  # code -1 is missing
+        else:
+            found = self._found(values)
+        return pd.Series(found != self.exclude, index=values.index)
+
+    def _found(self, values):
+        hashes = _set_hashes(values)
+        found = np.zeros(len(hashes), dtype=bool)
+        if not len(self.hashes):
+            return found
+        candidates = np.arange(len(hashes))
+        if self.bloom is not None:  # most values not in the set fail a probe
+            bits = len(self.bloom) * 8
+            for probe in range(_BLOOM_PROBES):
+                positions = _bloom_bits(hashes[candidates], bits, probe)
+                byte = self.bloom[positions >> np.uint64(3)]
+                candidates = candidates[(byte >> (positions & np.uint64(7))) & 1 > 0]
+        hashes = hashes[candidates]
+        positions = np.searchsorted(self.hashes, hashes)
+        positions[positions == len(self.hashes)] = 0
+        found[candidates] = self.hashes[positions] == hashes
+        return found
+
+
+def _key_set(keys, column):
+    # keys as a KeySet, those in column if they are a table or cryoSPARC file
+    if isinstance(keys, KeySet):
+        return keys
+    if isinstance(keys, StarTab):
+        return KeySet.from_tab(keys, column)
+    if isinstance(keys, cs_parser.CsParser):
+        return KeySet.from_cs(keys, column)
+    return KeySet(keys)
+
+
+def _join_renames(left, right, on, how, conflicts, suffix):
+    """
+    The name in the join of each column of right that it keeps, by the rules of
+    conflicts for columns that are in both: "left" keeps the values of left,
+    "right" those of right, "suffix" keeps both and adds suffix to the name of
+    the column of right, and "error" raises ValueError.
+    """
+    if how not in ["inner", "left", "anti"]:
+        raise ValueError(f"how must be inner, left or anti, not {how}")
+    if conflicts not in ["left", "right", "suffix", "error"]:
+        raise ValueError(f"conflicts must be left, right, suffix or error, not {conflicts}")
+    if how == "anti":  # only the rows of left
+        return {}
+    both = [c for c in right if c in left and c not in on]
+    if both and conflicts == "error":
+        raise ValueError(f"Columns {both} are in both tables")
+    clashes = [f"{c}{suffix}" for c in both if f"{c}{suffix}" in left + right]
+    if clashes and conflicts == "suffix":
+        raise ValueError(f"Columns {clashes} are in the tables already")
+    renames = {}
+    for c in right:
+        if c not in both and c not in on:
+            renames[c] = c
+        elif c in both and conflicts != "left":
+            renames[c] = f"{c}{suffix}" if conflicts == "suffix" else c
+    return renames
+
+
+def _joined(left, right, renames):
+    # rows of left next to the rows of right, with the columns of right renamed
+    df = left.reset_index(drop=True)
+    right = right.reset_index(drop=True)
+    columns = {new: right[old] for old, new in renames.items()}
+    return df.assign(**columns) if columns else df
+
+
+def _join(left, right, on, how, renames):
+    """
+    Yields the join of left and right as dataframes. Each table is given as a
+    (size, chunks, df) tuple of functions (see _join_side): chunks yields its
+    dataframes, df returns it whole. The smaller table is indexed by _HashIndex,
+    the other streams through it a chunk at a time. Rows are in the order of
+    left, each with its matches in the order of right.
+    """
+    left_size, left_chunks, left_df = left
+    right_size, right_chunks, right_df = right
+    if right_size <= left_size:
+        build = right_df()
+        index = _HashIndex(build, on)
+        for chunk in left_chunks():
+            positions, rows = index.lookup(chunk)
+            if how == "anti":
+                yield chunk[np.bincount(positions, minlength=len(chunk)) == 0]
+                continue
+            joined = _joined(chunk.iloc[positions], build.iloc[rows], renames)
+            if how == "left":  # with the rows that have no match
+                unmatched = np.bincount(positions, minlength=len(chunk)) == 0
+                joined = _concat_frames([joined, chunk[unmatched]])
+                positions = np.concatenate([positions, np.flatnonzero(unmatched)])
+                joined = joined.iloc[np.argsort(positions, kind="stable")]
+            yield joined.reset_index(drop=True)
+        return
+    build = left_df()
+    index = _HashIndex(build, on)
+    matched = np.zeros(len(build), dtype=bool)
+    parts, order = [], []
+    for chunk in right_chunks():
+        positions, rows = index.lookup(chunk)
+        matched[rows] = True
+        if how != "anti":
+            parts.append(_joined(build.iloc[rows], chunk.iloc[positions], renames))
+            order.append(rows)
+    if how == "anti":
+        yield build[~matched].reset_index(drop=True)
+        return
+    if how == "left" or not parts:
+        parts.append(build[~matched] if how == "left" else build.iloc[:0])
+        order.append(np.flatnonzero(~matched) if how == "left" else [])
+    joined = _concat_frames(parts)
+    order = np.argsort(np.concatenate(order), kind="stable")
+    yield joined.iloc[order].reset_index(drop=True)
+
+
+def _tab_chunks(tab):
+    # the rows of a loop table as dataframes, at least one
+    if isinstance(tab, StarTabDisk):
+        return tab.iter_chunks()
+    df = tab.to_df()
+    starts = range(0, max(len(df), 1), _DISK_ROWS)
+    return (df.iloc[start : start + _DISK_ROWS] for start in starts)
+
+
+def _join_side(tab):
+    size = tab.rows if isinstance(tab, StarTabDisk) else len(tab.to_df())
+    return size, lambda: _tab_chunks(tab), tab.to_df
+
+
+def _partitions(tab, on, count, directory):
+    """
+    The rows of tab in count StarTabDisk, by hash of their keys, so that equal
+    keys are in partitions with the same number
+    """
+    parts = None
+    for chunk in _tab_chunks(tab):
+        which = _key_hashes(chunk, on)[0] % np.uint64(count)
+        order = np.argsort(which, kind="stable")
+        bounds = np.searchsorted(which[order], np.arange(count + 1))
+        if parts is None:
+            parts = [
+                {c: _DiskColumn(directory, chunk[c].dtype) for c in chunk.columns}
+                for _ in range(count)
+            ]
+        for part, start, stop in zip(parts, bounds[:-1], bounds[1:]):
+            rows = chunk.iloc[order[start:stop]]
+            for c, column in part.items():
+                column.append(rows[c])
+    tabs = []
+    for part in parts:
+        partition = StarTabDisk(tab.name, directory)
+        partition._disk = {c: column.finish() for c, column in part.items()}
+        partition.rows = next(iter(partition._disk.values())).length
+        partition._update_labels(list(partition._disk))
+        tabs.append(partition)
+    return tabs
+
+
+def _occurrences(codes):
+    # the number of earlier rows with the same code, for each row
+    order = np.argsort(codes, kind="stable")
+    ordered = codes[order]
+    first = np.flatnonzero(np.concatenate([[True], ordered[1:] != ordered[:-1]]))
+    counts = np.diff(np.concatenate([first, [len(codes)]]))
+    occurrences = np.empty(len(codes), dtype=np.int64)
+    occurrences[order] = np.arange(len(codes)) - np.repeat(first, counts)
+    return occurrences
+
+
+def _diff_pairs(old, new, keys):
+    """
+    (rows of new, rows of old) with the same keys, the columns keys of the
+    dataframes old and new, in the order of new. The n-th row of new with a key
+    pairs with the n-th row of old with it. The keys are hashed once: the two
+    tables together are numbered by hash, and the numbers of new looked up in
+    those of old. Pairs are checked against the keys, in case of collisions;
+    missing keys pair with nothing.
+    """
+    old_hashes, old_missing = _key_hashes(old, keys)
+    new_hashes, new_missing = _key_hashes(new, keys)
+    codes = pd.factorize(np.concatenate([old_hashes, new_hashes]))[0]
+    old_codes, new_codes = codes[: len(old)], codes[len(old) :]
+    old_occurrences, new_occurrences = _occurrences(old_codes), _occurrences(new_codes)
+    repeats = max(old_occurrences.max(initial=0), new_occurrences.max(initial=0)) + 1
+    old_codes = old_codes * repeats + old_occurrences
+    new_codes = new_codes * repeats + new_occurrences
+    rows = pd.Index(old_codes).get_indexer(new_codes)
+    rows[new_missing] = -1
+    new_rows = np.flatnonzero(rows >= 0)
+    old_rows = rows[new_rows]
+    same = ~old_missing[old_rows]
+    for c in keys:
+        same &= old[c].to_numpy()[old_rows] == new[c].to_numpy()[new_rows]
+    return new_rows[same], old_rows[same]
+
+
+def _differ(old, new, tolerance):
+    """
+    True where the arrays old and new differ: numbers by more than tolerance,
+    other values when they are not equal. Missing values equal each other.
+    """
+    if old.dtype.kind in "iufb" and new.dtype.kind in "iufb":
+        old, new = old.astype(np.float64), new.astype(np.float64)
+        missing = np.isnan(old)
+        return (missing != np.isnan(new)) | (np.abs(old - new) > tolerance)
+    missing = pd.isna(old)
+    return ((old != new) & ~(missing & pd.isna(new))) | (missing != pd.isna(new))
+
+
+def _diff_tab(tab, rows, columns=None):
+    # a StarTab with the rows of tab, and columns, a dictionary of arrays
+    diff = StarTab(tab.name)
+    diff.version = tab.version
+    diff.df = tab._take(rows).reset_index(drop=True).assign(**(columns or {}))
+    diff._update_labels(list(diff.df.columns))
+    return diff
+
+
+def _key_bytes(values, width=0):
+    """
+    The values, a series, as rows of bytes that sort as the values do, and
+    where values are missing: integers as the big-endian bits of int64 with the
+    sign bit flipped, or of uint64, floats as the bits of float64 with the sign
+    bit flipped (all bits for negative numbers), text as UTF-8 padded with
+    zeros to at least width bytes.
+    """
+    if values.dtype.kind in "iub":
+        missing = values.isna().to_numpy()
+        if values.dtype.kind == "i":
+            bits = values.to_numpy(np.int64, na_value=0).view(np.uint64)
+            bits = bits ^ np.uint64(1 << 63)
+        else:
+            bits = values.to_numpy(np.uint64, na_value=0)
+        return bits.astype(">u8").view(np.uint8).reshape(-1, 8), missing
+    if values.dtype.kind == "f":
+        numbers = values.to_numpy(np.float64, na_value=np.nan)
+        missing = np.isnan(numbers)
+        # -0.0 is 0.0, which keeps their order
+        bits = np.where(missing | (numbers == 0), 0.0, numbers).view(np.uint64)
+        negative = (bits >> np.uint64(63)).astype(bool)
+        bits = np.where(negative, ~bits, bits | np.uint64(1 << 63))
+        return bits.astype(">u8").view(np.uint8).reshape(-1, 8), missing
+    missing = values.isna().to_numpy()
+    texts = values.tolist()
+    try:
+        joined = "".join(texts).encode()
+    except TypeError:  # missing values, or values that are not text
+        texts = ["" if m else str(v) for v, m in zip(texts, missing)]
+        joined = "".join(texts).encode()
+    lengths = np.fromiter(map(len, texts), np.int64, len(texts))
+    if lengths.sum() != len(joined):  # not ascii
+        lengths = np.array([len(text.encode()) for text in texts], dtype=np.int64)
+    width = max(width, lengths.max(initial=0), 1)
+    encoded = np.zeros((len(texts), width), dtype=np.uint8)
+    # each text to the start of its row
+    starts = np.arange(len(texts), dtype=np.int64) * width
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    encoded.ravel()[np.arange(len(joined)) + shifts] = np.frombuffer(joined, np.uint8)
+    return encoded, missing
+
+
+def _sort_keys(df, columns, ascending, widths=None):
+    """
+    A byte string for each row of df that sorts as the row does by columns,
+    and the width of the text of each column. Each column is a byte that puts
+    missing values last, then its value as _key_bytes, at least as wide as in
+    widths; inverted where not ascending. Categories are encoded once each.
+    """
+    widths = dict(widths or {})
+    parts = []
+    for column, up in zip(columns, ascending):
+        values = df[column]
+        if _is_categorical(values.dtype):
+            categories = pd.Series(values.cat.categories)
+            encoded, missing = _key_bytes(categories, widths.get(column, 0))
+            codes = values.cat.codes.to_numpy()
+            encoded = encoded[codes]
+            missing = missing[codes] | (codes < 0)
+        else:
+            encoded, missing = _key_bytes(values, widths.get(column, 0))
+        if values.dtype.kind not in "iufb":
+            widths[column] = encoded.shape[1]
+        parts.append(missing.astype(np.uint8)[:, None])
+        parts.append(encoded if up else ~encoded)
+    keys = np.ascontiguousarray(np.hstack(parts))
+    return keys.view(f"S{keys.shape[1]}").ravel(), widths
+
+
+def _sort_order(columns, ascending):
+    # columns as dataframe names, and ascending as a list with one for each
+    if not isinstance(columns, list):
+        columns = [columns]
+    columns = [c.split()[0].replace("_rln", "", 1) for c in columns]
+    if not isinstance(ascending, list):
+        ascending = [ascending] * len(columns)
+    if len(ascending) != len(columns):
+        raise ValueError(f"ascending {ascending} does not match columns {columns}")
+    return columns, ascending
+
+
+def _sorted_frame(df, columns, ascending):
+    keys, widths = _sort_keys(df, columns, ascending)
+    return df.iloc[np.argsort(keys, kind="stable")].reset_index(drop=True), widths
+
+
+def sort_chunks(chunks, columns, ascending=True, directory=None):
+    """
+    Yields the rows of chunks, dataframes of a loop table as they come from
+    StarParser.iter_chunks, sorted by columns as StarTab.sort_by. The rows are
+    sorted _SORT_ROWS at a time into runs, kept in files in directory (the
+    temporary directory if None), which are then merged a block of each at a
+    time: the table is never in memory as a whole. The sorted rows can stream
+    straight into a StarWriter:
+
+        with StarWriter("sorted.star") as writer:
+            chunks = parser.iter_chunks("data_particles")
+            rows = sort_chunks(chunks, "MicrographName")
+            writer.write_chunks("data_particles", rows, "# version 30001")
+    """
+    columns, ascending = _sort_order(columns, ascending)
+    runs, pending, widths = [], [], {}
+    for chunk in chunks:
+        missing = [c for c in columns if c not in chunk.columns]
+        if missing:
+            raise KeyError(f"Columns {missing} are missing from the chunks")
+        pending.append(chunk)
+        if sum(len(df) for df in pending) >= _SORT_ROWS:
+            runs.append(_sort_run(pending, columns, ascending, directory, widths))
+            pending = []
+    if not runs:  # all in memory
+        if pending:
+            df = pending[0] if len(pending) == 1 else _concat_frames(pending)
+            yield _sorted_frame(df, columns, ascending)[0]
+        return
+    if pending:
+        runs.append(_sort_run(pending, columns, ascending, directory, widths))
+    yield from _merge_runs(runs, columns, ascending, widths)
+
+
+def _sort_run(frames, columns, ascending, directory, widths):
+    # frames sorted into a run of columns on disk; widths grow to those of the run
+    df, run_widths = _sorted_frame(_concat_frames(frames), columns, ascending)
+    for column, width in run_widths.items():
+        widths[column] = max(widths.get(column, 0), width)
+    return {c: _DiskColumn.from_chunks(directory, [df[c]]) for c in df.columns}
+
+
+def _merge_runs(runs, columns, ascending, widths):
+    """
+    Yields the rows of the sorted runs merged in order, a block of each run in
+    memory at a time. Every round the run whose block ends first sets the limit:
+    all rows up to it are merged, sorted by their keys, and yielded. Rows equal
+    to the limit wait in the runs after that one, so equal rows keep the order
+    of the runs, which is that of the table.
+    """
+    block = max(_SORT_ROWS // len(runs), 1)
+    lengths = [next(iter(run.values())).length for run in runs]
+    # numbers of different kinds in different runs sort as float64, see _key_bytes
+    kinds = {c: {run[c].dtype.kind for run in runs} for c in columns}
+    floats = {
+        c: np.float64 for c, k in kinds.items() if len(k) > 1 and k <= set("iufb")
+    }
+    read = [0] * len(runs)
+    buffers, keys = [None] * len(runs), [None] * len(runs)
+
+    def fill(i):
+        start, stop = read[i], min(read[i] + block, lengths[i])
+        frame = pd.DataFrame(
+            {
+                c: pd.Series(values.slice(start, stop), dtype=values.dtype)
+                for c, values in runs[i].items()
+            }
+        )
+        read[i] = stop
+        numbers = frame.astype(floats) if floats else frame
+        frame_keys = _sort_keys(numbers, columns, ascending, widths)[0]
+        if buffers[i] is None or not len(buffers[i]):
+            buffers[i], keys[i] = frame, frame_keys
+        else:
+            buffers[i] = _concat_frames([buffers[i], frame])
+            keys[i] = np.concatenate([keys[i], frame_keys])
+
+    for i in range(len(runs)):
+        fill(i)
+    while True:
+        unfinished = [i for i in range(len(runs)) if read[i] < lengths[i]]
+        counts = [len(k) for k in keys]
+        if unfinished:
+            first = min(unfinished, key=lambda i: (keys[i][-1], i))
+            limit = keys[first][-1]
+            counts = [
+                np.searchsorted(k, limit, "right" if i <= first else "left")
+                for i, k in enumerate(keys)
+            ]
+        merged = [i for i in range(len(runs)) if counts[i]]
+        frame = _concat_frames([buffers[i].iloc[: counts[i]] for i in merged])
+        order = np.concatenate([keys[i][: counts[i]] for i in merged])
+        yield frame.iloc[np.argsort(order, kind="stable")].reset_index(drop=True)
+        if not unfinished:
+            return
+        for i in range(len(runs)):
+            buffers[i], keys[i] = buffers[i].iloc[counts[i] :], keys[i][counts[i] :]
+            if len(keys[i]) < block // 2 + 1 and read[i] < lengths[i]:
+                fill(i)
+
+
+def collate(
+    pattern,
+    tab=None,
+    file_column=None,
+    file_map=None,
+    columns=None,
+    typed=True,
+    workers=None,
+):
+    """
+    Reads a table from every star file matching pattern (a glob, or a list of
+    files) in a pool of workers processes, and concatenates them in one table,
+    in the order of the sorted file names.
+    tab: name of the table to read, by default the last one of each file.
+    file_column: column added in front with a value for each file, made by
+    file_map from its path, by default its file name with a .mrc extension
+    (e.g. the micrograph of a file of picks).
+    columns: columns to read, as in StarParser.parse. Columns that only some
+    files have are kept, with missing values for the others.
+    Returns a StarTabDf.
+    """
+    if isinstance(pattern, (str, Path)):
+        stars = sorted(glob.glob(str(pattern)))
+    else:
+        stars = [str(star) for star in pattern]
+    if not stars:
+        raise FileNotFoundError(f"No star files match {pattern}")
+    jobs = [(star, tab, columns, typed) for star in stars]
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(stars) == 1:
+        frames = [_read_loop(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(jobs) // (4 * workers))
+            frames = list(pool.map(_read_loop, *zip(*jobs), chunksize=chunksize))
+    df = _concat_frames(frames)
+    if file_column is not None:
+        if file_column in df.columns:
+            raise ValueError(f"Column {file_column} already exists in the star files")
+        if file_map is None:
+            file_map = lambda star: Path(star).with_suffix(".mrc").name
+        # one category per file, files that map to the same value share it
+        remap, names = pd.factorize(np.array([file_map(Path(s)) for s in stars], dtype=object))
+        codes = np.repeat(remap, [len(f) for f in frames])
+        df.insert(0, file_column, pd.Categorical.from_codes(codes, categories=names))
+    return StarTabDf(df)
 
 
 def main():
@@ -0,0 +1,89 @@
+## Compares the line by line parser with the block parser on a scaled up star file,
+## and times writing it back out, copied unchanged or formatted
+import argparse
+import os
+import tempfile
+import time
+
+from pathlib import Path
+
+from star_parser import StarParser
+
+
+def make_scaled_star(source, destination, factor):
+    # repeat the data lines of the last table of source factor times
+    lines = Path(source).read_text().splitlines(keepends=True)
+    last = max(i for i, l in enumerate(lines) if l.startswith("_rln"))
+    header, data = lines[: last + 1], [l for l in lines[last + 1 :] if l.strip()]
+    with open(destination, "w") as f:
+        f.writelines(header)
+        for _ in range(factor):
+            f.writelines(data)
+    return len(data) * factor
+
+
+def write_tabs(star_parser, destination):
+    with open(destination, "wb") as f:
+        star_parser._write_tabs(f, star_parser.tabs)
+
+
+def time_it(function, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--source", default="static/micrographs_ctf.star")
+    parser.add_argument("-f", "--factor", type=int, default=200)
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        star = Path(tmp) / "scaled.star"
+        rows = make_scaled_star(args.source, star, args.factor)
+        size = star.stat().st_size
+        star_parser = StarParser(star, create=False)
+        by_line = time_it(
+            lambda: star_parser.parse(file_blob=star_parser.iter_file(star)),
+            args.repeats,
+        )
+        by_block = time_it(star_parser.parse, args.repeats)
+        parallel = time_it(
+            lambda: StarParser(star, create=False).parse(workers=args.workers),
+            args.repeats,
+        )
+        written = Path(tmp) / "written.star"
+        # unchanged tables are copied from the file byte for byte
+        copying = time_it(lambda: write_tabs(star_parser, written), args.repeats)
+        formatted = StarParser(star, create=False)
+        for tab in formatted.parse().values():
+            tab._origin = None  # as if changed since parsed: formatted
+        writing = time_it(lambda: write_tabs(formatted, written), args.repeats)
+        # a column of the last table changed in every row, then in 1% of them
+        modified = StarParser(star, create=False)
+        tab = list(modified.parse().values())[-1]
+        df = tab.to_df()
+        column = next(c for c in df.columns if df[c].dtype.kind == "f")
+        original = df[column].copy()
+        df[column] = original * 1.0001
+        every_row = time_it(lambda: write_tabs(modified, written), args.repeats)
+        df[column] = original
+        df.loc[df.index[::100], column] *= 1.0001
+        some_rows = time_it(lambda: write_tabs(modified, written), args.repeats)
+    print(f"{rows} rows, {size} bytes")
+    print(f"line by line: {by_line:.3f} s")
+    print(f"block:        {by_block:.3f} s ({by_line / by_block:.1f}x)")
+    print(f"{args.workers} workers:    {parallel:.3f} s ({by_line / parallel:.1f}x)")
+    print(f"write copy:   {copying:.3f} s ({size / copying / 1e6:.0f} MB/s)")
+    print(f"write format: {writing:.3f} s ({size / writing / 1e6:.0f} MB/s)")
+    print(f"write with every row changed: {every_row:.3f} s")
+    print(f"write with 1% of rows changed: {some_rows:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,312 @@
+import errno
+import io
 import os
 import re
+import tempfile
 import unittest
 
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from star_parser import StarParser
+import star_parser
 
+from coord_transform import CoordTransform
+
+from star_parser import StarParser, StarTabDf, _StarStream
+
+
+def _plain(df):
+    # df with categories as the values they stand for
+    categories = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+    return df.astype({c: object for c in categories})
+
+
+class _TableTests:
+    """
+    Tests of the row methods, shared by testStarTab on a table in memory and
+    testStarTabDisk on one on disk: self.tab is data_micrographs, self.df its
+    rows in memory, and returns the type of the results of self.tab.
+    """
+
+    def frame(self, tab):
+        # the rows of tab, a table or already a dataframe
+        return tab.to_df() if isinstance(tab, star_parser.StarTab) else tab
+
+    def result(self, value):
+        # the rows of value, returned by a method of self.tab with store=False
+        self.assertIsInstance(value, self.returns)
+        return self.frame(value)
+
+    def assert_rows(self, rows, expected):
+        pd.testing.assert_frame_equal(
+            _plain(self.frame(rows)), _plain(expected), check_dtype=False
+        )
+
+    def limit(self, name, value):
+        # star_parser.<name> set to value for the rest of the test
+        self.addCleanup(setattr, star_parser, name, getattr(star_parser, name))
+        setattr(star_parser, name, value)
+
+    def picks(self):
+        # every other micrograph of self.tab twice, then one that is not in it
+        names = self.df["MicrographName"].astype(object).tolist()[::2] * 2
+        names.append("missing.mrc")
+        coordinates = np.arange(len(names), dtype=np.float64)
+        return StarTabDf(
+            pd.DataFrame(
+                {"MicrographName": names, "CoordinateX": coordinates, "DefocusU": 0.0}
+            )
+        )
+
+    def merged(self, left, right, how):
+        # pd.merge of the rows of left and right on MicrographName, in the
+        # order of left, with the values of left for the columns in both
+        left, right = _plain(self.frame(left)), _plain(self.frame(right))
+        both = [c for c in right.columns if c in left.columns and c != "MicrographName"]
+        left = left.assign(row=np.arange(len(left)))
+        merged = left.merge(right.drop(columns=both), on="MicrographName", how=how)
+        merged = merged.sort_values("row", kind="stable").drop(columns="row")
+        return merged.reset_index(drop=True)
+
+    def test_join_inner(self):
+        picks = self.picks()
+        for left, right in [(self.tab, picks), (picks, self.tab)]:
+            joined = left.join(right, "MicrographName")
+            self.assert_rows(joined, self.merged(left, right, "inner"))
+        self.result(self.tab.join(picks, "MicrographName"))
+
+    def test_join_left(self):
+        picks = self.picks()
+        for left, right in [(self.tab, picks), (picks, self.tab)]:
+            joined = left.join(right, "MicrographName", how="left")
+            self.assert_rows(joined, self.merged(left, right, "left"))
+
+    def test_join_anti(self):
+        picks = self.picks()
+        anti = self.frame(picks.join(self.tab, "_rlnMicrographName", how="anti"))
+        self.assertEqual(anti["MicrographName"].tolist(), ["missing.mrc"])
+        anti = self.result(self.tab.join(picks, "MicrographName", how="anti"))
+        self.assert_rows(anti, self.df.iloc[1::2].reset_index(drop=True))
+
+    def test_join_conflicts(self):
+        picks = self.picks()
+        joined = self.frame(picks.join(self.tab, "MicrographName", conflicts="right"))
+        expected = self.df["DefocusU"][::2].tolist() * 2
+        self.assertEqual(joined["DefocusU"].tolist(), expected)
+        joined = self.frame(picks.join(self.tab, "MicrographName", conflicts="suffix"))
+        self.assertEqual(joined.columns[-1], "CtfMaxResolution")
+        self.assertEqual(joined["DefocusU"].unique().tolist(), [0.0])
+        self.assertEqual(joined["DefocusU_2"].tolist(), expected)
+        with self.assertRaises(ValueError):
+            picks.join(self.tab, "MicrographName", conflicts="error")
+
+    def test_join_errors(self):
+        with self.assertRaises(ValueError):
+            self.tab.join(self.picks(), "MicrographName", how="outer")
+        with self.assertRaises(KeyError):
+            self.tab.join(self.picks(), "ImageName")
+
+    def test_join_store(self):
+        self.tab.join(self.picks(), "MicrographName", store=True)
+        self.assertEqual(self.tab.get_columns()[-1], "CoordinateX")
+        self.assertIn("_rlnCoordinateX #10", self.tab.labels)
+        self.assertEqual(len(self.frame(self.tab)), 4500)
+
+    def test_lookup(self):
+        index = self.tab.create_index("MicrographName")
+        self.assertIsInstance(index, star_parser.HashIndex)
+        name = self.df["MicrographName"][2345]
+        found = self.tab.lookup("MicrographName", [name, "x.mrc"])
+        self.assert_rows(found, self.df.loc[[2345]])
+        self.assertEqual(len(self.tab.lookup("MicrographName", "x.mrc")), 0)
+
+    def test_lookup_range(self):
+        index = self.tab.create_index("_rlnDefocusU")
+        self.assertIsInstance(index, star_parser.SortedIndex)
+        defocus = self.df["DefocusU"]
+        low, high = defocus.quantile([0.25, 0.5])
+        expected = self.df[(defocus >= low) & (defocus <= high)]
+        self.assert_rows(self.tab.lookup_range("DefocusU", low, high), expected)
+        found = self.tab.lookup("DefocusU", defocus[3])
+        self.assert_rows(found, self.df[defocus == defocus[3]])
+
+    def test_lookup_without_index(self):
+        defocus = self.df["DefocusU"]
+        found = self.tab.lookup("DefocusU", lambda values: values > 30000)
+        self.assert_rows(found, self.df[defocus > 30000])
+        found = self.tab.lookup_range("DefocusU", high=5000)
+        self.assert_rows(found, self.df[defocus <= 5000])
+
+    def test_create_index_kind(self):
+        self.assertIsInstance(
+            self.tab.create_index("DefocusU", kind="hash"), star_parser.HashIndex
+        )
+        with self.assertRaises(ValueError):
+            self.tab.create_index("DefocusV", kind="btree")
+
+    def test_indexes_follow_column_methods(self):
+        self.tab.create_index("MicrographName")
+        self.tab.create_index("DefocusU")
+        name = self.df["MicrographName"][7]
+        self.tab.add_prefix_to_column("x/", "MicrographName", store=True)
+        self.assertEqual(len(self.tab.lookup("MicrographName", name)), 0)
+        found = self.tab.lookup("MicrographName", "x/" + name)
+        self.assertEqual(found.index.tolist(), [7])
+        self.tab.rename_columns(["DefocusU"], ["DefocusX"], store=True)
+        found = self.tab.lookup("DefocusX", self.df["DefocusU"][3])
+        self.assertEqual(found.index.tolist(), [3])
+        self.tab.remove_columns(["MicrographName"], store=True)
+        self.assertEqual(list(self.tab._check_indexes()), ["DefocusX"])
+        self.tab.fill_column("DefocusX", "1.0", overwrite=True, store=True)
+        self.assertEqual(len(self.tab.lookup("DefocusX", "1.0")), 4500)
+
+    def changed(self):
+        # self.df without rows 3 and 10, with new DefocusU in rows 6 and 7 (by
+        # 0.5 and 5.0) and CtfImage in row 7, and a row added, as a table
+        new = self.df.drop(index=[3, 10]).reset_index(drop=True)
+        new.loc[5, "DefocusU"] += 0.5
+        new.loc[6, "DefocusU"] += 5.0
+        new["CtfImage"] = new["CtfImage"].astype(object)  # was categorical
+        new.loc[6, "CtfImage"] = "changed.ctf"
+        new.loc[len(new)] = self.df.loc[0].copy()
+        new.loc[len(new) - 1, "MicrographName"] = "added.mrc"
+        return StarTabDf(new)
+
+    def test_diff(self):
+        diff = self.tab.diff(self.changed(), "MicrographName", tolerance=1)
+        self.assertEqual(list(diff), ["added", "removed", "changed"])
+        added = self.frame(diff["added"])
+        self.assertEqual(added["MicrographName"].tolist(), ["added.mrc"])
+        self.assert_rows(diff["removed"], self.df.loc[[3, 10]].reset_index(drop=True))
+
+    def test_diff_changed(self):
+        diff = self.tab.diff(self.changed(), "MicrographName", tolerance=1)
+        changed = self.frame(diff["changed"])
+        name = self.df["MicrographName"][7]
+        self.assertEqual(changed["MicrographName"].tolist(), [name])
+        old = ["CtfImage_old", "DefocusU_old"]
+        self.assertEqual(changed.columns[-2:].tolist(), old)
+        self.assertEqual(changed["DefocusU_old"][0], self.df["DefocusU"][7])
+        self.assertIn("_rlnDefocusU_old #11", diff["changed"].labels)
+
+    def test_diff_columns(self):
+        diff = self.tab.diff(self.changed(), "MicrographName", ["DefocusU"])
+        self.assertEqual(len(self.frame(diff["changed"])), 2)
+
+    def test_diff_without_key(self):
+        # rows are paired by their values
+        diff = self.tab.diff(self.changed())
+        self.assertEqual([len(self.frame(diff[k])) for k in diff], [3, 4, 0])
+
+    def test_diff_repeated_keys(self):
+        # rows with the same key pair in order
+        twice = StarTabDf(pd.concat([self.df, self.df], ignore_index=True))
+        diff = twice.diff(self.tab, "MicrographName")
+        self.assertEqual([len(self.frame(diff[k])) for k in diff], [0, 4500, 0])
+
+    def selection(self):
+        # every ninth micrograph, and the rows of self.df that have them
+        keys = self.df["MicrographName"][::9]
+        rows = self.df[self.df["MicrographName"].isin(keys)]
+        return keys, rows.reset_index(drop=True)
+
+    def test_select(self):
+        keys, expected = self.selection()
+        self.assert_rows(self.result(self.tab.select("MicrographName", keys)), expected)
+
+    def test_select_key_set(self):
+        keys, expected = self.selection()
+        selected = self.tab.select("_rlnMicrographName", star_parser.KeySet(keys))
+        self.assert_rows(selected, expected)
+
+    def test_select_tab(self):
+        keys, expected = self.selection()
+        picks = StarTabDf(pd.DataFrame({"MicrographName": keys.astype(object)}))
+        self.assert_rows(self.tab.select("MicrographName", picks), expected)
+
+    def test_select_exclude(self):
+        keys, _ = self.selection()
+        excluded = self.tab.select("MicrographName", keys, exclude=True)
+        rows = self.df[~self.df["MicrographName"].isin(keys)]
+        self.assert_rows(excluded, rows.reset_index(drop=True))
+        selected = self.tab.select("MicrographName", ~star_parser.KeySet(keys))
+        self.assert_rows(selected, rows.reset_index(drop=True))
+
+    def test_select_store(self):
+        keys, expected = self.selection()
+        self.tab.create_index("DefocusU")
+        self.tab.select("MicrographName", keys, store=True)
+        self.assert_rows(self.tab, expected)
+        self.assertEqual(len(self.tab.lookup_range("DefocusU", 0, 1e6)), 500)
+
+    def assert_sorted(self, columns, ascending):
+        names = self.tab._resolve_columns(columns)
+        expected = _plain(self.df).sort_values(
+            names, ascending=ascending, kind="stable"
+        )
+        sorted_tab = self.result(self.tab.sort_by(columns, ascending))
+        self.assert_rows(sorted_tab, expected.reset_index(drop=True))
+
+    def test_sort_by(self):
+        self.assert_sorted("DefocusU", True)
+        self.assert_sorted("_rlnDefocusU", False)
+
+    def test_sort_by_text(self):
+        self.assert_sorted("MicrographName", False)
+        self.assert_sorted("CtfImage", True)
+
+    def test_sort_by_columns(self):
+        self.assert_sorted(["CtfImage", "DefocusU"], True)
+        self.assert_sorted(["OpticsGroup", "CtfImage"], False)
+        self.assert_sorted(["_rlnOpticsGroup", "DefocusV"], [True, False])
+
+    def test_sort_by_errors(self):
+        with self.assertRaises(ValueError):
+            self.tab.sort_by(["DefocusU", "DefocusV"], [True])
+        with self.assertRaises(KeyError):
+            self.tab.sort_by("ImageName")
+
+    def test_sort_by_store(self):
+        self.tab.sort_by("DefocusU", store=True)
+        self.assertTrue(self.frame(self.tab)["DefocusU"].is_monotonic_increasing)
+
+    def transform(self):
+        # DefocusU and DefocusV taken as coordinates: swapped, y flipped in 30000,
+        # and the particles outside 40000 by 30000, with DefocusU above 30000,
+        # dropped
+        transform = CoordTransform().swap().flip(y=True, height=30000)
+        return transform.within(0, 40000, 30000)
+
+    def transformed(self):
+        x, y = self.df["DefocusV"], 30000 - self.df["DefocusU"]
+        keep = (x >= 0) & (x <= 40000) & (y >= 0) & (y <= 30000)
+        return self.df.assign(DefocusU=x, DefocusV=y)[keep].reset_index(drop=True)
+
+    def test_transform_coords(self):
+        moved = self.tab.transform_coords(self.transform(), "DefocusU", "DefocusV")
+        self.assert_rows(self.result(moved), self.transformed())
+        self.assertLess(len(self.frame(moved)), len(self.df))
+        self.assert_rows(self.tab, self.df)
+
+    def test_transform_coords_store(self):
+        self.tab.create_index("MicrographName")
+        transform = self.transform()
+        self.tab.transform_coords(transform, "_rlnDefocusU", "DefocusV", store=True)
+        self.assert_rows(self.tab, self.transformed())
+        dropped = self.df["MicrographName"][self.df["DefocusU"] > 30000].iloc[0]
+        self.assertEqual(len(self.tab.lookup("MicrographName", dropped)), 0)
+
+    def test_transform_coords_missing_size(self):
+        with self.assertRaises(KeyError):
+            transform = CoordTransform().scale("Width")
+            self.tab.transform_coords(transform, "DefocusU", "DefocusV")
+
+
+class testStarTab(_TableTests, unittest.TestCase):
+    returns = pd.DataFrame
 
-class testStarTab(unittest.TestCase):
     def setUp(self):
         working_dir = Path(os.path.abspath(__file__)).parent
         self.starfile = working_dir / "static/micrographs_ctf.star"
@@ -17,6 +314,8 @@ class testStarTab(unittest.TestCase):
         self.tabs = self.parser.parse()
         self.first_tab = self.tabs["data_optics"]
         self.data_tab = self.tabs["data_micrographs"]
+        self.tab = self.data_tab
+        self.df = self.tab.to_df().copy()
 
     def test_trim_column_values(self):
         # first line of 'MicrographName' is
@@ -267,12 +566,17 @@ class testStarTab(unittest.TestCase):
     def test_fill_column_single_value(self):
         # not permanent
         res = self.first_tab.fill_column("OpticsGroup", "2", overwrite=True)
-        self.assertEqual(res["OpticsGroup"][0], "2")
-        self.assertEqual(self.first_tab.df["OpticsGroup"][0], "1")
+        self.assertEqual(res["OpticsGroup"][0], 2)
+        self.assertEqual(self.first_tab.df["OpticsGroup"][0], 1)
         # permanent
         res = self.first_tab.fill_column("OpticsGroup", "2", overwrite=True, store=True)
-        self.assertEqual(res["OpticsGroup"][0], "2")
-        self.assertEqual(self.first_tab.df["OpticsGroup"][0], "2")
+        self.assertEqual(res["OpticsGroup"][0], 2)
+        self.assertEqual(self.first_tab.df["OpticsGroup"][0], 2)
+        self.assertEqual(self.first_tab.df["OpticsGroup"].dtype, "int32")
+
+    def test_fill_column_untyped_value(self):
+        res = self.first_tab.fill_column("OpticsGroup", "two", overwrite=True)
+        self.assertEqual(res["OpticsGroup"][0], "two")
 
     def test_fill_column_create_false(self):
         with self.assertRaises(ValueError):
@@ -312,7 +616,7 @@ class testStarTab(unittest.TestCase):
         # non permanent
         res = self.first_tab.add_prefix_to_column("vaffa", "OpticsGroup")
         self.assertEqual(res["OpticsGroup"][0], "vaffa1")
-        self.assertEqual(self.first_tab.df["OpticsGroup"][0], "1")
+        self.assertEqual(self.first_tab.df["OpticsGroup"][0], 1)
         # permanent
         res = self.first_tab.add_prefix_to_column("vaffa", "OpticsGroup", store=True)
         self.assertEqual(res["OpticsGroup"][0], "vaffa1")
@@ -407,6 +711,348 @@ class testStarTab(unittest.TestCase):
         with self.assertRaises(AssertionError):
             self.data_tab.apply_regex_to_column(regex, pattern, column, store=True)
 
+    def test_string_transforms_run_once_per_value(self):
+        names = ["J2/mic_a.mrc", "J2/mic_b.mrc", "J4/mic_c.mrc"] * 1000
+        series = pd.Series(names, dtype="category")
+        calls = []
+
+        def transform(value):
+            calls.append(value)
+            return value.upper()
+
+        res = star_parser._map_distinct(series, transform)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(res.dtype, "category")
+        self.assertEqual(res[3000 - 1], "J4/MIC_C.MRC")
+
+    def test_string_transforms_merge_values(self):
+        series = pd.Series(["J2/a.mrc", "J4/a.mrc", "J4/b.mrc"], dtype="category")
+        res = star_parser._map_distinct(series, lambda value: value[3:])
+        self.assertEqual(list(res), ["a.mrc", "a.mrc", "b.mrc"])
+        self.assertEqual(list(res.cat.categories), ["a.mrc", "b.mrc"])
+        self.assertEqual(list(res.cat.codes), [0, 0, 1])
+
+    def test_string_transforms_keep_plain_strings(self):
+        tab = StarTabDf(pd.DataFrame({"ImageName": ["1@a.mrcs", "2@a.mrcs"]}))
+        res = tab.add_prefix_to_column("Extract/", "ImageName")
+        self.assertNotEqual(res["ImageName"].dtype, "category")
+        self.assertEqual(list(res["ImageName"]), ["Extract/1@a.mrcs", "Extract/2@a.mrcs"])
+
+    def test_store_edits_do_not_remake_rows(self):
+        calls = []
+        update_body = self.data_tab._update_body
+        self.data_tab._update_body = lambda df: calls.append(1) or update_body(df)
+        self.data_tab.remove_columns(["CtfFigureOfMerit"], store=True)
+        self.data_tab.fill_column("OpticsGroup", 2, overwrite=True, store=True)
+        self.data_tab.add_prefix_to_column("J2/", "MicrographName", store=True)
+        star = self.data_tab.to_star()
+        self.assertEqual(calls, [])
+        self.assertNotIn("_rlnCtfFigureOfMerit", star)
+        self.assertTrue(self.data_tab.body[0][0].startswith("J2/"))
+        self.data_tab.body
+        self.assertEqual(len(calls), 1)
+
+    def test_to_star_follows_dataframe(self):
+        self.data_tab.to_star()
+        self.data_tab.df.rename(columns={"DefocusU": "DefocusV2"}, inplace=True)
+        self.data_tab.df = self.data_tab.df.head(2)
+        star = self.data_tab.to_star()
+        self.assertIn("_rlnDefocusV2 #", star)
+        self.assertEqual(len(self.data_tab.body), 2)
+
+    def test_previews_share_unchanged_columns(self):
+        df = self.data_tab.to_df()
+        defocus = df["DefocusU"].to_numpy().copy()
+        previews = [
+            self.data_tab.add_prefix_to_column("J2/", "MicrographName"),
+            self.data_tab.trim_column_values("MicrographName", start=3),
+            self.data_tab.fill_column(["OpticsGroup", "DefocusV"], 2, overwrite=True),
+            self.data_tab.substitute_columns(df[["DefocusU"]] * 2),
+        ]
+        # only with copy-on-write, where writes into a preview do not reach df
+        for preview in previews[:3]:
+            shared = np.shares_memory(
+                preview["DefocusU"].to_numpy(), df["DefocusU"].to_numpy()
+            )
+            self.assertEqual(shared, star_parser._copy_on_write())
+        self.assertNotEqual(previews[0]["MicrographName"][0], df["MicrographName"][0])
+        # the table is not changed through the shared memory
+        self.assertIs(self.data_tab.to_df(), df)
+        self.assertTrue((df["OpticsGroup"] == 1).all())
+        self.assertFalse((df["DefocusV"] == 2).any())
+        np.testing.assert_array_equal(df["DefocusU"].to_numpy(), defocus)
+        np.testing.assert_array_equal(previews[3]["DefocusU"].to_numpy(), defocus * 2)
+
+    def test_writes_into_previews_do_not_reach_the_table(self):
+        df = self.data_tab.to_df()
+        expected = df.copy()
+        previews = [
+            self.data_tab.add_prefix_to_column("J2/", "MicrographName"),
+            self.data_tab.fill_column("DefocusV", 2.0, overwrite=True),
+            self.data_tab.substitute_columns(df[["DefocusV"]] * 2),
+            self.data_tab.remove_columns(["DefocusV"]),
+            self.data_tab.reorder_columns(list(reversed(df.columns))),
+            self.data_tab.rename_columns(["DefocusV"], ["DefocusX"]),
+        ]
+        for preview in previews:
+            preview.loc[0, "DefocusU"] = -1.0
+            preview["DefocusU"] *= 2
+            preview.loc[1, "MicrographName"] = preview["MicrographName"][2]
+        self.assertIs(self.data_tab.to_df(), df)
+        pd.testing.assert_frame_equal(df, expected)
+
+    def test_join_missing_keys(self):
+        names = pd.Series(["a.mrc", None, np.nan], dtype=object)
+        left = StarTabDf(pd.DataFrame({"MicrographName": names, "DefocusU": 1.0}))
+        names = pd.Series([None, "a.mrc"], dtype=object)
+        right = StarTabDf(
+            pd.DataFrame({"MicrographName": names, "CoordinateX": [1.0, 2.0]})
+        )
+        joined = left.join(right, "MicrographName", how="left")
+        self.assertEqual(joined["CoordinateX"].tolist()[0], 2.0)
+        self.assertTrue(joined["CoordinateX"][1:].isna().all())
+        self.assertEqual(len(left.join(right, "MicrographName", how="anti")), 2)
+
+    def test_sort_by_missing_values(self):
+        # numbers by value and missing values last, either way
+        values = {"a": [3, -1.5, np.nan, 0, -7, np.inf], "b": list("CbAaBc")}
+        tab = StarTabDf(pd.DataFrame(values))
+        self.assertEqual(
+            tab.sort_by("a")["a"].tolist()[:-1], [-7.0, -1.5, 0.0, 3.0, np.inf]
+        )
+        self.assertTrue(np.isnan(tab.sort_by("a", False)["a"].tolist()[-1]))
+        self.assertEqual(tab.sort_by("b")["b"].tolist(), list("ABCabc"))
+
+    def test_indexes_follow_df(self):
+        tab = self.data_tab
+        df = tab.to_df()
+        name = df["MicrographName"][7]
+        tab.create_index("MicrographName")
+        index = tab.create_index("DefocusU")
+        tab.df["MicrographName"] = "x/" + df["MicrographName"].astype(str)
+        found = tab.lookup("MicrographName", "x/" + name)
+        self.assertEqual(found.index.tolist(), [7])
+        # the same values elsewhere keep the index
+        tab.df = tab.df.copy()
+        self.assertIs(tab._check_indexes()["DefocusU"].order, index.order)
+        tab.df = tab.df.iloc[::-1].reset_index(drop=True)
+        value = df["DefocusU"][3]
+        found = tab.lookup("DefocusU", value)
+        expected = np.flatnonzero(tab.df["DefocusU"].to_numpy() == value)
+        self.assertEqual(found.index.tolist(), expected.tolist())
+
+    def test_hash_index_collisions(self):
+        key_hashes = star_parser._key_hashes
+
+        def few_hashes(df, on):
+            hashes, missing = key_hashes(df, on)
+            return hashes % 2, missing
+
+        values = pd.Series(["a", "b", "c", "a", "d", "c"])
+        star_parser._key_hashes = few_hashes
+        try:
+            index = star_parser.HashIndex(values)
+            # different values with one hash do not follow each other's rows
+            updated = index.updated(values.map(lambda value: "x" + value), True)
+            for value in "abcd":
+                expected = np.flatnonzero(values == value).tolist()
+                self.assertEqual(index.rows(value).tolist(), expected)
+                self.assertEqual(updated.rows("x" + value).tolist(), expected)
+        finally:
+            star_parser._key_hashes = key_hashes
+
+    def test_split_by(self):
+        df = pd.DataFrame(
+            {
+                "CoordinateX": [1.0, 2.0, 3.0, 4.0],
+                "MicrographName": ["J2/a.mrc", "J2/b.mrc", "J2/a.mrc", "J2/c.mrc"],
+            }
+        )
+        tab = StarTabDf(df)
+        with tempfile.TemporaryDirectory() as d:
+            paths = tab.split_by("MicrographName", d, workers=2)
+            self.assertEqual([p.name for p in paths], ["a.star", "b.star", "c.star"])
+            a = StarParser(paths[0]).parse()["data_"].to_df()
+            self.assertEqual(list(a["CoordinateX"]), [1.0, 3.0])
+            self.assertEqual(list(a["MicrographName"]), ["J2/a.mrc", "J2/a.mrc"])
+            self.assertEqual(paths[1].read_text(), StarTabDf(df.iloc[[1]]).to_star())
+            texts = [p.read_text() for p in paths]
+            rows = star_parser._WRITE_ROWS
+            star_parser._WRITE_ROWS = 1  # every group written on its own
+            try:
+                paths = tab.split_by("MicrographName", d)
+            finally:
+                star_parser._WRITE_ROWS = rows
+            self.assertEqual([p.read_text() for p in paths], texts)
+
+    def test_split_by_for_cryolo(self):
+        tab = StarTabDf(
+            pd.DataFrame({"CoordinateX": [1.0, 2.0], "MicrographName": ["a", "b"]})
+        )
+        with tempfile.TemporaryDirectory() as d:
+            paths = tab.split_by(
+                "MicrographName",
+                Path(d) / "split",
+                name_map={"a": "first.star", "b": "second.star"},
+                drop_column=True,
+                strip_header=True,
+            )
+            lines = paths[1].read_text().split("\n")
+        self.assertEqual([p.name for p in paths], ["first.star", "second.star"])
+        self.assertEqual(lines[:2], ["_rlnCoordinateX #1", "    2.000000 "])
+
+    def test_split_by_errors(self):
+        tab = StarTabDf(pd.DataFrame({"MicrographName": ["x/a.mrc", "y/a.mrc"]}))
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaises(AttributeError):
+                tab.split_by("ImageName", d)
+            with self.assertRaises(ValueError):
+                tab.split_by("MicrographName", d)
+
+
+class testStarTabDisk(_TableTests, unittest.TestCase):
+    returns = star_parser.StarTabDisk
+
+    def setUp(self):
+        working_dir = Path(os.path.abspath(__file__)).parent
+        self.starfile = working_dir / "static/micrographs_ctf.star"
+        self.directory = tempfile.TemporaryDirectory()
+        self.limit("_DISK_ROWS", 1000)  # several chunks per table
+        self.limit("_SORT_ROWS", 700)  # sort_by merges runs from disk
+        parser = StarParser(self.starfile, create=False)
+        self.tabs = parser.parse(memmap=self.directory.name)
+        self.tab = self.tabs["data_micrographs"]
+        self.in_memory = StarParser(self.starfile, create=False).parse()
+        self.df = self.in_memory["data_micrographs"].to_df()
+
+    def tearDown(self):
+        del self.tabs, self.tab
+        self.directory.cleanup()
+
+    def test_parse(self):
+        self.assertIsInstance(self.tab, star_parser.StarTabDisk)
+        for name, tab in self.in_memory.items():
+            pd.testing.assert_frame_equal(self.tabs[name].to_df(), tab.to_df())
+            self.assertEqual(self.tabs[name].to_star(), tab.to_star())
+        chunks = list(self.tab.iter_chunks(columns=["DefocusU"]))
+        self.assertEqual([len(c) for c in chunks], [1000] * 4 + [500])
+        self.assertEqual(chunks[-1].index[0], 4000)
+
+    def test_body(self):
+        with self.assertRaises(ValueError):
+            self.tab.body
+        with self.assertRaises(ValueError):
+            self.tab.body = [["a.mrc"]]
+
+    def test_column_methods(self):
+        expected = self.in_memory["data_micrographs"]
+        calls = [
+            ("keep_only_columns", ["MicrographName", "DefocusU"]),
+            ("remove_columns", ["DefocusU"]),
+            ("fill_column", "Voltage", 300.0, False, False, True),
+            ("fill_column", "OpticsGroup", 2, True),
+            ("add_prefix_to_column", "x/", "MicrographName"),
+            ("trim_column_values", "MicrographName", 1, 9),
+            ("rename_columns", ["DefocusU"], ["DefocusX"]),
+            ("reorder_columns", list(reversed(expected.columns()))),
+        ]
+        for method, *arguments in calls:
+            result = getattr(self.tab, method)(*arguments)
+            self.assertIsInstance(result, star_parser.StarTabDisk)
+            pd.testing.assert_frame_equal(
+                result.to_df(), getattr(expected, method)(*arguments)
+            )
+        pd.testing.assert_frame_equal(self.tab.to_df(), expected.to_df())
+
+    def test_store_shares_columns(self):
+        files = len(os.listdir(self.directory.name))
+        preview = self.tab.fill_column("CtfImage", "a.ctf", overwrite=True)
+        self.assertEqual(len(os.listdir(self.directory.name)), files + 1)
+        self.tab.rename_columns(["DefocusU"], ["DefocusX"], store=True)
+        self.assertIn("_rlnDefocusX #4", self.tab.labels)
+        self.assertIn("DefocusU", preview.columns())
+        del preview  # its one new column is removed with it
+        self.assertEqual(len(os.listdir(self.directory.name)), files)
+
+    def test_join_partitions(self):
+        self.limit("_JOIN_ROWS", 500)
+        picks = self.picks()
+        for how in ["inner", "left", "anti"]:
+            joined = self.result(self.tab.join(picks, "MicrographName", how=how))
+            expected = self.in_memory["data_micrographs"].join(
+                picks, "MicrographName", how=how
+            )
+            # the rows come a partition at a time
+            joined, expected = (
+                _plain(df).sort_values(list(df.columns)).reset_index(drop=True)
+                for df in [joined, expected]
+            )
+            self.assert_rows(joined, expected)
+
+    def test_diff_of_tables_on_disk(self):
+        expected = self.in_memory["data_micrographs"]
+        tab = StarParser(self.starfile, create=False).parse(memmap=self.directory.name)
+        tab = tab["data_micrographs"]
+        tab.fill_column("DefocusV", 1.0, overwrite=True, store=True)
+        tab.remove_columns(["CtfImage"], store=True)
+        diff = self.tab.diff(tab, "MicrographName")
+        self.assertEqual([len(diff[k].df) for k in diff], [0, 0, 4500])
+        self.assertEqual(diff["changed"].df["DefocusV"].unique().tolist(), [1.0])
+        pd.testing.assert_series_equal(
+            diff["changed"].df["DefocusV_old"],
+            expected.to_df()["DefocusV"].rename("DefocusV_old"),
+            check_dtype=False,
+        )
+
+    def test_values_that_do_not_match_labels(self):
+        star = Path(self.directory.name) / "mixed.star"
+        rows = "\n".join(f"a{i}.mrc {i} {'x' if i == 1500 else i}" for i in range(2000))
+        star.write_text(
+            "data_\n\nloop_\n_rlnMicrographName\n_rlnOpticsGroup\n_rlnDefocusU\n"
+            + rows
+        )
+        tab = StarParser(star, create=False).parse(memmap=self.directory.name)
+        df = tab["data_"].to_df()
+        self.assertEqual(df["OpticsGroup"].dtype, np.int32)
+        self.assertEqual(df["DefocusU"].dtype, object)
+        self.assertEqual(df["DefocusU"][1500], "x")
+
+
+class testKeySet(unittest.TestCase):
+    def setUp(self):
+        self.names = pd.Series([f"{i:06d}@Extract/stack.mrcs" for i in range(1, 5001)])
+
+    def test_select(self):
+        keys = self.names[::4]
+        for bloom in [False, True]:
+            key_set = star_parser.KeySet(keys, bloom=bloom)
+            self.assertEqual(len(key_set), 1250)
+            selected = key_set(self.names)
+            self.assertTrue(selected.equals(self.names.isin(keys)))
+            self.assertTrue((~key_set)(self.names).equals(~selected))
+        categories = self.names.astype("category")
+        self.assertTrue(key_set(categories).equals(selected))
+        self.assertEqual(star_parser.KeySet([1, 2.0])([1.0, 2, 3]).tolist(), [1, 1, 0])
+        self.assertFalse(star_parser.KeySet([])(self.names).any())
+
+    def test_from_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            text = Path(d) / "keys.txt"
+            text.write_text("3\n\n 5\n")
+            key_set = star_parser.KeySet.from_text(text)
+            self.assertEqual(key_set(pd.Series([3.0, 4.0, 5.0])).tolist(), [1, 0, 1])
+            cs = Path(d) / "particles.cs"
+            fields = [("uid", "<u8"), ("blob/path", "S22"), ("blob/idx", "<u4")]
+            array = np.zeros(3, dtype=fields)
+            array["blob/path"] = b"Extract/stack.mrcs"
+            array["blob/idx"] = [0, 9, 4]
+            with open(cs, "wb") as f:
+                np.save(f, array)
+            key_set = star_parser.KeySet.from_cs(cs, "ImageName")
+            self.assertEqual(list(self.names[key_set(self.names)].index), [0, 4, 9])
+            with self.assertRaises(KeyError):
+                star_parser.KeySet.from_cs(cs, "MicrographName")
+
 
 class testStarGeneralTab(unittest.TestCase):
     def setUp(self):
@@ -482,6 +1128,772 @@ class testStarGeneralTab(unittest.TestCase):
         self.maxDiff = None
         self.assertEqual(res, exp)
 
+class testStarParser(unittest.TestCase):
+    def setUp(self):
+        working_dir = Path(os.path.abspath(__file__)).parent
+        self.starfile = working_dir / "static/micrographs_ctf.star"
+        self.parser = StarParser(self.starfile)
+
+    def test_parse_keeps_no_blob(self):
+        tabs = self.parser.parse()
+        self.assertFalse(hasattr(self.parser, "blob"))
+        # rows are only kept in the dataframe
+        self.assertIsNone(tabs["data_micrographs"]._body)
+        self.assertEqual(tabs["data_micrographs"].to_df().shape, (4500, 9))
+
+    def test_parse_streaming_matches_blob(self):
+        streamed = self.parser.parse()["data_micrographs"].to_df()
+        blob = self.parser.read_file(self.starfile)
+        from_blob = self.parser.parse(file_blob=blob)["data_micrographs"].to_df()
+        self.assertTrue(streamed.equals(from_blob))
+
+    def test_parse_empty_loop(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "empty.star"
+            star.write_text("data_particles\n\nloop_\n_rlnCoordinateX #1\n")
+            tabs = StarParser(star).parse()
+        self.assertEqual(list(tabs["data_particles"].to_df().columns), ["CoordinateX"])
+        self.assertEqual(len(tabs["data_particles"].to_df()), 0)
+
+    def test_loop_blocks_across_chunks(self):
+        text = b"loop_\n_rlnA #1\n 1 a\n2 b\n  3 c\n  \ndata_next\n"
+        for chunk_size in [1, 2, 3, 5, 8, 64]:
+            with tempfile.TemporaryFile() as f:
+                f.write(text)
+                f.seek(0)
+                stream = _StarStream(f, chunk_size=chunk_size)
+                stream.readline()
+                stream.readline()
+                data = b"".join(stream.iter_loop())
+                # empty lines are left to the C reader
+                self.assertEqual(data, b" 1 a\n2 b\n  3 c\n  \n")
+                self.assertEqual(stream.readline(), b"data_next\n")
+
+    def test_parse_last_line_without_newline(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "short.star"
+            star.write_text("data_\nloop_\n_rlnA #1\n_rlnB #2\n1 2\n3 4")
+            df = StarParser(star).parse()["data_"].to_df()
+        self.assertEqual(df.values.tolist(), [["1", "2"], ["3", "4"]])
+
+    def test_parse_requested_tabs(self):
+        tabs = self.parser.parse(tabs="data_optics")
+        self.assertEqual(list(tabs), ["data_optics"])
+        self.assertEqual(list(self.parser.tabs), ["data_optics"])
+        self.assertEqual(tabs["data_optics"].to_df()["OpticsGroup"][0], 1)
+        # the scan stopped after the requested table
+        self.assertNotIn("data_micrographs", self.parser.blocks)
+        tabs = self.parser.parse(tabs=["data_micrographs"])
+        self.assertEqual(tabs["data_micrographs"].to_df().shape, (4500, 9))
+        self.assertEqual(list(self.parser.tabs), ["data_optics", "data_micrographs"])
+
+    def test_parse_missing_tab(self):
+        with self.assertRaises(KeyError):
+            self.parser.parse(tabs="data_particles")
+        # again, once the whole file is indexed
+        with self.assertRaises(KeyError):
+            self.parser.parse(tabs="data_particles")
+
+    def test_index(self):
+        blocks = self.parser.index()
+        self.assertEqual(list(blocks), ["data_optics", "data_micrographs"])
+        micrographs = blocks["data_micrographs"]
+        self.assertEqual(micrographs.version, "# version 30001")
+        self.assertEqual(micrographs.header[1], "_rlnMicrographName #1")
+        with open(self.starfile, "rb") as f:
+            f.seek(micrographs.start)
+            self.assertTrue(f.readline().startswith(b"# version"))
+            f.seek(micrographs.data_start)
+            self.assertTrue(f.readline().startswith(b"MotionCorr/job017"))
+        self.assertEqual(micrographs.end, self.starfile.stat().st_size)
+
+    def test_parse_indexed_tab_is_read_directly(self):
+        starfile = self.starfile.parent / "run_it025_model.star"
+        parser = StarParser(starfile)
+        parser.index()
+        tabs = parser.parse(tabs=["data_model_class_2", "data_model_general"])
+        expected = StarParser(starfile).parse()
+        for name, tab in tabs.items():
+            self.assertEqual(tab.labels, expected[name].labels)
+        self.assertTrue(
+            tabs["data_model_class_2"]
+            .to_df()
+            .equals(expected["data_model_class_2"].to_df())
+        )
+
+    def test_write_out_after_partial_parse(self):
+        self.parser.parse(tabs="data_micrographs")
+        res = self.parser.write_out()
+        # all tables, copied from the unchanged file
+        self.assertEqual(res, self.starfile.read_text())
+
+    def test_parse_columns(self):
+        columns = ["CtfMaxResolution", "_rlnMicrographName", "DefocusU"]
+        tabs = self.parser.parse(tabs="data_micrographs", columns=columns)
+        tab = tabs["data_micrographs"]
+        # file order is kept
+        exp = ["MicrographName", "DefocusU", "CtfMaxResolution"]
+        self.assertEqual(list(tab.to_df().columns), exp)
+        self.assertEqual(tab.columns(), exp)
+        labels = [f"_rln{c} #{i + 1}" for i, c in enumerate(exp)]
+        self.assertEqual(tab.labels[1:], labels)
+        self.assertEqual(tab.to_df()["DefocusU"][0], 10582.780273)
+
+    def test_parse_columns_by_tab(self):
+        columns = {"data_micrographs": ["MicrographName"]}
+        tabs = self.parser.parse(columns=columns)
+        self.assertEqual(tabs["data_micrographs"].columns(), ["MicrographName"])
+        self.assertEqual(len(tabs["data_optics"].columns()), 8)
+
+    def test_parse_columns_of_some_tabs(self):
+        # data_optics lacks them and is read whole
+        tabs = self.parser.parse(columns=["MicrographName", "DefocusU"])
+        micrographs = tabs["data_micrographs"]
+        self.assertEqual(micrographs.columns(), ["MicrographName", "DefocusU"])
+        self.assertEqual(len(tabs["data_optics"].columns()), 8)
+
+    def test_parse_missing_columns(self):
+        with self.assertRaises(KeyError):
+            self.parser.parse(tabs="data_micrographs", columns=["NotAColumn"])
+        with self.assertRaises(KeyError):
+            self.parser.parse(columns=["NotAColumn"])
+        with self.assertRaises(KeyError):
+            self.parser.parse(columns={"data_optics": ["MicrographName"]})
+
+    def test_parse_where_key_set(self):
+        df = StarParser(self.starfile, create=False).parse()["data_micrographs"].df
+        keys = star_parser.KeySet(df["MicrographName"][:100])
+        parser = StarParser(self.starfile, create=False)
+        where = {"data_micrographs": {"MicrographName": keys}}
+        tab = parser.parse(where=where)["data_micrographs"]
+        pd.testing.assert_frame_equal(tab.df, df[:100], check_categorical=False)
+        chunks = parser.iter_chunks("data_micrographs", where={"MicrographName": ~keys})
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 4400)
+
+    def test_parse_typed_columns(self):
+        df = self.parser.parse()["data_micrographs"].to_df()
+        self.assertEqual(df["MicrographName"].dtype, "category")
+        self.assertEqual(df["OpticsGroup"].dtype, "int32")
+        self.assertEqual(df["DefocusU"].dtype, "float64")
+        tabs = self.parser.parse(dtypes={"DefocusU": "float32"})
+        df = tabs["data_micrographs"].to_df()
+        self.assertEqual(df["DefocusU"].dtype, "float32")
+        df = self.parser.parse(typed=False)["data_micrographs"].to_df()
+        self.assertEqual(df["DefocusU"].dtype, object)
+
+    def test_parse_value_not_matching_type(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "odd.star"
+            star.write_text(
+                "data_\nloop_\n_rlnClassNumber #1\n_rlnDefocusU #2\n"
+                "1.0 1.5\n2.0 none\n"
+            )
+            df = StarParser(star).parse()["data_"].to_df()
+        self.assertEqual(df["ClassNumber"].dtype, "int32")
+        self.assertEqual(df["DefocusU"].tolist(), ["1.5", "none"])
+
+    def test_register_label_type(self):
+        star_parser.register_label_type("_rlnMicrographName", "float64")
+        try:
+            tabs = self.parser.parse(tabs="data_micrographs")
+        finally:
+            star_parser.register_label_type("MicrographName", "category")
+        # not numbers, left as strings
+        df = tabs["data_micrographs"].to_df()
+        self.assertEqual(df["MicrographName"].dtype, object)
+
+    def test_categorical_columns(self):
+        tab = self.parser.parse()["data_micrographs"]
+        names = tab.to_df()["MicrographName"]
+        self.assertEqual(len(names.cat.categories), 4500)
+        self.assertTrue(names.iloc[0].startswith("MotionCorr/job017/Micrographs/"))
+        groups = tab.to_df().groupby("MicrographName", observed=True)
+        self.assertEqual(len(groups), 4500)
+        res = tab.fill_column("MicrographName", "mic.mrc", overwrite=True, store=True)
+        self.assertEqual(res["MicrographName"].dtype, "category")
+        self.assertEqual(list(res["MicrographName"].cat.categories), ["mic.mrc"])
+        self.assertTrue(all(r[0] == "mic.mrc" for r in tab.body))
+
+    def test_typed_round_trip(self):
+        tabs = self.parser.parse()
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "copy.star"
+            self.parser.write_out(new_file=star)
+            copy = StarParser(star).parse()
+        for name, tab in tabs.items():
+            self.assertTrue(tab.to_df().equals(copy[name].to_df()))
+
+    def test_write_matches_relion_layout(self):
+        star = self.parser.parse()["data_micrographs"].to_star()
+        written = [l for l in star.split("\n") if l.startswith("MotionCorr")]
+        original = [
+            l for l in self.starfile.read_text().split("\n") if l.startswith("MotionCorr")
+        ]
+        # relion drops a digit of some small negative numbers, e.g. -0.00177
+        same = [i for i, l in enumerate(original) if " -" not in l]
+        self.assertGreater(len(same), 4000)
+        self.assertEqual([written[i] for i in same], [original[i] for i in same])
+
+    def test_write_field_widths(self):
+        df = pd.DataFrame({"DefocusU": [1.5, -123456.7], "ImageName": ["a", "b" * 15]})
+        rows = StarTabDf(df).to_star().split("\n")[-6:-4]
+        self.assertEqual(
+            rows, ["    1.500000            a ", "-1.234567e+05 bbbbbbbbbbbbbbb "]
+        )
+
+    def test_write_in_chunks(self):
+        tab = self.parser.parse()["data_micrographs"]
+        whole = tab.to_star()
+        rows = star_parser._WRITE_ROWS
+        star_parser._WRITE_ROWS = 7
+        try:
+            self.assertEqual(tab.to_star(), whole)
+        finally:
+            star_parser._WRITE_ROWS = rows
+
+    def test_float_fields(self):
+        values = pd.Series(
+            [0.0, -0.0, 1.5, -0.25, 0.0005, -123456.7, 100000.0, 1.0000005, float("nan")]
+        )
+        fields = star_parser._float_fields(values.to_numpy())
+        written = [bytes(f).decode() for f in fields]
+        self.assertEqual([w.strip() for w in written], star_parser._format_column(values))
+
+    def test_parse_parallel(self):
+        serial = self.parser.parse()
+        range_min = star_parser._RANGE_MIN
+        star_parser._RANGE_MIN = 1 << 16
+        try:
+            parser = StarParser(self.starfile)
+            parallel = parser.parse(workers=3)
+            block = parser.blocks["data_micrographs"]
+            ranges = star_parser._split_range(
+                self.starfile, block.data_start, block.end, 3
+            )
+            columns = {"data_micrographs": ["MicrographName", "DefocusU"]}
+            strings = StarParser(self.starfile).parse(
+                tabs="data_micrographs", columns=columns, typed=False, workers=3
+            )
+        finally:
+            star_parser._RANGE_MIN = range_min
+        self.assertEqual(len(ranges), 3)
+        text = self.starfile.read_bytes()
+        self.assertTrue(all(text[start - 1 : start] == b"\n" for start, _ in ranges))
+        for name, tab in serial.items():
+            self.assertTrue(tab.to_df().equals(parallel[name].to_df()))
+        df = strings["data_micrographs"].to_df()
+        self.assertEqual(list(df.dtypes), [object, object])
+        self.assertEqual(df["DefocusU"][0], "10582.780273")
+
+    def test_collate(self):
+        picks = [
+            pd.DataFrame({"CoordinateX": [1.0, 2.0], "ClassNumber": [1, 2]}),
+            pd.DataFrame({"CoordinateX": [], "ClassNumber": []}),
+            pd.DataFrame({"CoordinateX": [3.0], "AnglePsi": [90.0]}),
+        ]
+        with tempfile.TemporaryDirectory() as d:
+            for index, df in enumerate(picks):
+                star = Path(d) / f"mic_{index}.star"
+                star.write_text(StarTabDf(df).to_star())
+            tab = star_parser.collate(
+                Path(d) / "mic_*.star", file_column="MicrographName", workers=2
+            )
+            only_x = star_parser.collate(
+                Path(d) / "*.star", columns=["CoordinateX"], workers=1
+            )
+        df = tab.to_df()
+        self.assertEqual(
+            list(df.columns), ["MicrographName", "CoordinateX", "ClassNumber", "AnglePsi"]
+        )
+        self.assertEqual(list(df["MicrographName"]), ["mic_0.mrc"] * 2 + ["mic_2.mrc"])
+        self.assertEqual(df["MicrographName"].dtype, "category")
+        self.assertEqual(list(df["CoordinateX"]), [1.0, 2.0, 3.0])
+        self.assertEqual(df["CoordinateX"].dtype, "float64")
+        # columns that only some files have are filled with missing values
+        self.assertEqual(df["ClassNumber"].isna().tolist(), [False, False, True])
+        self.assertEqual(df["AnglePsi"].isna().tolist(), [True, True, False])
+        self.assertEqual(list(only_x.to_df().columns), ["CoordinateX"])
+
+    def test_collate_no_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            with self.assertRaises(FileNotFoundError):
+                star_parser.collate(Path(d) / "*.star")
+
+    def test_parse_where(self):
+        full = StarParser(self.starfile, create=False).parse()
+        df = full["data_micrographs"].to_df()
+        accepted = set(df["MicrographName"][:10]) | {"missing.mrc"}
+        where = {
+            "CtfMaxResolution": lambda values: values < 4,
+            "_rlnOpticsGroup": 1,
+            "MicrographName": accepted,
+        }
+        tabs = StarParser(self.starfile, create=False).parse(where=where)
+        expected = df[
+            (df["CtfMaxResolution"] < 4) & df["MicrographName"].isin(accepted)
+        ].reset_index(drop=True)
+        result = tabs["data_micrographs"].to_df()
+        pd.testing.assert_frame_equal(result, expected, check_categorical=False)
+        self.assertEqual(len(result["MicrographName"].cat.categories), len(result))
+        # tables without the columns are read whole
+        self.assertTrue(tabs["data_optics"].to_df().equals(full["data_optics"].to_df()))
+        # by table, with columns that are only used to filter
+        tabs = StarParser(self.starfile, create=False).parse(
+            columns={"data_micrographs": ["DefocusU"]},
+            where={"data_micrographs": {"CtfMaxResolution": (3.2, 4.5)}},
+        )
+        values = df.loc[df["CtfMaxResolution"].isin([3.2, 4.5]), "DefocusU"]
+        self.assertEqual(tabs["data_micrographs"].labels, ["loop_", "_rlnDefocusU #1"])
+        self.assertEqual(
+            tabs["data_micrographs"].to_df()["DefocusU"].tolist(), values.tolist()
+        )
+
+    def test_parse_where_missing_columns(self):
+        parser = StarParser(self.starfile, create=False)
+        with self.assertRaises(KeyError):
+            parser.parse(where={"data_micrographs": {"DefocsU": 1.0}})
+        with self.assertRaises(KeyError):
+            parser.parse(where={"DefocsU": 1.0})
+        with self.assertRaises(KeyError):
+            parser.parse(tabs="data_optics", where={"DefocusU": 1.0})
+        # tables that a predicate for all tables is not meant for are read whole
+        tabs = parser.parse(where={"OpticsGroupName": "opticsGroup2"})
+        self.assertEqual(len(tabs["data_optics"].to_df()), 0)
+        self.assertEqual(len(tabs["data_micrographs"].to_df()), 4500)
+
+    def test_parse_where_values_that_do_not_match_labels(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "mixed.star"
+            rows = [f"a{i}.mrc {i} {'x' if i == 25 else i}" for i in range(30)]
+            star.write_text(
+                "data_\n\nloop_\n_rlnMicrographName\n_rlnOpticsGroup\n_rlnDefocusU\n"
+                + "\n".join(rows)
+            )
+            where = {"OpticsGroup": lambda values: values % 5 == 0}
+            df = StarParser(star, create=False).parse(where=where)["data_"].to_df()
+            chunks = StarParser(star, create=False).iter_chunks(
+                "data_", chunksize=10, where=where
+            )
+            self.assertEqual([len(c) for c in chunks], [2, 2, 2])
+        self.assertEqual(df["OpticsGroup"].tolist(), [0, 5, 10, 15, 20, 25])
+        self.assertEqual(df["DefocusU"].tolist(), ["0", "5", "10", "15", "20", "x"])
+
+    def test_iter_chunks(self):
+        parser = StarParser(self.starfile, create=False)
+        chunks = list(parser.iter_chunks("data_micrographs", chunksize=1000))
+        self.assertEqual([len(c) for c in chunks], [1000] * 4 + [500])
+        expected = StarParser(self.starfile, create=False).parse()
+        pd.testing.assert_frame_equal(
+            pd.concat(chunks),
+            expected["data_micrographs"].to_df(),
+            check_categorical=False,
+            check_dtype=False,
+        )
+        self.assertEqual(chunks[0]["DefocusU"].dtype, np.float64)
+        chunks = parser.iter_chunks("data_micrographs", columns=["DefocusU"])
+        self.assertEqual(list(next(chunks).columns), ["DefocusU"])
+        with self.assertRaises(KeyError):
+            next(parser.iter_chunks("data_particles"))
+        where = {"CtfMaxResolution": lambda values: values < 4}
+        chunks = parser.iter_chunks("data_micrographs", 1000, where=where)
+        self.assertEqual(sum(len(c) for c in chunks), 4460)
+        with self.assertRaises(KeyError):
+            next(parser.iter_chunks("data_micrographs", where={"ClassNumber": 2}))
+
+    def test_iter_chunks_values_that_do_not_match_labels(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "mixed.star"
+            rows = [f"a{i}.mrc {'x' if i == 25 else i}" for i in range(30)]
+            star.write_text(
+                "data_\n\nloop_\n_rlnMicrographName\n_rlnDefocusU\n" + "\n".join(rows)
+            )
+            parser = StarParser(star, create=False)
+            chunks = list(parser.iter_chunks("data_", chunksize=10))
+        self.assertEqual([len(c) for c in chunks], [10, 10, 10])
+        self.assertEqual(chunks[0]["DefocusU"].dtype, np.float64)
+        self.assertEqual(chunks[2]["DefocusU"][25], "x")
+
+    def test_sort_chunks_to_star_writer(self):
+        parser = StarParser(self.starfile, create=False)
+        version = parser.index()["data_micrographs"].version
+        tab = StarParser(self.starfile, create=False).parse()["data_micrographs"]
+        sort_rows = star_parser._SORT_ROWS
+        star_parser._SORT_ROWS = 1000
+        with tempfile.TemporaryDirectory() as d:
+            destination = Path(d) / "sorted.star"
+            try:
+                chunks = parser.iter_chunks("data_micrographs", chunksize=300)
+                with star_parser.StarWriter(destination) as writer:
+                    rows = star_parser.sort_chunks(chunks, "DefocusV", False, d)
+                    writer.write_chunks("data_micrographs", rows, version)
+            finally:
+                star_parser._SORT_ROWS = sort_rows
+            written = StarParser(destination, create=False).parse()["data_micrographs"]
+            pd.testing.assert_frame_equal(
+                written.df, tab.sort_by("DefocusV", False), check_categorical=False
+            )
+            with self.assertRaises(KeyError):
+                next(star_parser.sort_chunks([tab.df], "ImageName"))
+
+    def test_sort_chunks_missing_text(self):
+        df = pd.DataFrame(
+            {
+                "DefocusU": [5.0, 3.0, 1.0, 4.0, 2.0, 6.0],
+                "MicrographName": ["a.mrc", None, "c.mrc", np.nan, "e.mrc", "f.mrc"],
+            }
+        )
+        sort_rows = star_parser._SORT_ROWS
+        star_parser._SORT_ROWS = 2  # runs merged from disk
+        try:
+            chunks = [df.iloc[:3], df.iloc[3:]]
+            rows = pd.concat(list(star_parser.sort_chunks(chunks, "DefocusU")))
+        finally:
+            star_parser._SORT_ROWS = sort_rows
+        self.assertEqual(rows["DefocusU"].tolist(), [1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        names = rows["MicrographName"].tolist()
+        self.assertEqual(names[:2] + names[4:], ["c.mrc", "e.mrc", "a.mrc", "f.mrc"])
+        self.assertTrue(rows["MicrographName"].iloc[2:4].isna().all())
+
+    def test_sort_chunks_exact_numbers(self):
+        df = pd.DataFrame(
+            {
+                "ClassNumber": [2**53 + 1, 2**53, -(2**53) - 1, 1, -(2**53)],
+                "DefocusU": [0.0, -0.0, -1.0, 0.0, -0.0],
+            }
+        )
+        chunks = [df.iloc[:3], df.iloc[3:]]
+
+        def sort(chunks, column):
+            return pd.concat(list(star_parser.sort_chunks(chunks, column)))
+
+        sort_rows = star_parser._SORT_ROWS
+        for rows in [100, 2]:  # in memory, and runs merged from disk
+            star_parser._SORT_ROWS = rows
+            try:
+                by_class = sort(chunks, "ClassNumber")
+                by_defocus = sort(chunks, "DefocusU")
+                # integers in one run and floats in another
+                mixed = sort([chunks[0], chunks[1].astype(np.float64)], "ClassNumber")
+            finally:
+                star_parser._SORT_ROWS = sort_rows
+            expected = sorted(df["ClassNumber"].tolist())
+            self.assertEqual(by_class["ClassNumber"].tolist(), expected)
+            self.assertTrue(mixed["ClassNumber"].is_monotonic_increasing)
+            # -0.0 and 0.0 are equal and keep their order
+            signs = np.signbit(by_defocus["DefocusU"].to_numpy()).tolist()
+            self.assertEqual(signs, [True, False, True, False, True])
+
+    def test_star_writer(self):
+        parser = StarParser(self.starfile, create=False)
+        version = parser.index()["data_micrographs"].version
+        reference = StarParser(self.starfile, create=False)
+        tabs = reference.parse()
+        with tempfile.TemporaryDirectory() as d:
+            destination = Path(d) / "out.star"
+            with star_parser.StarWriter(destination) as writer:
+                writer.write_tab(tabs["data_optics"])
+                writer.write_chunks(
+                    "data_micrographs",
+                    parser.iter_chunks("data_micrographs", chunksize=1000),
+                    version,
+                )
+            # as the tables would be written, write_out copies the file instead
+            expected = io.BytesIO()
+            tabs["data_optics"].write(expected)
+            expected.write(b"\n")
+            tabs["data_micrographs"].write(expected)
+            self.assertEqual(destination.read_bytes(), expected.getvalue())
+            # chunks changed through StarTab methods on the way
+            chunks = (
+                StarTabDf(c).fill_column("Voltage", 300, create=True)
+                for c in parser.iter_chunks("data_micrographs", chunksize=1000)
+            )
+            with star_parser.StarWriter(destination) as writer:
+                writer.write_chunks("data_micrographs", chunks)
+            written = StarParser(destination, create=False).parse()
+            self.assertEqual(len(written["data_micrographs"].to_df()), 4500)
+            self.assertIn("_rlnVoltage #10", written["data_micrographs"].labels)
+            chunks = [pd.DataFrame({"a": [1]}), pd.DataFrame({"b": [1]})]
+            with star_parser.StarWriter(destination) as writer:
+                with self.assertRaises(ValueError):
+                    writer.write_chunks("data_", chunks)
+
+    def test_compressed_files(self):
+        suffixes = [".gz", ".xz"] + [".zst"] * (star_parser.zstandard is not None)
+        reference = StarParser(self.starfile, create=False)
+        tabs = reference.parse()
+        with tempfile.TemporaryDirectory() as d:
+            for suffix in suffixes:
+                star = Path(d) / f"micrographs_ctf.star{suffix}"
+                reference.write_out(to_file=True, new_file=star)
+                self.assertLess(star.stat().st_size, self.starfile.stat().st_size / 4)
+                parser = StarParser(star, create=False)
+                parser.parse()
+                self.assertEqual(parser.write_out(), reference.write_out())
+                # tables read after the scan passed them
+                parser = StarParser(star, create=False)
+                parser.parse(tabs="data_micrographs")
+                optics = parser.parse(tabs="data_optics")["data_optics"]
+                self.assertTrue(optics.to_df().equals(tabs["data_optics"].to_df()))
+                chunks = parser.iter_chunks("data_micrographs", chunksize=1000)
+                self.assertEqual(sum(len(c) for c in chunks), 4500)
+                lines = parser.read_file(star)
+                self.assertEqual("".join(lines), reference.write_out())
+            # recognised by content, whatever the name
+            star = Path(d) / "micrographs_ctf.star"
+            (Path(d) / "micrographs_ctf.star.gz").rename(star)
+            self.assertEqual(len(StarParser(star, create=False).parse()), 2)
+
+    def test_write_out_copies_unchanged_text(self):
+        original = self.starfile.read_bytes()
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "micrographs_ctf.star"
+            star.write_bytes(original)
+            parser = StarParser(star, create=False)
+            tabs = parser.parse()
+            self.assertEqual(parser.write_out().encode(), original)
+            # one table changed, the other copied
+            tabs["data_optics"].fill_column("Voltage", 200, overwrite=True, store=True)
+            text = parser.write_out()
+            micrographs = original[parser.blocks["data_micrographs"].start :]
+            self.assertTrue(text.encode().endswith(micrographs))
+            self.assertNotEqual(text.encode(), original)
+            # one row changed, the other rows copied
+            parser = StarParser(star, create=False)
+            tabs = parser.parse()
+            df = tabs["data_micrographs"].df
+            df.loc[10, "DefocusU"] = 1.5
+            lines = parser.write_out().splitlines()
+            expected = original.decode().splitlines()
+            changed = [i for i, (a, b) in enumerate(zip(lines, expected)) if a != b]
+            self.assertEqual(len(lines), len(expected))
+            self.assertEqual(len(changed), 1)
+            self.assertIn("1.500000", lines[changed[0]])
+            # rows removed and moved
+            tabs["data_micrographs"].df = pd.concat([df.iloc[2000:], df.iloc[2:2000]])
+            parser.write_out(to_file=True, new_file=Path(d) / "rows.star")
+            written = StarParser(Path(d) / "rows.star", create=False).parse()
+            self.assertEqual(
+                written["data_micrographs"].to_df().to_numpy().tolist(),
+                tabs["data_micrographs"].df.to_numpy().tolist(),
+            )
+            # a partial parse copies the tables it skipped
+            parser = StarParser(star, create=False)
+            parser.parse(tabs="data_optics")
+            self.assertEqual(parser.write_out().encode(), original)
+            # written in place, the file changes under the parser
+            optics = parser.tabs["data_optics"]
+            optics.fill_column("Voltage", 200, overwrite=True, store=True)
+            parser.write_out(to_file=True)
+            parser.tabs["data_optics"].fill_column(
+                "Voltage", 100, overwrite=True, store=True
+            )
+            parser.write_out(to_file=True)
+            written = StarParser(star, create=False).parse()
+            self.assertEqual(len(written["data_micrographs"].to_df()), 4500)
+            self.assertEqual(written["data_optics"].to_df()["Voltage"][0], 100)
+
+    def test_write_out_changed_rows_in_chunks(self):
+        parser = StarParser(self.starfile, create=False)
+        df = parser.parse()["data_micrographs"].df
+        changed = list(range(10, 21)) + [100] + list(range(3000, 3016))
+        df.loc[changed, "DefocusU"] = 1.5
+        whole = parser.write_out()
+        rows = star_parser._WRITE_ROWS
+        star_parser._WRITE_ROWS = 7  # runs of changed rows across chunks
+        try:
+            self.assertEqual(parser.write_out(), whole)
+        finally:
+            star_parser._WRITE_ROWS = rows
+        lines = whole.splitlines()
+        expected = self.starfile.read_text().splitlines()
+        self.assertEqual(len(lines), len(expected))
+        different = [i for i, (a, b) in enumerate(zip(lines, expected)) if a != b]
+        self.assertEqual(len(different), len(changed))
+        self.assertTrue(all("1.500000" in lines[i] for i in different))
+
+    def copied_star(self, directory):
+        # a copy of self.starfile in directory
+        star = Path(directory) / "micrographs_ctf.star"
+        star.write_bytes(self.starfile.read_bytes())
+        return star
+
+    def test_append_rows_to_last_table(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = self.copied_star(d)
+            parser = StarParser(star, create=False)
+            rows = parser.parse()["data_micrographs"].to_df().iloc[:3]
+            size = star.stat().st_size
+            # only the rows are written
+            parser.append_rows("data_micrographs", rows[rows.columns[::-1]])
+            original = self.starfile.read_bytes()
+            self.assertEqual(star.read_bytes()[: size - 3], original[:-3])
+            self.assertNotIn("data_micrographs", parser.tabs)
+            self.assertEqual(parser.write_out(), star.read_text())
+            df = StarParser(star, create=False).parse()["data_micrographs"].to_df()
+            self.assertEqual(len(df), 4503)
+            self.assertTrue(df.iloc[-3:].reset_index(drop=True).equals(rows))
+
+    def test_append_rows_before_the_end(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = self.copied_star(d)
+            parser = StarParser(star, create=False)
+            parser.append_rows("data_optics", parser.parse()["data_optics"])
+            written = StarParser(star, create=False).parse()
+            self.assertEqual(len(written["data_optics"].to_df()), 2)
+            self.assertEqual(len(written["data_micrographs"].to_df()), 4500)
+            self.assertEqual(parser.write_out(), star.read_text())
+
+    def test_write_through_symlink(self):
+        with tempfile.TemporaryDirectory() as d:
+            target = self.copied_star(d)
+            link = Path(d) / "link.star"
+            link.symlink_to(target)
+            parser = StarParser(link, create=False)
+            tab = parser.parse()["data_micrographs"]
+            tab.df = tab.df.iloc[:10]
+            parser.write_out(to_file=True)
+            self.assertTrue(link.is_symlink())
+            tabs = StarParser(target, create=False).parse()
+            self.assertEqual(len(tabs["data_micrographs"].to_df()), 10)
+            # appended before the end, the file is written again
+            parser.append_rows("data_optics", tabs["data_optics"])
+            self.assertTrue(link.is_symlink())
+            tabs = StarParser(target, create=False).parse()
+            self.assertEqual(len(tabs["data_optics"].to_df()), 2)
+
+    def test_parse_after_the_file_changed(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = self.copied_star(d)
+            parser = StarParser(star, create=False)
+            parser.index()
+            # offsets of the tables move
+            star.write_bytes(b"# edited\n" * 7 + self.starfile.read_bytes())
+            tab = parser.parse(tabs="data_micrographs")["data_micrographs"]
+            expected = StarParser(self.starfile).parse()["data_micrographs"]
+            self.assertTrue(tab.to_df().equals(expected.to_df()))
+            # rows are added after the end of the indexed tables
+            rows = expected.to_df().iloc[:3]
+            lines = rows.astype(str).apply(" ".join, axis=1)
+            with open(star, "a") as f:
+                f.write("\n".join(lines) + "\n")
+            range_min = star_parser._RANGE_MIN
+            star_parser._RANGE_MIN = 1 << 16
+            try:
+                tabs = parser.parse(workers=2)
+            finally:
+                star_parser._RANGE_MIN = range_min
+            self.assertEqual(len(tabs["data_micrographs"].to_df()), 4503)
+            chunks = parser.iter_chunks("data_micrographs", chunksize=4000)
+            self.assertEqual(sum(len(c) for c in chunks), 4503)
+
+    def test_append_rows_errors(self):
+        with tempfile.TemporaryDirectory() as d:
+            parser = StarParser(self.copied_star(d), create=False)
+            rows = parser.parse()["data_micrographs"].to_df().iloc[:3]
+            with self.assertRaises(ValueError):
+                parser.append_rows("data_optics", rows)
+            with self.assertRaises(KeyError):
+                parser.append_rows("data_particles", rows)
+
+    def test_append_rows_failed_write(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = self.copied_star(d)
+            star.write_bytes(self.starfile.read_bytes() + b"\n\n")
+            parser = StarParser(star, create=False)
+            rows = parser.parse()["data_micrographs"].to_df().iloc[:3]
+            fsync = os.fsync
+
+            def full(descriptor):
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+            os.fsync = full
+            try:
+                with self.assertRaises(OSError):
+                    parser.append_rows("data_micrographs", rows)
+            finally:
+                os.fsync = fsync
+            # cut back to the last line of the table, without the blank lines
+            written = star.read_bytes()
+            self.assertTrue(self.starfile.read_bytes().startswith(written))
+            self.assertEqual(written.strip(), self.starfile.read_bytes().strip())
+
+    def picks_star(self, directory):
+        # a star file with a third of the micrographs of self.starfile, and the
+        # rows of the table in memory
+        star = Path(directory) / "picks.star"
+        df = StarParser(self.starfile, create=False).parse()["data_micrographs"].df
+        picks = pd.DataFrame(
+            {"MicrographName": df["MicrographName"][::-3], "CoordinateX": 1.0}
+        )
+        text = StarTabDf(picks).to_star()
+        star.write_text(text.replace("data_\n", "data_micrographs\n", 1))
+        return star, df
+
+    def test_join(self):
+        with tempfile.TemporaryDirectory() as d:
+            star, df = self.picks_star(d)
+            parser = StarParser(self.starfile, create=False)
+            joined = parser.join(star, "data_micrographs", "MicrographName")
+            self.assertEqual(joined.get_columns()[-1], "CoordinateX")
+            self.assertIs(parser.tabs["data_micrographs"], joined)
+            expected = df["MicrographName"][2::3].tolist()
+            self.assertEqual(joined.to_df()["MicrographName"].tolist(), expected)
+
+    def test_join_copies_other_tables(self):
+        with tempfile.TemporaryDirectory() as d:
+            star, _ = self.picks_star(d)
+            parser = StarParser(self.starfile, create=False)
+            parser.join(star, "data_micrographs", "MicrographName")
+            parser.write_out(to_file=True, new_file=star)
+            tabs = StarParser(star, create=False).parse()
+            self.assertEqual(list(tabs), ["data_optics", "data_micrographs"])
+            self.assertEqual(len(tabs["data_micrographs"].to_df()), 1500)
+
+    def test_join_parsed_tables(self):
+        with tempfile.TemporaryDirectory() as d:
+            star, _ = self.picks_star(d)
+            parser = StarParser(self.starfile, create=False)
+            parser.parse()
+            picks = StarParser(star, create=False)
+            anti = parser.join(picks, "data_micrographs", "MicrographName", how="anti")
+            self.assertEqual(len(anti.to_df()), 3000)
+
+    def test_diff(self):
+        with tempfile.TemporaryDirectory() as d:
+            star = Path(d) / "changed.star"
+            parser = StarParser(self.starfile, create=False)
+            tab = parser.parse(tabs="data_micrographs")["data_micrographs"]
+            tab.remove_columns(["CtfImage"], store=True)
+            tab.df = tab.df.iloc[1:]
+            parser.write_out(to_file=True, new_file=star)
+            diff = StarParser(self.starfile, create=False).diff(
+                star, "data_micrographs", "MicrographName"
+            )
+            self.assertEqual([len(diff[k].df) for k in diff], [0, 1, 0])
+            self.assertEqual(diff["removed"].name, "data_micrographs")
+            with self.assertRaises(KeyError):
+                parser.diff(star, "data_particles")
+
+    def test_parse_matches_line_by_line_parser(self):
+        starfile = self.starfile.parent / "run_it025_model.star"
+        parser = StarParser(starfile)
+        by_block = parser.parse()
+        by_line = parser.parse(file_blob=parser.iter_file(starfile))
+        self.assertEqual(list(by_block), list(by_line))
+        for name, tab in by_block.items():
+            if name.endswith("_general"):
+                self.assertEqual(tab.body, by_line[name].body)
+            else:
+                self.assertTrue(tab.to_df().equals(by_line[name].to_df()))
+
+    def test_parse_line_by_line_wrong_number_of_fields(self):
+        star = "data_\n\nloop_\n_rlnMicrographName\n_rlnDefocusU\na.mrc 1.0\nb.mrc\n"
+        parser = StarParser(self.starfile, create=False)
+        with self.assertRaises(ValueError):
+            parser.parse(file_blob=iter(star.splitlines(keepends=True)))
+
+
 # class testParser(unittest.TestCase):
 
 #     def test_normal(self):